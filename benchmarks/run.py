@@ -0,0 +1,437 @@
+"""
+Benchmarks for Jettison.
+
+This measures the throughput and memory use of each codec type, arrays and
+strings of several lengths, a few representative definitions, schema
+dispatch with many definitions, and the size and time tradeoff of stream
+compression for each definition. Run all of the benchmarks, and write the
+results as JSON:
+
+    $ python benchmarks/run.py --output results.json
+
+Only run the benchmarks whose names contain a string:
+
+    $ python benchmarks/run.py --filter definition.
+
+Compare two result files, such as the results for two revisions:
+
+    $ python benchmarks/run.py --compare before.json after.json
+
+Each result records the median and best time per operation, in nanoseconds,
+and the peak memory allocated while performing a single operation, in bytes.
+Compression results also record the encoded size before and after
+compression.
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import jettison  # noqa: E402
+import jettison.compression  # noqa: E402
+from jettison._version import __version__  # noqa: E402
+
+
+#: Sample values for each codec type.
+codec_values = {
+    'boolean': True,
+    'float32': 0.5,
+    'float64': -1.5,
+    'int8': -5,
+    'int16': -300,
+    'int32': -70000,
+    'string': u'hello',
+    'svarint': -300,
+    'uint1': 1,
+    'uint2': 3,
+    'uint3': 5,
+    'uint4': 9,
+    'uint5': 17,
+    'uint6': 33,
+    'uint7': 65,
+    'uint8': 200,
+    'uint16': 60000,
+    'uint32': 4000000000,
+    'varint': 300,
+}
+
+#: Lengths of the arrays and strings to benchmark.
+lengths = (0, 16, 256, 4096)
+
+
+def codec_benchmarks():
+    for key, codec in sorted(jettison._codecs.items()):
+        value = codec_values[key]
+        string = codec.dumps(value)
+        yield ('codec.{}.dumps'.format(key),
+               functools.partial(codec.dumps, value))
+        yield ('codec.{}.loads'.format(key),
+               functools.partial(codec.loads, string))
+
+
+def array_benchmarks():
+    codec = jettison.ArrayCodec('f')
+    for length in lengths:
+        values = [float(i) for i in range(length)]
+        string = codec.dumps(values)
+        yield ('array.float32.{}.dumps'.format(length),
+               functools.partial(codec.dumps, values))
+        yield ('array.float32.{}.loads'.format(length),
+               functools.partial(codec.loads, string))
+
+
+def string_benchmarks():
+    codec = jettison.StringCodec()
+    for length in lengths:
+        for name, character in [('ascii', u'a'), ('utf8', u'\xf8')]:
+            value = character * length
+            string = codec.dumps(value)
+            yield ('string.{}.{}.dumps'.format(name, length),
+                   functools.partial(codec.dumps, value))
+            yield ('string.{}.{}.loads'.format(name, length),
+                   functools.partial(codec.loads, string))
+
+
+def make_definitions(codegen):
+    small = jettison.define([
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ], codegen=codegen)
+    small_value = {'entity_id': 1, 'x': 0.5, 'y': -1.5}
+
+    wide_types = ['uint8', 'int16', 'uint32', 'float32', 'float64', 'boolean',
+                  'int8', 'uint16']
+    wide = jettison.define([
+        {'key': 'field{}'.format(i), 'type': wide_types[i % len(wide_types)]}
+        for i in range(32)
+    ], codegen=codegen)
+    wide_value = dict(('field{}'.format(i), 1) for i in range(32))
+
+    string_heavy = jettison.define([
+        {'key': 'entity_id', 'type': 'uint32'},
+    ] + [
+        {'key': 'name{}'.format(i), 'type': 'string'} for i in range(8)
+    ], codegen=codegen)
+    string_heavy_value = dict(('name{}'.format(i), u'name number {}'.format(i))
+                              for i in range(8))
+    string_heavy_value['entity_id'] = 1
+
+    return [
+        ('small', small, small_value),
+        ('wide', wide, wide_value),
+        ('string_heavy', string_heavy, string_heavy_value),
+    ]
+
+
+def definition_benchmarks():
+    for codegen in (False, True):
+        suffix = '.codegen' if codegen else ''
+        for name, definition, value in make_definitions(codegen):
+            string = definition.dumps(value)
+            yield ('definition.{}{}.dumps'.format(name, suffix),
+                   functools.partial(definition.dumps, value))
+            yield ('definition.{}{}.loads'.format(name, suffix),
+                   functools.partial(definition.loads, string))
+
+
+def schema_benchmarks():
+    schema = jettison.Schema(id_type='uint16')
+    for i in range(200):
+        schema.define('message{}'.format(i), [
+            {'key': 'entity_id', 'type': 'uint32'},
+            {'key': 'x', 'type': 'float32'},
+            {'key': 'y', 'type': 'float32'},
+            {'key': 'health', 'type': 'int16'},
+        ])
+    value = {'entity_id': 1, 'x': 0.5, 'y': -1.5, 'health': 100}
+    string = schema.dumps('message199', value)
+    messages = [('message{}'.format(i * 2), value) for i in range(100)]
+    buffer, _ = schema.dumps_batch(messages)
+
+    def loads_batch():
+        offset = 0
+        while offset < len(buffer):
+            _, offset = schema.loads_from(buffer, offset)
+
+    yield 'schema.dumps', functools.partial(schema.dumps, 'message199',
+                                            value)
+    yield 'schema.loads', functools.partial(schema.loads, string)
+    yield 'schema.dumps_batch.100', functools.partial(schema.dumps_batch,
+                                                      messages)
+    yield 'schema.loads_from.100', loads_batch
+
+
+def make_compression_messages(count, seed):
+    """
+    Make sample messages for the compression benchmarks. Chat and inventory
+    messages repeat the same words and item names, like real traffic does,
+    while position messages are mostly numbers.
+
+    :param int count: Number of messages of each definition.
+    :param int seed: Seed for the random number generator.
+    :returns: dict of definition keys to lists of data dicts.
+    """
+    rng = random.Random(seed)
+    words = ['anyone', 'selling', 'buying', 'looking', 'for', 'group', 'the',
+             'dungeon', 'raid', 'tonight', 'meet', 'at', 'gate', 'thanks',
+             'lol', 'need', 'healer', 'tank', 'price', 'check']
+    items = ['Sword of the Ancients', 'Health Potion', 'Mana Potion',
+             'Iron Ore', 'Dragon Scale', 'Leather Boots', 'Arrow',
+             'Scroll of Teleportation', 'Gold Ring', 'Wooden Shield']
+    return {
+        'chat': [{
+            'entity_id': rng.randrange(100000),
+            'channel': rng.choice(['general', 'trade', 'guild']),
+            'text': ' '.join(rng.choice(words)
+                             for _ in range(rng.randrange(3, 15))),
+        } for _ in range(count)],
+        'inventory': [{
+            'entity_id': rng.randrange(100000),
+            'slot': rng.randrange(40),
+            'name': rng.choice(items),
+            'count': rng.randrange(1, 100),
+        } for _ in range(count)],
+        'position': [{
+            'entity_id': rng.randrange(100000),
+            'x': rng.uniform(-1000, 1000),
+            'y': rng.uniform(-1000, 1000),
+        } for _ in range(count)],
+    }
+
+
+def compression_benchmarks():
+    schema = jettison.Schema()
+    schema.define('chat', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'channel', 'type': 'string'},
+        {'key': 'text', 'type': 'string'},
+    ])
+    schema.define('inventory', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'slot', 'type': 'uint8'},
+        {'key': 'name', 'type': 'string'},
+        {'key': 'count', 'type': 'uint16'},
+    ])
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ])
+    # The dictionary is trained and measured on different messages, so that
+    # it isn't measured on the exact messages that it was trained on.
+    training = make_compression_messages(1000, seed=1)
+    samples = [schema.dumps(key, data)
+               for key, values in sorted(training.items())
+               for data in values]
+    compressions = [
+        ('none', None),
+        ('zlib', jettison.compression.Compression(threshold=0)),
+        ('zlib_dict', jettison.compression.Compression(
+            jettison.compression.train_dictionary(samples), threshold=0)),
+    ]
+    for key, values in sorted(make_compression_messages(100, 2).items()):
+        messages = [(key, data) for data in values]
+        raw_bytes = len(schema.dumps_batch(messages)[0])
+        for mode, compression in compressions:
+            if compression is None:
+                def dumps_each(messages=messages):
+                    return [schema.dumps(key, data) for key, data in messages]
+                dumps_batch = functools.partial(schema.dumps_batch, messages)
+                frames = dumps_each()
+                batch = dumps_batch()[0]
+            else:
+                def dumps_each(messages=messages, compression=compression):
+                    return [compression.dumps(schema, key, data)
+                            for key, data in messages]
+                dumps_batch = functools.partial(compression.dumps_batch,
+                                                schema, messages)
+                frames = dumps_each()
+                batch = dumps_batch()
+            name = 'compression.{}.{}'.format(key, mode)
+            yield ('{}.message.100'.format(name), dumps_each, {
+                'raw_bytes': raw_bytes,
+                'encoded_bytes': sum(len(frame) for frame in frames),
+            })
+            yield ('{}.batch.100'.format(name), dumps_batch, {
+                'raw_bytes': raw_bytes,
+                'encoded_bytes': len(batch),
+            })
+            if compression is not None:
+                stream = b''.join(frames)
+                yield ('{}.decode.100'.format(name), functools.partial(
+                    compression.decoder(schema).feed, stream))
+
+
+benchmark_groups = [
+    codec_benchmarks,
+    array_benchmarks,
+    string_benchmarks,
+    definition_benchmarks,
+    schema_benchmarks,
+    compression_benchmarks,
+]
+
+
+def measure(function, min_time, repeat):
+    """
+    Measure the time and peak memory of an operation.
+
+    :param function: The operation to measure.
+    :param float min_time: Minimum time to run each repeat for, in seconds.
+    :param int repeat: Number of times to repeat the measurement.
+    :returns: dict
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed) + 1)
+
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+
+    tracemalloc.start()
+    try:
+        function()
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    median = statistics.median(timings)
+    return {
+        'ns_per_op': median * 1e9,
+        'min_ns_per_op': min(timings) * 1e9,
+        'ops_per_sec': 1.0 / median,
+        'peak_bytes': peak - current,
+        'iterations': number * repeat,
+    }
+
+
+def get_revision():
+    """
+    Get the git revision of the working tree, if it is available.
+
+    :returns: str, or None.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(filter=None, min_time=0.1, repeat=5):
+    """
+    Run the benchmarks.
+
+    :param str filter: Only run benchmarks whose names contain this string.
+    :param float min_time: Minimum time to run each repeat for, in seconds.
+    :param int repeat: Number of times to repeat each measurement.
+    :returns: dict of the results, and information about the environment.
+    """
+    results = []
+    for group in benchmark_groups:
+        # Benchmarks can include extra information, such as encoded sizes,
+        # which is added to their results.
+        for name, function, *info in group():
+            if filter and filter not in name:
+                continue
+            result = measure(function, min_time, repeat)
+            result['name'] = name
+            for extra in info:
+                result.update(extra)
+            results.append(result)
+            sys.stderr.write('{:<40} {:>12.1f} ns {:>10} bytes\n'.format(
+                name, result['ns_per_op'], result['peak_bytes']))
+    return {
+        'jettison_version': __version__,
+        'revision': get_revision(),
+        'backend': 'python' if jettison._speedups is None else 'speedups',
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'results': results,
+    }
+
+
+def compare(before, after):
+    """
+    Print a comparison of two result files.
+
+    :param dict before: The baseline results.
+    :param dict after: The results to compare with the baseline.
+    """
+    before_results = dict((result['name'], result)
+                          for result in before['results'])
+    print('{:<40} {:>12} {:>12} {:>8} {:>12}'.format(
+        'benchmark', 'before ns', 'after ns', 'change', 'bytes'))
+    for result in after['results']:
+        old = before_results.get(result['name'])
+        if old is None:
+            continue
+        change = result['ns_per_op'] / old['ns_per_op'] - 1
+        print('{:<40} {:>12.1f} {:>12.1f} {:>+7.1%} {:>+12}'.format(
+            result['name'], old['ns_per_op'], result['ns_per_op'], change,
+            result['peak_bytes'] - old['peak_bytes']))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark jettison.')
+    parser.add_argument('-o', '--output',
+                        help='write the results to this file')
+    parser.add_argument('-f', '--filter',
+                        help='only run benchmarks containing this string')
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='minimum seconds per measurement')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of measurements per benchmark')
+    parser.add_argument('--pure-python', action='store_true',
+                        help="don't use the C accelerator")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files')
+    args = parser.parse_args(args)
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            compare(json.load(before), json.load(after))
+        return
+    if args.pure_python:
+        jettison._speedups = None
+    results = run(args.filter, args.min_time, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
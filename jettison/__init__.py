@@ -49,45 +49,100 @@ on the client and server.
 
 Types that are currently supported are:
 
-+---------+------------------------------------------------------------------+
-| Type    | Description                                                      |
-+=========+==================================================================+
-| int8    | 1 byte signed integer. Range is -128 to 127 (inclusive).         |
-+---------+------------------------------------------------------------------+
-| int16   | 2 byte signed integer. Range is -32768 to 32767.                 |
-+---------+------------------------------------------------------------------+
-| int32   | 4 byte signed integer. Range is -2147483648 to 2147483647.       |
-+---------+------------------------------------------------------------------+
-| uint8   | 1 byte unsigned integer. Range is 0 to 255.                      |
-+---------+------------------------------------------------------------------+
-| uint16  | 2 byte unsigned integer. Range is 0 to 65535.                    |
-+---------+------------------------------------------------------------------+
-| uint32  | 4 byte unsigned integer. Range is 0 to 4294967295.               |
-+---------+------------------------------------------------------------------+
-| float32 | 4 byte floating point number. Note that normal JavaScript        |
-|         | numbers will be rounded to fit this size, so decoded values      |
-|         | will only approximately equal the originals.                     |
-+---------+------------------------------------------------------------------+
-| float64 | 8 byte floating point number. Normal JavaScript numbers are      |
-|         | stored in this format, so these will be transmitted without      |
-|         | rounding.                                                        |
-+---------+------------------------------------------------------------------+
-| array   | A variable length array of another type. When you use this type, |
-|         | you must also specify a `valueType` field, which will specify    |
-|         | the type of value in the array.                                  |
-+---------+------------------------------------------------------------------+
-| string  | A variable length string. JavaScript's UTF-16 strings are        |
-|         | encoded to UTF-8 for transmission.                               |
-+---------+------------------------------------------------------------------+
++-----------+-----------------------------------------------------------------+
+| Type      | Description                                                     |
++===========+=================================================================+
+| boolean   | 1 byte boolean value. If the schema was created with            |
+|           | pack_booleans=True, consecutive booleans are packed into shared |
+|           | bytes, using one bit each.                                      |
++-----------+-----------------------------------------------------------------+
+| int8      | 1 byte signed integer. Range is -128 to 127 (inclusive).        |
++-----------+-----------------------------------------------------------------+
+| int16     | 2 byte signed integer. Range is -32768 to 32767.                |
++-----------+-----------------------------------------------------------------+
+| int32     | 4 byte signed integer. Range is -2147483648 to 2147483647.      |
++-----------+-----------------------------------------------------------------+
+| uint8     | 1 byte unsigned integer. Range is 0 to 255.                     |
++-----------+-----------------------------------------------------------------+
+| uint16    | 2 byte unsigned integer. Range is 0 to 65535.                   |
++-----------+-----------------------------------------------------------------+
+| uint32    | 4 byte unsigned integer. Range is 0 to 4294967295.              |
++-----------+-----------------------------------------------------------------+
+| uintN     | Types uint1 to uint7 are unsigned integers of 1 to 7 bits.      |
+|           | Range is 0 to 2^N-1. Consecutive fields of these types are      |
+|           | packed into shared bytes, with the first field in the most      |
+|           | significant bits. They can't be used as array value types.      |
++-----------+-----------------------------------------------------------------+
+| float32   | 4 byte floating point number. Note that normal JavaScript       |
+|           | numbers will be rounded to fit this size, so decoded values     |
+|           | will only approximately equal the originals.                    |
++-----------+-----------------------------------------------------------------+
+| float64   | 8 byte floating point number. Normal JavaScript numbers are     |
+|           | stored in this format, so these will be transmitted without     |
+|           | rounding.                                                       |
++-----------+-----------------------------------------------------------------+
+| array     | A variable length array of another type. When you use this      |
+|           | type, you must also specify a `value_type` field, which will    |
+|           | specify the type of value in the array. Arrays are decoded as   |
+|           | tuples by default. Set `array_type` to "array" or "numpy" to    |
+|           | decode them into an `array.array` or a `numpy.ndarray` instead. |
+|           | The value type can also be "string", or "struct" along with a   |
+|           | `definition` field.                                             |
++-----------+-----------------------------------------------------------------+
+| string    | A variable length string. JavaScript's UTF-16 strings are       |
+|           | encoded to UTF-8 for transmission.                              |
++-----------+-----------------------------------------------------------------+
+| struct    | The fields of another definition, nested inside this one.       |
+|           | Specify the nested definition with a `definition` field. Within |
+|           | a schema, this can be the key of a definition that was defined  |
+|           | earlier.                                                        |
++-----------+-----------------------------------------------------------------+
+| quantized | A floating point number in a fixed range, encoded as an         |
+|           | unsigned integer. Specify the range with `min` and `max`        |
+|           | fields, and the size of the integer with a `bits` field of 8,   |
+|           | 16 or 32. The range is divided into evenly spaced steps, and    |
+|           | values are rounded to the nearest step.                         |
++-----------+-----------------------------------------------------------------+
+| varint    | Variable length unsigned integer, from 1 to 10 bytes. Range is  |
+|           | 0 to 18446744073709551615. Values under 128 use a single byte.  |
++-----------+-----------------------------------------------------------------+
+| svarint   | Variable length signed integer, zigzag encoded so that small    |
+|           | negative numbers are also short. Range is -9223372036854775808  |
+|           | to 9223372036854775807.                                         |
++-----------+-----------------------------------------------------------------+
+
+Arrays and strings are prefixed with their length as a uint32 by default.
+Pass ``length_type='varint'`` to a Schema to encode their lengths as varints
+instead. Varints are not supported by the JavaScript version of the library,
+so only use them if both ends of the connection understand them.
 
 Note that if you attempt to encode a value that is out of range of its type,
 an exception will be raised.
 """
 
+import array
+import collections
+import itertools
+import keyword
+import linecache
+import pickle
 import struct
+import sys
+import uuid
+import weakref
 
 import six
 
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+try:
+    from jettison import _speedups
+except ImportError:  # pragma: no cover
+    _speedups = None
+
 
 #: This struct is used to encode big endian length values.
 _big_length_struct = struct.Struct('>I')
@@ -109,6 +164,207 @@ def _get_length_struct(little_endian):
         return _big_length_struct
 
 
+_array_structs = {}
+_repeated_structs = {}
+_max_cached_structs = 1024
+
+
+def _cache_struct(cache, key, format):
+    """
+    Compile a struct and store it in a cache. The cache is cleared whenever
+    it fills up, so that encoding arrays of many different lengths can't grow
+    it without bound.
+
+    :param dict cache: The cache to store the struct in.
+    :param key: The cache key for the struct.
+    :param str format: The format string to compile.
+    :returns: struct.Struct
+    """
+    if len(cache) >= _max_cached_structs:
+        cache.clear()
+    compiled_struct = cache[key] = struct.Struct(format)
+    return compiled_struct
+
+
+def _get_array_struct(value_format, length, little_endian):
+    """
+    Return a compiled struct for an array of values.
+
+    Arrays of the same length tend to be encoded over and over, so the
+    compiled structs are cached instead of parsing a new format string for
+    every array.
+
+    :param str value_format: Format string for the list items.
+    :param int length: The number of items in the list.
+    :param bool little_endian:
+    :returns: struct.Struct
+    """
+    key = (value_format, length, little_endian)
+    try:
+        return _array_structs[key]
+    except KeyError:
+        return _cache_struct(_array_structs, key, '{}{}{}'.format(
+            '<' if little_endian else '>', length, value_format))
+
+
+def _get_repeated_struct(format, count, little_endian):
+    """
+    Return a compiled struct that repeats a format string count times. This is
+    used to pack lists of nested definitions, whose formats contain more than
+    one value and so can't be repeated with a count prefix.
+
+    :param str format: Format string for one item in the list.
+    :param int count: The number of items in the list.
+    :param bool little_endian:
+    :returns: struct.Struct
+    """
+    key = (format, count, little_endian)
+    try:
+        return _repeated_structs[key]
+    except KeyError:
+        return _cache_struct(_repeated_structs, key, '{}{}'.format(
+            '<' if little_endian else '>', format * count))
+
+
+class BufferFullError(struct.error):
+
+    """
+    Raised by the dumps_into methods when the encoded value would not fit in
+    the space remaining in the buffer. When this is raised, part of the value
+    may have been written to the buffer, so the caller should flush the
+    buffer and encode the value again.
+    """
+
+
+class TruncatedError(struct.error):
+
+    """
+    Raised by the loads methods when the string ends before the end of the
+    encoded value, so the value might decode once more bytes are available.
+    Other decoding errors, such as an invalid varint or a length above the
+    maximum, raise struct.error itself.
+
+    :param str message: The error message.
+    :param int size: The size the string needs to be, counting from its
+        start, to decode the part of the value that failed.
+    """
+
+    def __init__(self, message, size):
+        super(TruncatedError, self).__init__(message)
+        self.size = size
+
+    def __reduce__(self):
+        return (TruncatedError, (self.args[0], self.size))
+
+
+def _check_truncated(string, size):
+    """
+    Raise TruncatedError if a string is smaller than size bytes. This is
+    called after struct.unpack_from fails, to tell a short string apart from
+    other errors.
+
+    :param string: The string that was being decoded.
+    :param int size: The number of bytes required.
+    :raises TruncatedError: If the string is too small.
+    """
+    with memoryview(string) as view:
+        _check_buffer_size(view, size)
+
+
+def _check_buffer_space(buffer, size):
+    """
+    Make sure a buffer is large enough to write size bytes into it.
+
+    :param buffer: The writable buffer to check.
+    :param int size: The number of bytes required.
+    :raises BufferFullError: If the buffer is too small.
+    """
+    if len(buffer) < size:
+        raise BufferFullError('buffer of {} bytes is too small, {} bytes are '
+                              'required'.format(len(buffer), size))
+
+
+def _write_bytes(buffer, offset, string):
+    """
+    Copy a string into a buffer at an offset. Unlike slice assignment, this
+    never resizes the buffer.
+
+    :param buffer: The writable buffer.
+    :param int offset: Offset within the buffer to copy to.
+    :param str string: The bytes to copy.
+    :returns: int offset just past the copied bytes.
+    :raises BufferFullError: If the buffer is too small.
+    """
+    end = offset + len(string)
+    _check_buffer_space(buffer, end)
+    buffer[offset:end] = string
+    return end
+
+
+def _check_length(length, max_length):
+    """
+    Make sure the length of a string or array is within its bound.
+
+    :param int length: The length of the value being encoded.
+    :param int max_length: The maximum length, or None if it is unbounded.
+    :raises struct.error: If the length is larger than the maximum.
+    """
+    if max_length is not None and length > max_length:
+        raise struct.error('length {} is larger than the maximum length of '
+                           '{}'.format(length, max_length))
+
+
+def _has_changed(codec, value, previous_value, little_endian):
+    """
+    Check whether a field value differs from its previous value.
+
+    :param codec: The codec for the field.
+    :param value: The new value.
+    :param previous_value: The previously sent value.
+    :param bool little_endian: If True, values are encoded in little endian
+        format.
+    :returns: bool
+    """
+    if numpy is not None and (isinstance(value, numpy.ndarray) or
+                              isinstance(previous_value, numpy.ndarray)):
+        return not numpy.array_equal(value, previous_value)
+    try:
+        return bool(value != previous_value)
+    except ValueError:
+        # Containers of numpy arrays, such as struct fields, can't be
+        # compared directly, but their encoded strings can.
+        return (codec.dumps(value, little_endian) !=
+                codec.dumps(previous_value, little_endian))
+
+
+def _get_max_size(length_codec, max_length, value_size):
+    """
+    Calculate the largest encoded size of a length prefixed value.
+
+    :param length_codec: The codec for the length prefix.
+    :param int max_length: The maximum length, or None if it is unbounded.
+    :param int value_size: The largest encoded size of each item, or None if
+        it is unbounded.
+    :returns: int, or None if the size is unbounded.
+    """
+    if max_length is None or (value_size is None and max_length):
+        return None
+    return length_codec.size_of(max_length) + max_length * (value_size or 0)
+
+
+def _check_buffer_size(view, size):
+    """
+    Make sure a buffer is large enough to read size bytes from it.
+
+    :param memoryview view: The buffer to check.
+    :param int size: The number of bytes required.
+    :raises TruncatedError: If the buffer is too small.
+    """
+    if view.nbytes < size:
+        raise TruncatedError('unpack_from requires a buffer of at least {} '
+                             'bytes'.format(size), size)
+
+
 class Codec(object):
 
     """
@@ -120,12 +376,19 @@ class Codec(object):
         should not include any endian prefixes.
     """
 
+    #: Subclasses that need to convert values before packing them, or after
+    #: unpacking them, should set this to True and override encode_value and
+    #: decode_value. Definitions use these to apply the conversions when they
+    #: pack several fields with a single struct.
+    converts = False
+
     def __init__(self, format):
         super(Codec, self).__init__()
         self.format = format
         self.big_struct = struct.Struct('>{}'.format(self.format))
         self.little_struct = struct.Struct('<{}'.format(self.format))
         self.size = struct.calcsize(self.format)
+        self.max_size = self.size
 
     def _get_struct(self, little_endian):
         """
@@ -151,6 +414,36 @@ class Codec(object):
         """
         return self._get_struct(little_endian).pack(value)
 
+    def size_of(self, value):
+        """
+        Return the encoded size of a value, which is always the size of the
+        format.
+
+        :param value: Value of the type specified in the format string.
+        :returns: int
+        """
+        return self.size
+
+    def dumps_into(self, buffer, offset, value, little_endian=False):
+        """
+        Dump the value into a writable buffer, such as a bytearray.
+
+        :param buffer: The buffer to write to.
+        :param int offset: Offset within the buffer to write to.
+        :param value: Value of the type specified in the format string.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: int offset just past the end of the written value.
+        :raises BufferFullError: If the buffer is too small.
+        """
+        if self.converts:
+            value = self.encode_value(value)
+        value_struct = self._get_struct(little_endian)
+        end = offset + value_struct.size
+        _check_buffer_space(buffer, end)
+        value_struct.pack_into(buffer, offset, value)
+        return end
+
     def loads(self, string, offset=0, little_endian=False):
         """
         Load the value from a string.
@@ -162,238 +455,2371 @@ class Codec(object):
             endian format.
         :returns:
         """
-        return self._get_struct(little_endian).unpack_from(string, offset)[0]
+        value_struct = self._get_struct(little_endian)
+        try:
+            return value_struct.unpack_from(string, offset)[0]
+        except struct.error:
+            _check_truncated(string, offset + value_struct.size)
+            raise
+
+    def loads_from(self, string, offset=0, little_endian=False):
+        """
+        Load the value from a string, along with the offset just past it.
+
+        :param str string: A string encoded by this codec. This should be a str
+            object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: tuple(value, int)
+        """
+        value_struct = self._get_struct(little_endian)
+        try:
+            value = value_struct.unpack_from(string, offset)[0]
+        except struct.error:
+            _check_truncated(string, offset + value_struct.size)
+            raise
+        return value, offset + value_struct.size
+
+    def encode_value(self, value):
+        """
+        Convert a value into the form that is packed by the struct.
+
+        :param value: The value to convert.
+        :returns: The converted value.
+        """
+        return value
 
+    def decode_value(self, value):
+        """
+        Convert a value unpacked by the struct back into its original form.
 
-class ArrayCodec(object):
+        :param value: The value to convert.
+        :returns: The converted value.
+        """
+        return value
+
+
+class QuantizedCodec(Codec):
 
     """
-    An array codec is a special case. It starts with a uint32 length value,
-    followed by that many items in the passed value_format.
+    Encodes floating point numbers within a known range as unsigned integers.
+    The range is divided into evenly spaced steps, and values are rounded to
+    the nearest step. Decoded values will only approximately equal the
+    originals, but they take up less space than a float32 or float64.
+
+    :param float min: The smallest value that can be encoded.
+    :param float max: The largest value that can be encoded.
+    :param int bits: The size of the encoded integer, in bits. This can be 8,
+        16 or 32.
+    """
+
+    converts = True
+
+    #: Mapping of supported bit sizes to struct formats.
+    formats = {8: 'B', 16: 'H', 32: 'I'}
+
+    def __init__(self, min, max, bits=16):
+        if bits not in self.formats:
+            raise ValueError('invalid quantized bits %r' % (bits,))
+        if not min < max:
+            raise ValueError('quantized min must be less than max')
+        super(QuantizedCodec, self).__init__(self.formats[bits])
+        self.min = min
+        self.max = max
+        self.bits = bits
+        self.step_size = (max - min) / float((1 << bits) - 1)
+
+    def encode_value(self, value):
+        if not self.min <= value <= self.max:
+            raise struct.error('quantized value requires {} <= number <= '
+                               '{}'.format(self.min, self.max))
+        return int(round((value - self.min) / self.step_size))
+
+    def decode_value(self, value):
+        return self.min + value * self.step_size
+
+    def dumps(self, value, little_endian=False):
+        return super(QuantizedCodec, self).dumps(self.encode_value(value),
+                                                 little_endian)
+
+    def loads(self, string, offset=0, little_endian=False):
+        return self.loads_from(string, offset, little_endian)[0]
+
+    def loads_from(self, string, offset=0, little_endian=False):
+        value, offset = super(QuantizedCodec, self).loads_from(
+            string, offset, little_endian)
+        return self.decode_value(value), offset
+
+
+class BitsCodec(Codec):
 
-    :param str value_format: Format string for the list items.
     """
+    Encodes unsigned integers that are smaller than a byte. When several of
+    these fields are next to each other in a definition, they are packed
+    together into shared bytes. See :class:`BitGroup`. When encoded on its own,
+    each value takes up a full byte.
 
-    def __init__(self, value_format):
-        super(ArrayCodec, self).__init__()
-        self.value_format = value_format
-        self.big_format_template = '>{{length}}{}'.format(self.value_format)
-        self.little_format_template = '<{{length}}{}'.format(self.value_format)
+    :param int bits: The size of the values, in bits, from 1 to 7.
+    """
+
+    converts = True
+
+    def __init__(self, bits):
+        if not 1 <= bits <= 7:
+            raise ValueError('invalid bits %r' % (bits,))
+        super(BitsCodec, self).__init__('B')
+        self.bits = bits
+        self.max_value = (1 << bits) - 1
+
+    def encode_value(self, value):
+        if not 0 <= value <= self.max_value:
+            raise struct.error('uint{} requires 0 <= number <= {}'.format(
+                self.bits, self.max_value))
+        return value
+
+    def dumps(self, value, little_endian=False):
+        return super(BitsCodec, self).dumps(self.encode_value(value),
+                                            little_endian)
+
+
+class BitGroup(object):
+
+    """
+    A bit group packs a run of consecutive bit fields into as few bytes as
+    possible. The first field is stored in the most significant bits of the
+    first byte, and any unused bits at the end of the last byte are zero.
+
+    The packed bytes are a single item of the struct for the definition, with
+    an "s" format, so they are written in the same order regardless of
+    endianness.
+
+    :param list codecs: A BitsCodec for each uintN field in the group, or the
+        boolean codec for each boolean field in the group.
+    """
 
-    def _get_format(self, length, little_endian):
+    def __init__(self, codecs):
+        super(BitGroup, self).__init__()
+        self.codecs = codecs
+        self.widths = tuple(getattr(codec, 'bits', 1) for codec in codecs)
+        self.booleans = tuple(not isinstance(codec, BitsCodec)
+                              for codec in codecs)
+        bits = sum(self.widths)
+        self.size = (bits + 7) // 8
+        self.padding = self.size * 8 - bits
+        self.format = '{}s'.format(self.size)
+
+    def encode_values(self, values):
         """
-        Get the appropriate format for the given length and endianness.
+        Pack the values of the fields in the group into bytes.
 
-        :param int length: The number of items in the list.
-        :param bool little_endian: If True, values will be encoded in little
-            endian format.
-        :returns: str
+        :param list values: The value of each field in the group.
+        :returns: bytes
         """
-        if little_endian:
-            return self.little_format_template.format(length=length)
-        else:
-            return self.big_format_template.format(length=length)
+        packed = 0
+        for codec, width, boolean, value in zip(self.codecs, self.widths,
+                                                self.booleans, values):
+            if boolean:
+                value = 1 if value else 0
+            else:
+                value = codec.encode_value(value)
+            packed = (packed << width) | value
+        return (packed << self.padding).to_bytes(self.size, 'big')
+
+    def decode_values(self, string):
+        """
+        Unpack the values of the fields in the group from bytes.
 
-    def dumps(self, values, little_endian=False):
+        :param bytes string: The bytes encoded by encode_values.
+        :returns: list of the values of the fields in the group.
         """
-        Dump a list of values to a string.
+        packed = int.from_bytes(string, 'big') >> self.padding
+        values = []
+        for width, boolean in zip(reversed(self.widths),
+                                  reversed(self.booleans)):
+            value = packed & ((1 << width) - 1)
+            packed >>= width
+            values.append(bool(value) if boolean else value)
+        values.reverse()
+        return values
 
-        :param list values: List of values to encode. Each value must be of a
-            type compatible with the value_format specified when the ArrayCodec
-            was constructed.
-        :param bool little_endian: If True, values will be encoded in little
-            endian format.
-        :returns: str
+    def encode_items(self, values):
         """
-        length = len(values)
-        length_struct = _get_length_struct(little_endian)
-        string = length_struct.pack(length)
-        string += struct.pack(self._get_format(length, little_endian), *values)
-        return string
+        Pack the values of the fields in the group into struct items.
 
-    def loads(self, string, offset=0, little_endian=False):
+        :param list values: The value of each field in the group.
+        :returns: list containing the packed bytes.
         """
-        Load a list of values from a string.
+        return [self.encode_values(values)]
 
-        :param str string: A string encoded by this codec. This should be a str
-            object on Python 2, and a bytes object on Python 3.
-        :param int offset: Start decoding from this offset within the string.
-        :param bool little_endian: If True, values will be decoded in little
-            endian format.
-        :returns: tuple
+    def decode_items(self, items):
         """
-        length_struct = _get_length_struct(little_endian)
-        length = length_struct.unpack_from(string, offset)[0]
-        if length:
-            format = self._get_format(length, little_endian)
-            self.size = struct.calcsize(format) + length_struct.size
-            return struct.unpack_from(format, string,
-                                      offset + length_struct.size)
-        else:
-            self.size = length_struct.size
-            return ()
+        Unpack the values of the fields in the group from struct items.
 
+        :param items: Sequence containing the packed bytes.
+        :returns: list of the values of the fields in the group.
+        """
+        return self.decode_values(items[0])
 
-class StringCodec(object):
+
+class VarintCodec(object):
 
     """
-    The string codec is another special case. The codec first converts the
-    unicode string to UTF-8, then packs that. The packed value is prefixed
-    with the length of the UTF-8 string, like the ArrayCodec.
+    Encodes integers in a variable number of bytes, so that small values take
+    up less space. Each byte stores seven bits of the value, starting with the
+    least significant bits, and the high bit of the byte is set if more bytes
+    follow. This is the same as the varint encoding used by Protocol Buffers.
+
+    Signed values are zigzag encoded first, so that small negative numbers
+    are also encoded in a small number of bytes.
+
+    Varints have no endianness, so the little_endian arguments are ignored.
+
+    :param bool signed: If True, the codec encodes signed 64-bit integers.
+        Otherwise, it encodes unsigned 64-bit integers.
     """
 
-    def __init__(self):
-        super(StringCodec, self).__init__()
-        self.big_format_template = '>{length}s'
-        self.little_format_template = '<{length}s'
+    def __init__(self, signed=False):
+        super(VarintCodec, self).__init__()
+        self.signed = signed
+        if signed:
+            self.min_value = -(1 << 63)
+            self.max_value = (1 << 63) - 1
+        else:
+            self.min_value = 0
+            self.max_value = (1 << 64) - 1
+        self.max_size = 10
 
-    def _get_format(self, length, little_endian):
+    def dumps(self, value, little_endian=False):
         """
-        Get the appropriate format for the given length and endianness.
+        Dump the value to a string.
 
-        :param int length: The number of items in the list.
-        :param bool little_endian: If True, values will be encoded in little
-            endian format.
+        :param int value: The integer to encode.
+        :param bool little_endian: Ignored.
         :returns: str
         """
-        if little_endian:
-            return self.little_format_template.format(length=length)
-        else:
-            return self.big_format_template.format(length=length)
+        if not self.min_value <= value <= self.max_value:
+            raise struct.error('varint requires {} <= number <= {}'.format(
+                self.min_value, self.max_value))
+        if self.signed:
+            value = (value << 1) ^ (value >> 63)
+        if value < 0x80:
+            return six.int2byte(value)
+        string = bytearray()
+        while value >= 0x80:
+            string.append((value & 0x7f) | 0x80)
+            value >>= 7
+        string.append(value)
+        return bytes(string)
+
+    def size_of(self, value):
+        """
+        Return the number of bytes used to encode a value, without encoding
+        it.
 
-    def dumps(self, value, little_endian=False):
+        :param int value: The integer to encode.
+        :returns: int
         """
-        :param unicode value: A unicode string to encode.
-        :param bool little_endian: If True, values will be encoded in little
-            endian format.
-        :returns str:
+        if self.signed:
+            value = (value << 1) ^ (value >> 63)
+        return (value.bit_length() + 6) // 7 or 1
+
+    def dumps_into(self, buffer, offset, value, little_endian=False):
         """
-        # FIXME: raise a better error message here
-        assert isinstance(value, six.text_type)
-        value = value.encode('utf-8')
-        length = len(value)
-        length_struct = _get_length_struct(little_endian)
-        format = self._get_format(length, little_endian)
-        return (length_struct.pack(length) + struct.pack(format, value))
+        Dump the value into a writable buffer, such as a bytearray.
+
+        :param buffer: The buffer to write to.
+        :param int offset: Offset within the buffer to write to.
+        :param int value: The integer to encode.
+        :param bool little_endian: Ignored.
+        :returns: int offset just past the end of the written value.
+        :raises BufferFullError: If the buffer is too small.
+        """
+        return _write_bytes(buffer, offset, self.dumps(value))
 
     def loads(self, string, offset=0, little_endian=False):
         """
+        Load the value from a string.
+
         :param str string: A string encoded by this codec. This should be a str
             object on Python 2, and a bytes object on Python 3.
         :param int offset: Start decoding from this offset within the string.
-        :param bool little_endian: If True, values will be decoded in little
-            endian format.
-        :returns: unicode
+        :param bool little_endian: Ignored.
+        :returns: int
         """
-        length_struct = _get_length_struct(little_endian)
-        length = length_struct.unpack_from(string, offset)[0]
-        if length:
-            format = self._get_format(length, little_endian)
-            self.size = struct.calcsize(format) + length_struct.size
-            value = struct.unpack_from(format, string,
-                                       offset + length_struct.size)[0]
-            return value.decode('utf-8')
-        else:
-            self.size = length_struct.size
-            return u''
+        return self.loads_from(string, offset, little_endian)[0]
 
+    def loads_from(self, string, offset=0, little_endian=False):
+        """
+        Load the value from a string, along with the offset just past it.
 
-#: Mapping of types to the codecs objects for those types. Note that the
-#: "array" type is not present in this list because its value_type field means
-#: it must be constructed on the fly.
-_codecs = {
-    'boolean': Codec('?'),
-    'float32': Codec('f'),
-    'float64': Codec('d'),
-    'int8': Codec('b'),
-    'int16': Codec('h'),
-    'int32': Codec('i'),
-    'string': StringCodec(),
-    'uint8': Codec('B'),
-    'uint16': Codec('H'),
-    'uint32': Codec('I')
+        :param str string: A string encoded by this codec. This should be a str
+            object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: Ignored.
+        :returns: tuple(int, int)
+        """
+        value = 0
+        shift = 0
+        while True:
+            try:
+                byte = six.indexbytes(string, offset)
+            except IndexError:
+                raise TruncatedError('unpack_from requires a buffer of at '
+                                     'least {} bytes'.format(offset + 1),
+                                     offset + 1)
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+            if shift >= 64:
+                raise struct.error('varint is longer than 10 bytes')
+        if self.signed:
+            value = (value >> 1) ^ -(value & 1)
+        return value, offset
+
+
+#: Codecs for the length prefixes of arrays and strings. Lengths are normally
+#: encoded as uint32 values, but can optionally be encoded as varints.
+_length_codecs = {
+    'uint32': Codec('I'),
+    'varint': VarintCodec(),
 }
 
 
-class Field(object):
+def _get_length_codec(length_type):
+    """
+    Return the codec for a length type.
 
+    :param str length_type: Either "uint32" or "varint".
+    :returns: Codec or VarintCodec
+    :raises ValueError: If the length type is not supported.
     """
-    Fields represent a single property in an object. These fields are grouped
-    into definition objects. Each field represents a single key from the type
-    of dict that will be encoded by the definition.
+    try:
+        return _length_codecs[length_type or 'uint32']
+    except KeyError:
+        raise ValueError('invalid length type %r' % (length_type,))
+
+
+#: True if the native byte order of this machine is little endian.
+_native_little_endian = sys.byteorder == 'little'
+
+#: Mapping of struct formats to the array module typecodes that might have the
+#: same size. The sizes of some typecodes vary by platform, so the first
+#: matching one is chosen by _get_array_typecode.
+_array_typecodes = {
+    'b': 'b',
+    'B': 'B',
+    'h': 'h',
+    'H': 'H',
+    'i': 'il',
+    'I': 'IL',
+    'f': 'f',
+    'd': 'd',
+}
 
-    :param str key: Key in the dictionary to encode.
-    :param str type: Type of the value in the dictionary. This should be one
-        of the supported codec types (e.g. "int32").
-    :param str value_type: If type is "array", this should specify the type of
-        the values within the array.
+
+def _get_array_typecode(format):
     """
+    Return the array module typecode matching a struct format.
 
-    def __init__(self, key, type, value_type=None):
-        super(Field, self).__init__()
-        self.key = key
-        self.type = type
-        self.value_type = value_type
-        if not self.key:
-            raise ValueError('key is required')
-        if self.type == 'array':
-            if (self.value_type in ('array', 'string') or
-                    self.value_type not in _codecs):
-                raise ValueError('invalid array value type %r' %
-                                 (self.value_type,))
-            self.codec = ArrayCodec(_codecs[self.value_type].format)
-        elif self.type in _codecs:
-            self.codec = _codecs[self.type]
-        else:
-            raise ValueError('invalid type %r' % (self.type,))
+    :param str format: A struct format for a single value, without any endian
+        prefix.
+    :returns: str, or None if the array module has no matching typecode.
+    """
+    size = struct.calcsize(format)
+    for typecode in _array_typecodes.get(format, ''):
+        if array.array(typecode).itemsize == size:
+            return typecode
+    return None
 
 
-class Definition(object):
+class ArrayCodec(object):
 
     """
-    Definitions are a grouping of fields, and are used to encode or decode an
-    individual message. They can be grouped into schemas or used standalone.
+    An array codec is a special case. It starts with a uint32 length value,
+    followed by that many items in the passed value_format. The length can
+    optionally be encoded as a varint instead.
 
-    :param list(Field) fields: The fields contained in this definition.
-    :param int id: An optional integer id for this definition. Use to identify
-        it in packets encoded by a schema.
-    :param str key: An optional human readable name for this definition. Used
-        to identify it within a schema.
-    :param bool little_endian: If True, values will be encoded and decoded in
-        little endian format for this definition.
+    Values can be encoded from any sequence. Arrays from the array module with
+    a matching typecode, and NumPy arrays, are encoded with a single buffer
+    copy instead of packing each value individually. Decoded values are
+    returned as a tuple by default, but array_type can be used to decode them
+    into an array module or NumPy array instead.
+
+    :param str value_format: Format string for the list items.
+    :param str array_type: Type of the decoded values. This can be "tuple"
+        (the default), "array" for an array.array, or "numpy" for a
+        numpy.ndarray.
+    :param str length_type: Type of the length prefix. This can be "uint32"
+        (the default) or "varint".
+    :param int max_length: The maximum number of values in the array, or
+        None if it is unbounded. Encoding a longer array raises struct.error.
     """
 
-    def __init__(self, fields, id=None, key=None, little_endian=False):
-        super(Definition, self).__init__()
-        self.fields = fields
-        self.id = id
-        self.key = key
-        self.little_endian = little_endian
+    array_types = ('tuple', 'array', 'numpy')
+
+    def __init__(self, value_format, array_type=None, length_type=None,
+                 max_length=None):
+        super(ArrayCodec, self).__init__()
+        self.length_codec = _get_length_codec(length_type)
+        self.value_format = value_format
+        self.value_size = struct.calcsize(value_format)
+        self.max_length = max_length
+        self.max_size = _get_max_size(self.length_codec, max_length,
+                                      self.value_size)
+        self.array_type = array_type or 'tuple'
+        self.typecode = _get_array_typecode(value_format)
+        if numpy is not None:
+            self.big_dtype = numpy.dtype('>{}'.format(value_format))
+            self.little_dtype = numpy.dtype('<{}'.format(value_format))
+        else:
+            self.big_dtype = None
+            self.little_dtype = None
+        if self.array_type not in self.array_types:
+            raise ValueError('invalid array type %r' % (array_type,))
+        elif self.array_type == 'array' and self.typecode is None:
+            raise ValueError('value format %r is not supported by the array '
+                             'module' % (value_format,))
+        elif self.array_type == 'numpy' and numpy is None:
+            raise ValueError('numpy is required for array type "numpy"')
+
+    def _get_dtype(self, little_endian):
+        """
+        Get the NumPy dtype for the given endianness.
+
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: numpy.dtype
+        """
+        if little_endian:
+            return self.little_dtype
+        else:
+            return self.big_dtype
+
+    def _dumps_buffer(self, values, little_endian):
+        """
+        Dump the contents of an array.array or numpy.ndarray as a string,
+        byteswapping it if needed. Arrays of any other type or shape are not
+        cast, as casting would silently wrap or truncate values that are out
+        of range for the value format.
+
+        :param values: An array of values.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: str, or None if the values must be packed individually.
+        """
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            dtype = self._get_dtype(little_endian)
+            if (values.ndim != 1 or values.dtype.kind != dtype.kind or
+                    values.dtype.itemsize != dtype.itemsize):
+                return None
+            return values.astype(dtype, copy=False).tobytes()
+        elif (isinstance(values, array.array) and
+                values.typecode == self.typecode):
+            if little_endian != _native_little_endian:
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            return values.tobytes()
+        return None
+
+    def _loads_buffer(self, string, offset, length, little_endian):
+        """
+        Load length values into an array.array or numpy.ndarray, depending on
+        the array type of the codec.
+
+        :param str string: A string encoded by this codec.
+        :param int offset: Offset of the first value within the string.
+        :param int length: The number of values to load.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: array.array or numpy.ndarray
+        """
+        end = offset + length * self.value_size
+        with memoryview(string) as view:
+            _check_buffer_size(view, end)
+            if self.array_type == 'numpy':
+                dtype = self._get_dtype(little_endian)
+                values = numpy.frombuffer(view, dtype, length, offset)
+                return values.astype(dtype.newbyteorder('='))
+            values = array.array(self.typecode)
+            values.frombytes(view[offset:end])
+        if little_endian != _native_little_endian:
+            values.byteswap()
+        return values
+
+    def _get_struct(self, length, little_endian):
+        """
+        Get the struct for the given length and endianness.
+
+        :param int length: The number of items in the list.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: struct.Struct
+        """
+        return _get_array_struct(self.value_format, length, little_endian)
+
+    def dumps(self, values, little_endian=False):
+        """
+        Dump a list of values to a string.
+
+        :param list values: List of values to encode. Each value must be of a
+            type compatible with the value_format specified when the ArrayCodec
+            was constructed. This can also be an array.array or a
+            numpy.ndarray.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: str
+        """
+        length_codec = self.length_codec
+        string = self._dumps_buffer(values, little_endian)
+        if string is not None:
+            length = len(string) // self.value_size
+            _check_length(length, self.max_length)
+            return length_codec.dumps(length, little_endian) + string
+        length = len(values)
+        _check_length(length, self.max_length)
+        values_struct = self._get_struct(length, little_endian)
+        return (length_codec.dumps(length, little_endian) +
+                values_struct.pack(*values))
+
+    def dumps_into(self, buffer, offset, values, little_endian=False):
+        """
+        Dump a list of values into a writable buffer, such as a bytearray.
+
+        :param buffer: The buffer to write to.
+        :param int offset: Offset within the buffer to write to.
+        :param list values: List of values to encode.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: int offset just past the end of the written values.
+        :raises BufferFullError: If the buffer is too small.
+        """
+        length_codec = self.length_codec
+        string = self._dumps_buffer(values, little_endian)
+        if string is not None:
+            length = len(string) // self.value_size
+            _check_length(length, self.max_length)
+            offset = length_codec.dumps_into(buffer, offset, length,
+                                             little_endian)
+            return _write_bytes(buffer, offset, string)
+        length = len(values)
+        _check_length(length, self.max_length)
+        offset = length_codec.dumps_into(buffer, offset, length, little_endian)
+        values_struct = self._get_struct(length, little_endian)
+        end = offset + values_struct.size
+        _check_buffer_space(buffer, end)
+        values_struct.pack_into(buffer, offset, *values)
+        return end
+
+    def size_of(self, values):
+        """
+        Return the encoded size of a list of values, without encoding it.
+
+        :param list values: List of values to encode.
+        :returns: int
+        """
+        length = len(values)
+        return self.length_codec.size_of(length) + length * self.value_size
+
+    def loads(self, string, offset=0, little_endian=False):
+        """
+        Load a list of values from a string.
+
+        :param str string: A string encoded by this codec. This should be a str
+            object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: tuple
+        """
+        return self.loads_from(string, offset, little_endian)[0]
+
+    def loads_from(self, string, offset=0, little_endian=False):
+        """
+        Load a list of values from a string, along with the offset just past
+        the end of the encoded list.
+
+        :param str string: A string encoded by this codec. This should be a str
+            object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: tuple(tuple, int)
+        """
+        length, offset = self.length_codec.loads_from(string, offset,
+                                                      little_endian)
+        _check_length(length, self.max_length)
+        if self.array_type != 'tuple':
+            values = self._loads_buffer(string, offset, length, little_endian)
+            return values, offset + len(values) * values.itemsize
+        elif length:
+            values_struct = self._get_struct(length, little_endian)
+            try:
+                values = values_struct.unpack_from(string, offset)
+            except struct.error:
+                _check_truncated(string, offset + values_struct.size)
+                raise
+            return values, offset + values_struct.size
+        else:
+            return (), offset
+
+    def skip_from(self, string, offset=0, little_endian=False):
+        """
+        Find the end of an encoded array without decoding its values.
+
+        :param str string: A string encoded by this codec.
+        :param int offset: Offset of the array within the string.
+        :param bool little_endian: If True, the length will be decoded in
+            little endian format.
+        :returns: int offset just past the end of the encoded array.
+        """
+        length, offset = self.length_codec.loads_from(string, offset,
+                                                      little_endian)
+        _check_length(length, self.max_length)
+        end = offset + length * self.value_size
+        _check_truncated(string, end)
+        return end
+
+
+#: str.isascii is only available on Python 3.7 and later. It's much cheaper
+#: than encoding a string just to measure it.
+_isascii = getattr(six.text_type, 'isascii', None)
+
+
+class StringCodec(object):
+
+    """
+    The string codec is another special case. The codec first converts the
+    unicode string to UTF-8, then packs that. The packed value is prefixed
+    with the length of the UTF-8 string, like the ArrayCodec.
+
+    The UTF-8 bytes don't need any conversion, so they are copied directly
+    after the length without going through a struct format.
+
+    :param str length_type: Type of the length prefix. This can be "uint32"
+        (the default) or "varint".
+    :param int max_length: The maximum length of the UTF-8 string in bytes,
+        or None if it is unbounded. Encoding a longer string raises
+        struct.error.
+    """
+
+    def __init__(self, length_type=None, max_length=None):
+        super(StringCodec, self).__init__()
+        self.length_codec = _get_length_codec(length_type)
+        self.max_length = max_length
+        self.max_size = _get_max_size(self.length_codec, max_length, 1)
+
+    def dumps(self, value, little_endian=False):
+        """
+        :param unicode value: A unicode string to encode.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns str:
+        """
+        # FIXME: raise a better error message here
+        assert isinstance(value, six.text_type)
+        value = value.encode('utf-8')
+        _check_length(len(value), self.max_length)
+        return self.length_codec.dumps(len(value), little_endian) + value
+
+    def size_of(self, value):
+        """
+        Return the encoded size of a string. This has to measure the UTF-8
+        length of the string, but doesn't allocate the length prefix, and
+        ASCII strings are measured without being encoded.
+
+        :param unicode value: A unicode string to encode.
+        :returns: int
+        """
+        if _isascii is not None and _isascii(value):
+            length = len(value)
+        else:
+            length = len(value.encode('utf-8'))
+        return self.length_codec.size_of(length) + length
+
+    def dumps_into(self, buffer, offset, value, little_endian=False):
+        """
+        Dump a string into a writable buffer, such as a bytearray.
+
+        :param buffer: The buffer to write to.
+        :param int offset: Offset within the buffer to write to.
+        :param unicode value: A unicode string to encode.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: int offset just past the end of the written string.
+        :raises BufferFullError: If the buffer is too small.
+        """
+        assert isinstance(value, six.text_type)
+        value = value.encode('utf-8')
+        _check_length(len(value), self.max_length)
+        offset = self.length_codec.dumps_into(buffer, offset, len(value),
+                                              little_endian)
+        return _write_bytes(buffer, offset, value)
+
+    def loads(self, string, offset=0, little_endian=False):
+        """
+        :param str string: A string encoded by this codec. This should be a str
+            object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: unicode
+        """
+        return self.loads_from(string, offset, little_endian)[0]
+
+    def loads_from(self, string, offset=0, little_endian=False):
+        """
+        Load a string, along with the offset just past the end of the encoded
+        string.
+
+        :param str string: A string encoded by this codec. This should be a str
+            object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: tuple(unicode, int)
+        """
+        length, offset = self.length_codec.loads_from(string, offset,
+                                                      little_endian)
+        _check_length(length, self.max_length)
+        if length:
+            end = offset + length
+            value = string[offset:end]
+            if len(value) < length:
+                raise TruncatedError('unpack_from requires a buffer of at '
+                                     'least {} bytes'.format(end), end)
+            return six.text_type(value, 'utf-8'), end
+        else:
+            return u'', offset
+
+    def skip_from(self, string, offset=0, little_endian=False):
+        """
+        Find the end of an encoded string without decoding it.
+
+        :param str string: A string encoded by this codec.
+        :param int offset: Offset of the string within the string.
+        :param bool little_endian: If True, the length will be decoded in
+            little endian format.
+        :returns: int offset just past the end of the encoded string.
+        """
+        length, offset = self.length_codec.loads_from(string, offset,
+                                                      little_endian)
+        _check_length(length, self.max_length)
+        end = offset + length
+        _check_truncated(string, end)
+        return end
+
+
+class StructCodec(object):
+
+    """
+    Encodes the fields of another definition as a single nested value. The
+    nested fields are encoded exactly as the nested definition would encode
+    them, but using the endianness of the outer definition.
+
+    If the nested definition only contains fixed size fields, the codec is
+    fixed size too, and its fields are flattened into the struct of the
+    outer definition, so nesting doesn't cost any extra struct calls.
+
+    :param Definition definition: The nested definition.
+    """
+
+    def __init__(self, definition):
+        super(StructCodec, self).__init__()
+        self.definition = definition
+        run = definition._runs[0] if len(definition._runs) == 1 else None
+        self.fixed = definition.big_struct is not None
+        if self.fixed:
+            self.format = run.format
+            self.size = run.size
+            self.item_count = run.item_count
+        else:
+            self.format = None
+            self.size = None
+            self.item_count = None
+        self.max_size = definition.max_size
+
+    def encode_items(self, values):
+        """
+        Convert a nested value into the items packed by the outer struct.
+        This is only valid for fixed size codecs.
+
+        :param list values: A list containing the nested data dict or record.
+        :returns: list
+        """
+        return self.definition._get_struct_values(values[0])
+
+    def decode_items(self, items):
+        """
+        Convert items unpacked by the outer struct into a nested value. This
+        is only valid for fixed size codecs.
+
+        :param items: The items for the nested definition.
+        :returns: list containing the nested dict or record.
+        """
+        return [self.definition._make_struct_value(items)]
+
+    def dumps(self, value, little_endian=False):
+        """
+        :param value: A data dict or record for the nested definition.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: str
+        """
+        definition = self.definition
+        return definition._dumps_values(definition._get_values(value),
+                                        little_endian)
+
+    def size_of(self, value):
+        """
+        :param value: A data dict or record for the nested definition.
+        :returns: int
+        """
+        if self.fixed:
+            return self.size
+        definition = self.definition
+        return definition._size_of_values(definition._get_values(value))
+
+    def dumps_into(self, buffer, offset, value, little_endian=False):
+        """
+        :param buffer: The writable buffer to write to.
+        :param int offset: Offset within the buffer to write to.
+        :param value: A data dict or record for the nested definition.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: int offset just past the end of the written value.
+        :raises BufferFullError: If the buffer is too small.
+        """
+        definition = self.definition
+        return definition._dumps_values_into(
+            buffer, offset, definition._get_values(value), little_endian)
+
+    def loads(self, string, offset=0, little_endian=False):
+        """
+        :param str string: A string encoded by this codec.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: dict, or a record.
+        """
+        return self.loads_from(string, offset, little_endian)[0]
+
+    def loads_from(self, string, offset=0, little_endian=False):
+        """
+        :param str string: A string encoded by this codec.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: tuple(dict, int), or a tuple of a record and the offset.
+        """
+        definition = self.definition
+        values, offset = definition._loads_values(string, offset,
+                                                  little_endian)
+        return definition._make_value(values), offset
+
+
+class ListCodec(object):
+
+    """
+    Encodes a variable length list of values that ArrayCodec can't encode,
+    such as strings or nested definitions. Like ArrayCodec, it starts with
+    the length of the list, followed by each value in the list.
+
+    If the value codec is a fixed size StructCodec, the whole list is packed
+    with a single struct. Otherwise, each value is encoded by the value codec
+    in turn.
+
+    :param value_codec: The codec for the values in the list.
+    :param str length_type: Type of the length prefix. This can be "uint32"
+        (the default) or "varint".
+    :param int max_length: The maximum number of values in the list, or None
+        if it is unbounded. Encoding a longer list raises struct.error.
+    """
+
+    def __init__(self, value_codec, length_type=None, max_length=None):
+        super(ListCodec, self).__init__()
+        self.value_codec = value_codec
+        self.length_codec = _get_length_codec(length_type)
+        self.fixed_values = getattr(value_codec, 'fixed', False)
+        self.max_length = max_length
+        self.max_size = _get_max_size(self.length_codec, max_length,
+                                      value_codec.max_size)
+
+    def dumps(self, values, little_endian=False):
+        """
+        :param list values: List of values to encode.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: str
+        """
+        length = len(values)
+        _check_length(length, self.max_length)
+        string = self.length_codec.dumps(length, little_endian)
+        value_codec = self.value_codec
+        if self.fixed_values:
+            items = []
+            for value in values:
+                items.extend(value_codec.encode_items([value]))
+            values_struct = _get_repeated_struct(value_codec.format, length,
+                                                 little_endian)
+            return string + values_struct.pack(*items)
+        return string + b''.join([value_codec.dumps(value, little_endian)
+                                  for value in values])
+
+    def dumps_into(self, buffer, offset, values, little_endian=False):
+        """
+        :param buffer: The writable buffer to write to.
+        :param int offset: Offset within the buffer to write to.
+        :param list values: List of values to encode.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: int offset just past the end of the written values.
+        :raises BufferFullError: If the buffer is too small.
+        """
+        length = len(values)
+        _check_length(length, self.max_length)
+        offset = self.length_codec.dumps_into(buffer, offset, length,
+                                              little_endian)
+        value_codec = self.value_codec
+        if self.fixed_values:
+            items = []
+            for value in values:
+                items.extend(value_codec.encode_items([value]))
+            values_struct = _get_repeated_struct(value_codec.format, length,
+                                                 little_endian)
+            end = offset + values_struct.size
+            _check_buffer_space(buffer, end)
+            values_struct.pack_into(buffer, offset, *items)
+            return end
+        for value in values:
+            offset = value_codec.dumps_into(buffer, offset, value,
+                                            little_endian)
+        return offset
+
+    def size_of(self, values):
+        """
+        :param list values: List of values to encode.
+        :returns: int
+        """
+        value_codec = self.value_codec
+        size = self.length_codec.size_of(len(values))
+        if self.fixed_values:
+            return size + len(values) * value_codec.size
+        return size + sum([value_codec.size_of(value) for value in values])
+
+    def loads(self, string, offset=0, little_endian=False):
+        """
+        :param str string: A string encoded by this codec.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: tuple
+        """
+        return self.loads_from(string, offset, little_endian)[0]
+
+    def loads_from(self, string, offset=0, little_endian=False):
+        """
+        :param str string: A string encoded by this codec.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: tuple(tuple, int)
+        """
+        length, offset = self.length_codec.loads_from(string, offset,
+                                                      little_endian)
+        _check_length(length, self.max_length)
+        value_codec = self.value_codec
+        if self.fixed_values:
+            # The length comes from the string, so the string is checked
+            # before a struct is compiled for that many values.
+            end = offset + length * value_codec.size
+            _check_truncated(string, end)
+            count = value_codec.item_count
+            if not count:
+                # Nested definitions without any fields have no items.
+                values = tuple(value_codec.decode_items(())[0]
+                               for _ in range(length))
+                return values, end
+            values_struct = _get_repeated_struct(value_codec.format, length,
+                                                 little_endian)
+            items = values_struct.unpack_from(string, offset)
+            values = tuple(value_codec.decode_items(items[i:i + count])[0]
+                           for i in range(0, len(items), count))
+            return values, end
+        values = []
+        for _ in range(length):
+            value, offset = value_codec.loads_from(string, offset,
+                                                   little_endian)
+            values.append(value)
+        return tuple(values), offset
+
+
+def _is_fixed_codec(codec):
+    """
+    Return True if the codec always encodes values with the same struct
+    format, so that it can be packed along with neighboring fields.
+
+    :returns: bool
+    """
+    return isinstance(codec, Codec) or getattr(codec, 'fixed', False)
+
+
+#: Mapping of types to the codecs objects for those types. Note that the
+#: "array" type is not present in this list because its value_type field means
+#: it must be constructed on the fly.
+_codecs = {
+    'boolean': Codec('?'),
+    'float32': Codec('f'),
+    'float64': Codec('d'),
+    'int8': Codec('b'),
+    'int16': Codec('h'),
+    'int32': Codec('i'),
+    'string': StringCodec(),
+    'svarint': VarintCodec(signed=True),
+    'uint1': BitsCodec(1),
+    'uint2': BitsCodec(2),
+    'uint3': BitsCodec(3),
+    'uint4': BitsCodec(4),
+    'uint5': BitsCodec(5),
+    'uint6': BitsCodec(6),
+    'uint7': BitsCodec(7),
+    'uint8': Codec('B'),
+    'uint16': Codec('H'),
+    'uint32': Codec('I'),
+    'varint': VarintCodec(),
+}
+
+
+class Field(object):
+
+    """
+    Fields represent a single property in an object. These fields are grouped
+    into definition objects. Each field represents a single key from the type
+    of dict that will be encoded by the definition.
+
+    :param str key: Key in the dictionary to encode.
+    :param str type: Type of the value in the dictionary. This should be one
+        of the supported codec types (e.g. "int32").
+    :param str value_type: If type is "array", this should specify the type of
+        the values within the array.
+    :param str array_type: If type is "array", this optionally specifies the
+        type that decoded arrays are returned as. See :class:`ArrayCodec`.
+    :param str length_type: If type is "array" or "string", this specifies
+        how the length is encoded. This can be "uint32" (the default) or
+        "varint". It is ignored for other types.
+    :param int max_length: If type is "array" or "string", the maximum
+        number of values in the array, or bytes in the UTF-8 string. This
+        bounds the max_size of the definition. Encoding a longer value raises
+        struct.error.
+    :param float min: If type is "quantized", the smallest value that can be
+        encoded.
+    :param float max: If type is "quantized", the largest value that can be
+        encoded.
+    :param int bits: If type is "quantized", the size of the encoded value in
+        bits. This can be 8, 16 (the default) or 32.
+    :param Definition definition: If type is "struct", or type is "array" and
+        value_type is "struct", this is the definition for the nested values.
+        Within a schema, this can also be the key of a definition that has
+        already been defined.
+    """
+
+    def __init__(self, key, type, value_type=None, array_type=None,
+                 length_type=None, min=None, max=None, bits=None,
+                 definition=None, max_length=None):
+        super(Field, self).__init__()
+        self.key = key
+        self.type = type
+        self.value_type = value_type
+        self.array_type = array_type
+        self.length_type = length_type
+        self.max_length = max_length
+        self.min = min
+        self.max = max
+        self.bits = bits
+        self.definition = definition
+        if not self.key:
+            raise ValueError('key is required')
+        if self.max_length is not None:
+            if self.type not in ('array', 'string'):
+                raise ValueError('max_length is only valid for array and '
+                                 'string fields')
+            if self.max_length < 0:
+                raise ValueError('invalid max length %r' % (self.max_length,))
+        if self.definition is not None:
+            if not (self.type == 'struct' or self.value_type == 'struct'):
+                raise ValueError('definition is only valid for struct fields')
+            if not isinstance(self.definition, Definition):
+                raise ValueError('invalid definition %r' % (self.definition,))
+        if self.type == 'struct' or self.value_type == 'struct':
+            if self.definition is None:
+                raise ValueError('definition is required for struct fields')
+            if self.type == 'struct':
+                self.codec = StructCodec(self.definition)
+            elif self.type == 'array' and self.array_type is None:
+                self.codec = ListCodec(StructCodec(self.definition),
+                                       self.length_type, self.max_length)
+            else:
+                raise ValueError('invalid struct field')
+        elif self.type == 'array' and self.value_type == 'string':
+            if self.array_type is not None:
+                raise ValueError('array_type is not valid for string arrays')
+            self.codec = ListCodec(StringCodec(self.length_type),
+                                   self.length_type, self.max_length)
+        elif self.type == 'quantized':
+            if self.min is None or self.max is None:
+                raise ValueError('min and max are required for quantized '
+                                 'fields')
+            self.codec = QuantizedCodec(self.min, self.max, self.bits or 16)
+        elif (self.min is not None or self.max is not None or
+                self.bits is not None):
+            raise ValueError('min, max and bits are only valid for quantized '
+                             'fields')
+        elif self.type == 'array':
+            # Arrays are packed with the struct format of the value type, so
+            # types that convert or range check their values, such as uintN,
+            # can't be used.
+            value_codec = _codecs.get(self.value_type)
+            if not isinstance(value_codec, Codec) or value_codec.converts:
+                raise ValueError('invalid array value type %r' %
+                                 (self.value_type,))
+            self.codec = ArrayCodec(_codecs[self.value_type].format,
+                                    self.array_type, self.length_type,
+                                    self.max_length)
+        elif self.array_type is not None:
+            raise ValueError('array_type is only valid for array fields')
+        elif self.type == 'string':
+            self.codec = StringCodec(self.length_type, self.max_length)
+        elif self.type in _codecs:
+            self.codec = _codecs[self.type]
+        else:
+            raise ValueError('invalid type %r' % (self.type,))
+
+    def __reduce__(self):
+        return (Field, (self.key, self.type, self.value_type, self.array_type,
+                        self.length_type, self.min, self.max, self.bits,
+                        self.definition, self.max_length))
+
+
+def _is_bit_field(field, pack_booleans):
+    """
+    Return True if the field can be packed into a bit group.
+
+    :param Field field:
+    :param bool pack_booleans: If True, boolean fields can be packed too.
+    :returns: bool
+    """
+    return (isinstance(field.codec, BitsCodec) or
+            (pack_booleans and field.type == 'boolean'))
+
+
+class _StructRun(object):
+
+    """
+    A run of consecutive fixed size fields in a definition, which are encoded
+    and decoded together using a single struct.
+
+    :param list(Field) fields: All of the fields in the definition.
+    :param int start: Index of the first field in the run.
+    :param int stop: Index just past the last field in the run.
+    :param bool pack_booleans: If True, boolean fields are packed into bit
+        groups along with any uintN fields.
+    """
+
+    def __init__(self, fields, start, stop, pack_booleans):
+        super(_StructRun, self).__init__()
+        self.start = start
+        self.stop = stop
+        formats = []
+        conversions = []
+        splices = []
+        item_count = 0
+        i = start
+        while i < stop:
+            field = fields[i]
+            if _is_bit_field(field, pack_booleans):
+                group_stop = i + 1
+                while (group_stop < stop and
+                       _is_bit_field(fields[group_stop], pack_booleans)):
+                    group_stop += 1
+                splice = BitGroup([fields[j].codec
+                                   for j in range(i, group_stop)])
+                splice_items = 1
+            elif isinstance(field.codec, StructCodec):
+                group_stop = i + 1
+                splice = field.codec
+                splice_items = splice.item_count
+            else:
+                if field.codec.converts:
+                    conversions.append((i - start, field.codec))
+                formats.append(field.codec.format)
+                item_count += 1
+                i += 1
+                continue
+            splices.append((i - start, group_stop - start, item_count,
+                            item_count + splice_items, splice))
+            formats.append(splice.format)
+            item_count += splice_items
+            i = group_stop
+        self.format = ''.join(formats)
+        self.big_struct = struct.Struct('>{}'.format(self.format))
+        self.little_struct = struct.Struct('<{}'.format(self.format))
+        self.size = self.big_struct.size
+        self.max_size = self.size
+        self.item_count = item_count
+        self.conversions = tuple(conversions)
+        # Splices are applied from last to first, so that replacing the values
+        # of one splice doesn't shift the indexes of the splices before it.
+        self.splices = tuple(reversed(splices))
+        self.transforms = bool(self.conversions or self.splices)
+
+    def _get_struct(self, little_endian):
+        if little_endian:
+            return self.little_struct
+        else:
+            return self.big_struct
+
+    def encode_items(self, values):
+        """
+        Convert the values of the fields in the run into the items that are
+        packed by the struct. Values are converted by their codecs, the values
+        for each bit group are replaced with its packed bytes, and nested
+        values are replaced with the items for their fields.
+
+        :param list values: The value of each field in the run. This list is
+            modified in place.
+        :returns: list
+        """
+        for i, codec in self.conversions:
+            values[i] = codec.encode_value(values[i])
+        for start, stop, _, _, splice in self.splices:
+            values[start:stop] = splice.encode_items(values[start:stop])
+        return values
+
+    def decode_items(self, items):
+        """
+        Convert items unpacked by the struct back into the values of the
+        fields in the run. This reverses encode_items.
+
+        :param items: The items unpacked by the struct.
+        :returns: list
+        """
+        values = list(items)
+        for _, _, start, stop, splice in self.splices:
+            values[start:stop] = splice.decode_items(values[start:stop])
+        for i, codec in self.conversions:
+            values[i] = codec.decode_value(values[i])
+        return values
+
+    def dumps(self, values, little_endian):
+        """
+        :param list values: The value of every field in the definition.
+        :param bool little_endian:
+        :returns: str
+        """
+        items = values[self.start:self.stop]
+        if self.transforms:
+            items = self.encode_items(items)
+        return self._get_struct(little_endian).pack(*items)
+
+    def dumps_into(self, buffer, offset, values, little_endian):
+        """
+        :param buffer: The writable buffer to write to.
+        :param int offset: Offset within the buffer to write to.
+        :param list values: The value of every field in the definition.
+        :param bool little_endian:
+        :returns: int offset just past the end of the run.
+        """
+        items = values[self.start:self.stop]
+        if self.transforms:
+            items = self.encode_items(items)
+        end = offset + self.size
+        _check_buffer_space(buffer, end)
+        self._get_struct(little_endian).pack_into(buffer, offset, *items)
+        return end
+
+    def size_of(self, values):
+        return self.size
+
+    def loads_into(self, values, string, offset, little_endian):
+        """
+        Decode the fields in the run, appending their values to a list.
+
+        :param list values: The values of the fields before this run.
+        :param str string: The string to decode.
+        :param int offset: Offset of the run within the string.
+        :param bool little_endian:
+        :returns: int offset just past the end of the run.
+        """
+        run_struct = self._get_struct(little_endian)
+        try:
+            items = run_struct.unpack_from(string, offset)
+        except struct.error:
+            _check_truncated(string, offset + run_struct.size)
+            raise
+        if self.transforms:
+            items = self.decode_items(items)
+        values.extend(items)
+        return offset + run_struct.size
+
+
+class _FieldRun(object):
+
+    """
+    A single variable length field in a definition, which is encoded and
+    decoded by its own codec.
+
+    :param Field field: The field.
+    :param int index: Index of the field in the definition.
+    """
+
+    def __init__(self, field, index):
+        super(_FieldRun, self).__init__()
+        self.field = field
+        self.codec = field.codec
+        self.index = index
+        self.max_size = field.codec.max_size
+
+    def size_of(self, values):
+        return self.codec.size_of(values[self.index])
+
+    def dumps(self, values, little_endian):
+        return self.codec.dumps(values[self.index], little_endian)
+
+    def dumps_into(self, buffer, offset, values, little_endian):
+        return self.codec.dumps_into(buffer, offset, values[self.index],
+                                     little_endian)
+
+    def loads_into(self, values, string, offset, little_endian):
+        value, offset = self.codec.loads_from(string, offset, little_endian)
+        values.append(value)
+        return offset
+
+    def skip_from(self, string, offset, little_endian):
+        """
+        Find the end of the field without decoding it, if the codec supports
+        that. Otherwise, the field is decoded and the value is discarded.
+
+        :returns: int offset just past the end of the field.
+        """
+        skip_from = getattr(self.codec, 'skip_from', None)
+        if skip_from is not None:
+            return skip_from(string, offset, little_endian)
+        return self.codec.loads_from(string, offset, little_endian)[1]
+
+
+class _FieldSelection(object):
+
+    """
+    Decodes a subset of the fields of a definition.
+
+    The runs of the definition are compiled into a list of steps. Struct runs
+    without any selected fields are skipped by adding their size to the
+    offset. Other struct runs are unpacked with a struct that has pad bytes in
+    place of the fields that weren't selected, unless the run contains bit
+    groups or nested definitions, in which case the whole run is decoded.
+    Variable length fields that weren't selected are skipped using their
+    length prefixes, and decoding stops after the last selected field.
+
+    :param Definition definition: The definition to decode.
+    :param tuple keys: Keys of the fields to decode.
+    :param bool little_endian: If True, values will be decoded in little
+        endian format.
+    :raises KeyError: If a key isn't a field of the definition.
+    """
+
+    # Kinds of steps.
+    FIELD = 0
+    SKIP_FIELD = 1
+    STRUCT = 2
+    RUN = 3
+
+    def __init__(self, definition, keys, little_endian):
+        super(_FieldSelection, self).__init__()
+        selected = set()
+        for key in keys:
+            if key not in definition.keys:
+                raise KeyError('field {!r} is not defined'.format(key))
+            selected.add(definition.keys.index(key))
+        last = max(selected) if selected else -1
+        steps = []
+        skip = 0
+        for run in definition._runs:
+            if isinstance(run, _FieldRun):
+                if run.index > last:
+                    break
+                if run.index in selected:
+                    steps.append((skip, self.FIELD, run.codec.loads_from,
+                                  run.field.key, None))
+                else:
+                    steps.append((skip, self.SKIP_FIELD, run.skip_from, None,
+                                  None))
+                skip = 0
+                continue
+            if run.start > last:
+                break
+            indexes = [i for i in range(run.start, run.stop)
+                       if i in selected]
+            if not indexes:
+                skip += run.size
+                continue
+            run_keys = tuple(definition.keys[i] for i in indexes)
+            if run.splices:
+                # Bit groups and nested definitions don't map one field to
+                # one struct item, so the whole run is decoded.
+                picks = tuple(i - run.start for i in indexes)
+                steps.append((skip, self.RUN,
+                              run._get_struct(little_endian).unpack_from,
+                              run_keys, (run, picks)))
+            else:
+                formats = []
+                conversions = []
+                for position, i in enumerate(indexes):
+                    codec = definition.fields[i].codec
+                    if codec.converts:
+                        conversions.append((position, codec))
+                for i in range(run.start, run.stop):
+                    codec = definition.fields[i].codec
+                    if i in selected:
+                        formats.append(codec.format)
+                    else:
+                        formats.append('{}x'.format(
+                            struct.calcsize('>' + codec.format)))
+                run_struct = struct.Struct('{}{}'.format(
+                    '<' if little_endian else '>', ''.join(formats)))
+                steps.append((skip, self.STRUCT, run_struct.unpack_from,
+                              run_keys, tuple(conversions)))
+            skip = run.size
+        self.keys = tuple(keys)
+        self.little_endian = little_endian
+        self.steps = tuple(steps)
+
+    def loads(self, string, offset):
+        """
+        :param str string: A string encoded by the definition.
+        :param int offset: Offset of the message within the string.
+        :returns: dict of the selected fields.
+        """
+        little_endian = self.little_endian
+        values = {}
+        for skip, kind, function, keys, extra in self.steps:
+            offset += skip
+            if kind == self.FIELD:
+                values[keys], offset = function(string, offset,
+                                                little_endian)
+            elif kind == self.SKIP_FIELD:
+                offset = function(string, offset, little_endian)
+            elif kind == self.STRUCT:
+                items = function(string, offset)
+                if extra:
+                    items = list(items)
+                    for i, codec in extra:
+                        items[i] = codec.decode_value(items[i])
+                values.update(zip(keys, items))
+            else:
+                run, picks = extra
+                items = run.decode_items(function(string, offset))
+                values.update(zip(keys, [items[i] for i in picks]))
+        return values
+
+
+def _get_message_struct(id_codec, run, little_endian):
+    """
+    Get a struct that packs the id of a definition along with a run of its
+    fields, so that a schema can encode both with a single call.
+
+    Ids are always encoded in big endian format, so this is only possible
+    for little endian runs if the id is a single byte.
+
+    :param id_codec: Codec for the id of the definition.
+    :param run: The first run of the definition.
+    :param bool little_endian: If True, the run is encoded in little endian
+        format.
+    :returns: struct.Struct, or None if the id and the run can't be packed
+        together.
+    """
+    if not isinstance(id_codec, Codec) or not isinstance(run, _StructRun):
+        return None
+    if little_endian:
+        if id_codec.size != 1:
+            return None
+        return struct.Struct('<{}{}'.format(id_codec.format, run.format))
+    return struct.Struct('>{}{}'.format(id_codec.format, run.format))
+
+
+def _generate_tuple(names):
+    """
+    Join names into a tuple display, or unpacking target.
+
+    :param list(str) names:
+    :returns: str
+    """
+    if len(names) == 1:
+        return '{},'.format(names[0])
+    return ', '.join(names)
+
+
+def _generate_run(run, names, namespace):
+    """
+    Generate the code to pack and unpack the fields of a struct run.
+
+    :param _StructRun run: The run to generate code for.
+    :param list(str) names: Variable name for the value of each field in the
+        definition.
+    :param dict namespace: Namespace for the generated code. Codec methods
+        used by the code are added to it.
+    :returns: tuple(list, list, list) of the argument expressions to pack,
+        the names to unpack the items into, and the lines that convert the
+        unpacked items back into field values.
+    """
+    conversions = dict(run.conversions)
+    splices = dict((splice[0], splice) for splice in run.splices)
+    args = []
+    targets = []
+    lines = []
+    j = 0
+    while j < run.stop - run.start:
+        i = run.start + j
+        name = names[i]
+        if j in splices:
+            start, stop, _, _, splice = splices[j]
+            group = _generate_tuple(names[run.start + start:
+                                          run.start + stop])
+            if isinstance(splice, BitGroup):
+                namespace['encode_{}'.format(i)] = splice.encode_values
+                namespace['decode_{}'.format(i)] = splice.decode_values
+                args.append('encode_{}([{}])'.format(i, group.rstrip(',')))
+                targets.append('i{}'.format(i))
+                lines.append('{} = decode_{}(i{})'.format(group, i, i))
+            else:
+                namespace['encode_{}'.format(i)] = splice.encode_items
+                namespace['decode_{}'.format(i)] = splice.decode_items
+                items = ['i{}_{}'.format(i, k)
+                         for k in range(splice.item_count)]
+                args.append('*encode_{}([{}])'.format(i, name))
+                targets.extend(items)
+                lines.append('{}, = decode_{}(({}))'.format(
+                    name, i, _generate_tuple(items)))
+            j = stop
+            continue
+        if j in conversions:
+            codec = conversions[j]
+            namespace['encode_{}'.format(i)] = codec.encode_value
+            namespace['decode_{}'.format(i)] = codec.decode_value
+            args.append('encode_{}({})'.format(i, name))
+            targets.append('i{}'.format(i))
+            lines.append('{} = decode_{}(i{})'.format(name, i, i))
+        else:
+            args.append(name)
+            targets.append(name)
+        j += 1
+    return args, targets, lines
+
+
+def _generate_source(definition, little_endian, id_codec=None):
+    """
+    Generate the source of functions that encode and decode messages for a
+    definition, with the field loop unrolled into straight line code.
+
+    The source defines dumps, loads and loads_from functions with the same
+    arguments as the Definition methods. If id_codec is passed, it also
+    defines a dumps_message function, which prefixes the message with the id
+    of the definition, as Schema.dumps does.
+
+    :param Definition definition: The definition to generate code for.
+    :param bool little_endian: If True, the functions encode and decode
+        values in little endian format.
+    :param Codec id_codec: Codec for the id of the definition, or None.
+    :returns: tuple(str, dict) of the source, and the namespace that it must
+        be executed in.
+    """
+    namespace = {
+        'loads_fields': definition._loads_fields,
+        'record_class': definition.record_class,
+        'text_type': six.text_type,
+    }
+    names = ['v{}'.format(i) for i in range(len(definition.fields))]
+    parts = []
+    lines = []
+    first_args = None
+    position = 0
+    for r, run in enumerate(definition._runs):
+        offset = 'offset + {}'.format(position) if position else 'offset'
+        if isinstance(run, _FieldRun):
+            i = run.index
+            namespace['dumps_{}'.format(i)] = run.codec.dumps
+            namespace['loads_from_{}'.format(i)] = run.codec.loads_from
+            parts.append('dumps_{}({}, {})'.format(i, names[i],
+                                                   little_endian))
+            lines.append('{}, offset = loads_from_{}(string, {}, {})'.format(
+                names[i], i, offset, little_endian))
+            position = 0
+            continue
+        args, targets, run_lines = _generate_run(run, names, namespace)
+        run_struct = run._get_struct(little_endian)
+        namespace['pack_{}'.format(r)] = run_struct.pack
+        namespace['unpack_from_{}'.format(r)] = run_struct.unpack_from
+        if r == 0:
+            first_args = args
+        parts.append('pack_{}({})'.format(r, ', '.join(args)))
+        if targets:
+            lines.append('{} = unpack_from_{}(string, {})'.format(
+                _generate_tuple(targets), r, offset))
+        lines.extend(run_lines)
+        position += run.size
+    end = 'offset + {}'.format(position) if position else 'offset'
+
+    def join(parts):
+        if len(parts) == 1:
+            return parts[0]
+        return "b''.join(({}))".format(_generate_tuple(parts))
+
+    keys = [repr(key) for key in definition.keys]
+    if not names:
+        get_lines = []
+    elif definition.record_class is not None:
+        attributes = [
+            'data.{}'.format(key)
+            if (isinstance(key, str) and key.isidentifier() and
+                not keyword.iskeyword(key))
+            else 'getattr(data, {!r})'.format(key)
+            for key in definition.keys]
+        get_lines = [
+            'if isinstance(data, record_class):',
+            '    {} = {}'.format(', '.join(names), ', '.join(attributes)),
+            'else:',
+            '    {} = {}'.format(', '.join(names), ', '.join(
+                'data[{}]'.format(key) for key in keys)),
+        ]
+    else:
+        get_lines = ['{} = {}'.format(', '.join(names), ', '.join(
+            'data[{}]'.format(key) for key in keys))]
+    if definition.record_class is not None:
+        value = 'record_class({})'.format(', '.join(names))
+    else:
+        value = '{{{}}}'.format(', '.join(
+            '{}: {}'.format(key, name) for key, name in zip(keys, names)))
+
+    def function(signature, body, result):
+        return '\n'.join(['def {}:'.format(signature)] +
+                         ['    ' + line for line in body] +
+                         ['    return {}'.format(result), '', ''])
+
+    load_lines = [
+        'if isinstance(string, text_type):',
+        "    string = string.encode('utf-8')",
+    ]
+    if lines:
+        # The generic method is used to decode a message again after a
+        # struct.error, as it tells a truncated string apart from other
+        # errors, and raises TruncatedError for it.
+        namespace['struct_error'] = struct.error
+        namespace['loads_values'] = definition._loads_values
+        load_lines += ['start = offset', 'try:']
+        load_lines += ['    ' + line for line in lines]
+        load_lines += [
+            'except struct_error:',
+            '    loads_values(string, start, {})'.format(little_endian),
+            '    raise',
+        ]
+    functions = [
+        function('dumps(data)', get_lines, join(parts)),
+        function('loads_from(string, offset=0)', load_lines,
+                 '{}, {}'.format(value, end)),
+        function('loads(string, offset=0, fields=None)', [
+            'if fields is not None:',
+            '    return loads_fields(string, offset, fields)',
+        ] + load_lines, value),
+    ]
+    if id_codec is not None:
+        message_struct = _get_message_struct(id_codec, definition._runs[0],
+                                             little_endian)
+        if message_struct is not None:
+            namespace['pack_message'] = message_struct.pack
+            message_parts = ['pack_message({})'.format(', '.join(
+                [repr(definition.id)] + first_args))] + parts[1:]
+        else:
+            namespace['prefix'] = id_codec.dumps(definition.id)
+            message_parts = ['prefix'] + parts
+        functions.append(function('dumps_message(data)', get_lines,
+                                  join(message_parts)))
+    return '\n'.join(functions).rstrip() + '\n', namespace
+
+
+class Definition(object):
+
+    """
+    Definitions are a grouping of fields, and are used to encode or decode an
+    individual message. They can be grouped into schemas or used standalone.
+
+    :param list(Field) fields: The fields contained in this definition.
+    :param int id: An optional integer id for this definition. Use to identify
+        it in packets encoded by a schema.
+    :param str key: An optional human readable name for this definition. Used
+        to identify it within a schema.
+    :param bool little_endian: If True, values will be encoded and decoded in
+        little endian format for this definition.
+    :param record: Controls what type of object messages are decoded into.
+        If False (the default), messages are decoded into dicts. If True, a
+        namedtuple class is generated with an attribute for each field, in
+        the same order as the fields, so every key must be a valid attribute
+        name that doesn't start with an underscore. Any other class is called
+        with the value of each field as a positional argument, in field
+        order, so a class using __slots__ can be used to save memory.
+        Instances of the record class can also be passed to dumps instead of
+        dicts.
+    :param bool pack_booleans: If True, consecutive boolean fields are packed
+        into shared bytes, along with any neighboring uintN fields, using one
+        bit for each boolean. This is not supported by the JavaScript version
+        of the library, so it is disabled by default.
+    :param bool codegen: If True, specialized dumps and loads functions are
+        generated for the definition. See :meth:`generate`.
+    """
+
+    def __init__(self, fields, id=None, key=None, little_endian=False,
+                 record=False, pack_booleans=False, codegen=False):
+        super(Definition, self).__init__()
+        self.fields = fields
+        self.id = id
+        self.key = key
+        self.little_endian = little_endian
+        self.pack_booleans = pack_booleans
+        self._record = record
+        self._compile()
+        if record is True:
+            self.record_class = self._make_record_class()
+        elif record:
+            self.record_class = record
+        else:
+            self.record_class = None
+        self.codegen = False
+        self.generated_source = None
+        self._linecache_finalizer = None
+        self._id_codec = None
+        self._id_prefix = None
+        self._big_message_struct = None
+        self._little_message_struct = None
+        if codegen:
+            self.generate()
+
+    def __reduce__(self):
+        # Definitions are pickled as the arguments used to create them, and
+        # compiled again when they are unpickled, so the structs, generated
+        # code and accelerator plans never need to be pickled.
+        # The id type is included for definitions in a schema, so that code
+        # is only generated once, with the id prefix, when it is unpickled.
+        id_type = None
+        if self._id_codec is not None:
+            id_type = next(key for key, codec in _codecs.items()
+                           if codec is self._id_codec)
+        return (_load_definition, (self.fields, self.id, self.key,
+                                   self.little_endian, self._record,
+                                   self.pack_booleans, self.codegen, id_type))
+
+    def generate(self, id_codec=None):
+        """
+        Generate specialized dumps, loads and loads_from functions for this
+        definition, and use them in place of the generic methods.
+
+        The generic methods loop over the runs of the definition for every
+        message. The generated functions unroll that loop into straight line
+        code, with the struct methods, codec methods and offsets bound as
+        constants. The source of the generated functions is stored in
+        generated_source, and is also shown in tracebacks.
+
+        The functions are specialized for the current little_endian and
+        record_class, so call this again after changing either of them.
+
+        :param Codec id_codec: If passed, a function that prefixes messages
+            with the id of the definition is generated as well. This is used
+            by schemas, and is remembered when generate is called again.
+        """
+        if id_codec is None:
+            id_codec = self._id_codec
+        source, namespace = _generate_source(self, self.little_endian,
+                                             id_codec)
+        filename = '<jettison {} {:#x}>'.format(self.key or 'definition',
+                                                id(self))
+        six.exec_(compile(source, filename, 'exec'), namespace)
+        linecache.cache[filename] = (len(source), None,
+                                     source.splitlines(True), filename)
+        # The source is removed from the line cache along with the
+        # definition, so generating code for many short lived definitions
+        # doesn't leak it.
+        if self._linecache_finalizer is None:
+            self._linecache_finalizer = weakref.finalize(
+                self, linecache.cache.pop, filename, None)
+        self.codegen = True
+        self.generated_source = source
+        self._id_codec = id_codec
+        self.dumps = namespace['dumps']
+        self.loads = namespace['loads']
+        self.loads_from = namespace['loads_from']
+        if 'dumps_message' in namespace:
+            self._dumps_message = namespace['dumps_message']
+
+    def _set_id_codec(self, id_codec, generate=False):
+        """
+        Precompute the id prefix that a schema writes before each message of
+        this definition. If the definition is fixed size, structs that pack
+        the id along with the fields are compiled as well.
+
+        :param Codec id_codec: Codec for the id of the definition.
+        :param bool generate: If True, or if code was already generated for
+            the definition, code is generated using the id codec.
+        """
+        if id_codec is self._id_codec and (self.codegen or not generate):
+            return
+        self._id_codec = id_codec
+        self._id_prefix = id_codec.dumps(self.id)
+        if self.fixed_size is not None:
+            self._big_message_struct = _get_message_struct(
+                id_codec, self._runs[0], False)
+            self._little_message_struct = _get_message_struct(
+                id_codec, self._runs[0], True)
+        if generate or self.codegen:
+            self.generate(id_codec)
+
+    def _dumps_message(self, data):
+        """
+        Dump a data dict prefixed with the id of the definition, as
+        Schema.dumps does. This can only be used after _set_id_codec.
+
+        :param data: The data dict or record to encode.
+        :returns: str
+        """
+        if self._speedups_plan is not None:
+            return self._speedups_plan.dumps(data, self.record_class,
+                                             self.little_endian,
+                                             self._id_prefix)
+        if self.little_endian:
+            message_struct = self._little_message_struct
+        else:
+            message_struct = self._big_message_struct
+        if message_struct is not None:
+            return message_struct.pack(self.id,
+                                       *self._get_struct_values(data))
+        return self._id_prefix + self._dumps_values(self._get_values(data),
+                                                    self.little_endian)
+
+    def _make_record_class(self):
+        """
+        Generate a namedtuple class for the fields of this definition.
+
+        :returns: type
+        :raises ValueError: If a key can't be used as an attribute name.
+        """
+        if isinstance(self.key, str) and self.key.isidentifier():
+            name = self.key
+        else:
+            name = 'Record'
+        try:
+            return collections.namedtuple(name, self.keys)
+        except ValueError as error:
+            raise ValueError('record=True requires keys that are valid '
+                             'identifiers, pass a record class instead: '
+                             '{}'.format(error))
+
+    def _compile(self):
+        """
+        Precompute the structs used to encode and decode the definition.
+
+        Consecutive fixed size fields are grouped into runs, and the formats
+        of the fields in each run are concatenated into one struct that
+        encodes or decodes the whole run in a single call. Explicit endian
+        prefixes disable alignment padding, so the result is identical to
+        encoding field by field. Variable length fields are each encoded by
+        their own codec.
+
+        When every field uses a fixed size codec, the whole definition is a
+        single run, and its structs are also stored as big_struct and
+        little_struct, and its size as fixed_size. Otherwise, those are set to
+        None. The largest possible size of an encoded message is stored as
+        max_size, which is None if any string or array field is unbounded.
+        """
+        self.keys = tuple(field.key for field in self.fields)
+        self.delta_mask_size = (len(self.fields) + 7) // 8
+        self._column_codecs = tuple(
+            ArrayCodec(field.codec.format)
+            if isinstance(field.codec, Codec) else None
+            for field in self.fields)
+        runs = []
+        start = None
+        for i, field in enumerate(self.fields):
+            if _is_fixed_codec(field.codec):
+                if start is None:
+                    start = i
+                continue
+            if start is not None:
+                runs.append(_StructRun(self.fields, start, i,
+                                       self.pack_booleans))
+                start = None
+            runs.append(_FieldRun(field, i))
+        if start is not None or not runs:
+            runs.append(_StructRun(self.fields, start or 0, len(self.fields),
+                                   self.pack_booleans))
+        self._runs = tuple(runs)
+        self._selections = {}
+        if _speedups is not None:
+            self._speedups_plan = _speedups.Plan(tuple(
+                (run.start, run.format, run.size)
+                if isinstance(run, _StructRun) and not run.transforms
+                else run
+                for run in runs), self.keys)
+        else:
+            self._speedups_plan = None
+        if len(runs) == 1 and isinstance(runs[0], _StructRun):
+            self.big_struct = runs[0].big_struct
+            self.little_struct = runs[0].little_struct
+            self.fixed_size = runs[0].size
+        else:
+            self.big_struct = None
+            self.little_struct = None
+            self.fixed_size = None
+        if any(run.max_size is None for run in runs):
+            self.max_size = None
+        else:
+            self.max_size = sum(run.max_size for run in runs)
+
+    def _get_struct(self, little_endian):
+        """
+        Get the precompiled struct for the given endianness.
+
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: struct.Struct, or None if the definition contains variable
+            length fields.
+        """
+        if little_endian:
+            return self.little_struct
+        else:
+            return self.big_struct
+
+    def _get_values(self, data):
+        """
+        Get the value of each field from a data dict or record.
+
+        :param data: A data dict, or an instance of the record class.
+        :returns: list of values, in field order.
+        """
+        if self.record_class is not None and isinstance(data,
+                                                        self.record_class):
+            return [getattr(data, key) for key in self.keys]
+        return [data[key] for key in self.keys]
+
+    def _make_value(self, values):
+        """
+        Make a data dict or record from a sequence of field values.
+
+        :param values: Sequence of values, in field order.
+        :returns: dict, or an instance of the record class.
+        """
+        if self.record_class is not None:
+            return self.record_class(*values)
+        return dict(zip(self.keys, values))
+
+    def _get_struct_values(self, data):
+        """
+        Get the values to pack with the compiled struct from a data dict or
+        record. This is like _get_values, but any codec conversions, such as
+        quantization, and bit packing have been applied. It can only be used
+        when the definition has a compiled struct.
+
+        :param data: A data dict, or an instance of the record class.
+        :returns: list of values to pack.
+        """
+        values = self._get_values(data)
+        run = self._runs[0]
+        if run.transforms:
+            values = run.encode_items(values)
+        return values
+
+    def _make_struct_value(self, items):
+        """
+        Make a data dict or record from items unpacked by the compiled
+        struct, reversing any codec conversions and bit packing.
+
+        :param items: Sequence of items unpacked by the struct.
+        :returns: dict, or an instance of the record class.
+        """
+        run = self._runs[0]
+        if run.transforms:
+            items = run.decode_items(items)
+        return self._make_value(items)
+
+    def _dumps_values(self, values, little_endian):
+        """
+        Dump a list of field values to a string.
+
+        :param list values: The value of each field, in field order.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: str
+        """
+        compiled_struct = self._get_struct(little_endian)
+        if compiled_struct is not None:
+            run = self._runs[0]
+            if run.transforms:
+                values = run.encode_items(values)
+            return compiled_struct.pack(*values)
+        return b''.join([run.dumps(values, little_endian)
+                         for run in self._runs])
+
+    def _size_of_values(self, values):
+        """
+        Calculate the encoded size of a list of field values.
+
+        :param list values: The value of each field, in field order.
+        :returns: int
+        """
+        return sum([run.size_of(values) for run in self._runs])
+
+    def _dumps_values_into(self, buffer, offset, values, little_endian):
+        """
+        Dump a list of field values into a writable buffer.
+
+        :param buffer: The buffer to write to.
+        :param int offset: Offset within the buffer to write to.
+        :param list values: The value of each field, in field order.
+        :param bool little_endian: If True, values will be encoded in little
+            endian format.
+        :returns: int offset just past the end of the written message.
+        :raises BufferFullError: If the buffer is too small.
+        """
+        for run in self._runs:
+            offset = run.dumps_into(buffer, offset, values, little_endian)
+        return offset
+
+    def _loads_values(self, string, offset, little_endian):
+        """
+        Load a list of field values from a string.
+
+        :param str string: A string encoded by this definition.
+        :param int offset: Start decoding from this offset within the string.
+        :param bool little_endian: If True, values will be decoded in little
+            endian format.
+        :returns: tuple(list, int) of the value of each field, in field order,
+            and the offset just past the end of the encoded message.
+        """
+        compiled_struct = self._get_struct(little_endian)
+        if compiled_struct is not None:
+            try:
+                values = compiled_struct.unpack_from(string, offset)
+            except struct.error:
+                _check_truncated(string, offset + compiled_struct.size)
+                raise
+            run = self._runs[0]
+            if run.transforms:
+                values = run.decode_items(values)
+            return values, offset + compiled_struct.size
+        values = []
+        for run in self._runs:
+            offset = run.loads_into(values, string, offset, little_endian)
+        return values, offset
 
     def dumps(self, data):
         """
-        :param data: The data dict to encode as a string.
+        :param data: The data dict to encode as a string. This can also be an
+            instance of the definition's record class.
         :returns: str
         """
-        string = b''
-        for field in self.fields:
-            string += field.codec.dumps(data[field.key], self.little_endian)
-        return string
+        if self._speedups_plan is not None:
+            return self._speedups_plan.dumps(data, self.record_class,
+                                             self.little_endian)
+        return self._dumps_values(self._get_values(data), self.little_endian)
+
+    def size_of(self, data):
+        """
+        Calculate the exact size of the encoded data dict, without encoding
+        it. Fixed size definitions always return fixed_size.
+
+        :param data: The data dict or record to measure.
+        :returns: int
+        """
+        if self.fixed_size is not None:
+            return self.fixed_size
+        return self._size_of_values(self._get_values(data))
 
-    def loads(self, string, offset=0):
+    def dumps_into(self, buffer, offset, data):
+        """
+        Dump a data dict into a caller owned buffer, instead of allocating a
+        new string. Reusing the same buffer for many messages avoids
+        allocating an output string for each one. The values of the fields
+        are still gathered into a list, so this isn't free of allocations.
+
+        :param buffer: A writable buffer, such as a bytearray or a memoryview
+            of one. It is never resized.
+        :param int offset: Offset within the buffer to write to.
+        :param data: The data dict or record to encode.
+        :returns: int number of bytes written.
+        :raises BufferFullError: If the message does not fit in the space
+            remaining in the buffer.
+        """
+        end = self._dumps_values_into(buffer, offset, self._get_values(data),
+                                      self.little_endian)
+        return end - offset
+
+    def loads(self, string, offset=0, fields=None):
         """
         :param str string: A string encoded by this definition. This should be
             a str object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :param fields: If passed, only the fields with these keys are decoded,
+            and a dict of just those fields is returned, even if the
+            definition has a record class. Fields that aren't needed are
+            skipped without being decoded where possible, and nothing after
+            the last requested field is read, so this is much faster than a
+            full decode when only a few fields are needed.
+        :returns: dict, or an instance of the definition's record class.
+        :raises KeyError: If one of the fields isn't defined.
+        """
+        if fields is not None:
+            return self._loads_fields(string, offset, fields)
+        return self.loads_from(string, offset)[0]
+
+    def _loads_fields(self, string, offset, fields):
+        """
+        Load a dict of some of the fields from a string. The compiled steps
+        for each set of fields are cached, so they're only compiled the first
+        time that set is used.
+
+        :param str string: A string encoded by this definition.
+        :param int offset: Start decoding from this offset within the string.
+        :param fields: Sequence of the keys of the fields to decode.
         :returns: dict
         """
         if isinstance(string, six.text_type):
             string = string.encode('utf-8')
-        values = {}
-        for field in self.fields:
-            values[field.key] = field.codec.loads(string, offset,
-                                                   self.little_endian)
-            offset += field.codec.size
-        return values
+        if not isinstance(fields, tuple):
+            fields = tuple(fields)
+        cache_key = (fields, self.little_endian)
+        selection = self._selections.get(cache_key)
+        if selection is None:
+            selection = _FieldSelection(self, fields, self.little_endian)
+            self._selections[cache_key] = selection
+        return selection.loads(string, offset)
+
+    def loads_from(self, string, offset=0):
+        """
+        Load a dict from a string, along with the offset just past the end of
+        the encoded message.
+
+        Decoding does not modify the definition or its codecs, so a single
+        definition can be used to decode from several threads at once.
+
+        :param str string: A string encoded by this definition. This should be
+            a str object on Python 2, and a bytes object on Python 3. Any
+            object supporting the buffer protocol, such as a bytearray,
+            memoryview or mmap, is decoded in place without being copied.
+        :param int offset: Start decoding from this offset within the string.
+        :returns: tuple(dict, int). If the definition has a record class, a
+            record is returned instead of the dict.
+        """
+        if isinstance(string, six.text_type):
+            string = string.encode('utf-8')
+        if self._speedups_plan is not None:
+            return self._speedups_plan.loads_from(string, offset,
+                                                  self.record_class,
+                                                  self.little_endian)
+        values, offset = self._loads_values(string, offset, self.little_endian)
+        return self._make_value(values), offset
+
+    def skip_from(self, string, offset=0):
+        """
+        Find the end of a message without decoding it. Runs of fixed size
+        fields are skipped by their size, and strings and arrays are skipped
+        using their length prefixes, so this is much cheaper than loads_from.
+
+        :param str string: A string encoded by this definition.
+        :param int offset: Offset of the message within the string.
+        :returns: int offset just past the end of the encoded message.
+        :raises TruncatedError: If the string ends before the message does.
+        """
+        little_endian = self.little_endian
+        for run in self._runs:
+            if isinstance(run, _FieldRun):
+                offset = run.skip_from(string, offset, little_endian)
+            else:
+                offset += run.size
+        _check_truncated(string, offset)
+        return offset
+
+    def dumps_columns(self, data):
+        """
+        Dump many records to a string in columnar format.
+
+        The string starts with a uint32 record count. That is followed by the
+        values of the first field for every record, then the values of the
+        second field for every record, and so on. Each column of fixed size
+        values is packed with a single struct call, and arrays from the array
+        module or NumPy are copied in directly.
+
+        :param data: Either a list of data dicts or records, or a dict mapping
+            each key to a sequence of values for that field.
+        :returns: str
+        """
+        if isinstance(data, dict):
+            columns = [data[key] for key in self.keys]
+            count = len(columns[0]) if columns else 0
+        else:
+            records = [self._get_values(record) for record in data]
+            columns = [[values[i] for values in records]
+                       for i in range(len(self.keys))]
+            count = len(records)
+        little_endian = self.little_endian
+        strings = [_get_length_struct(little_endian).pack(count)]
+        for field, column_codec, column in zip(self.fields,
+                                               self._column_codecs, columns):
+            if len(column) != count:
+                raise ValueError('column {!r} has {} values, expected '
+                                 '{}'.format(field.key, len(column), count))
+            if column_codec is None:
+                strings.extend([field.codec.dumps(value, little_endian)
+                                for value in column])
+                continue
+            if field.codec.converts:
+                column = [field.codec.encode_value(value) for value in column]
+                string = None
+            else:
+                string = column_codec._dumps_buffer(column, little_endian)
+            if string is None:
+                column_struct = column_codec._get_struct(count, little_endian)
+                string = column_struct.pack(*column)
+            strings.append(string)
+        return b''.join(strings)
+
+    def loads_columns(self, string, offset=0):
+        """
+        Load records encoded by dumps_columns.
+
+        :param str string: A string encoded by dumps_columns. This should be a
+            str object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :returns: dict mapping each key to a tuple of the values for that
+            field.
+        """
+        return self.loads_columns_from(string, offset)[0]
+
+    def loads_columns_from(self, string, offset=0):
+        """
+        Load records encoded by dumps_columns, along with the offset just past
+        the end of the encoded records.
+
+        :param str string: A string encoded by dumps_columns. This should be a
+            str object on Python 2, and a bytes object on Python 3.
+        :param int offset: Start decoding from this offset within the string.
+        :returns: tuple(dict, int)
+        """
+        if isinstance(string, six.text_type):
+            string = string.encode('utf-8')
+        little_endian = self.little_endian
+        length_struct = _get_length_struct(little_endian)
+        count = length_struct.unpack_from(string, offset)[0]
+        offset += length_struct.size
+        columns = {}
+        for field, column_codec in zip(self.fields, self._column_codecs):
+            if column_codec is None:
+                column = []
+                for _ in range(count):
+                    value, offset = field.codec.loads_from(string, offset,
+                                                           little_endian)
+                    column.append(value)
+                columns[field.key] = tuple(column)
+            else:
+                column_struct = column_codec._get_struct(count, little_endian)
+                column = column_struct.unpack_from(string, offset)
+                if field.codec.converts:
+                    column = tuple(field.codec.decode_value(value)
+                                   for value in column)
+                columns[field.key] = column
+                offset += column_struct.size
+        return columns, offset
+
+    def dumps_delta(self, previous, data):
+        """
+        Dump only the fields that have changed since a previous message.
+
+        The string starts with a bitmask with one bit per field, in field
+        order, starting with the least significant bit of the first byte. A
+        set bit means the field has changed, and the changed values follow the
+        bitmask in field order, encoded exactly as dumps would encode them.
+
+        :param previous: The data dict or record previously sent for the same
+            entity, or None to send every field.
+        :param data: The data dict or record to encode.
+        :returns: str
+        """
+        little_endian = self.little_endian
+        values = self._get_values(data)
+        if previous is None:
+            changed = [True] * len(values)
+        else:
+            changed = [_has_changed(field.codec, value, previous_value,
+                                    little_endian)
+                       for field, value, previous_value
+                       in zip(self.fields, values,
+                              self._get_values(previous))]
+        mask = bytearray(self.delta_mask_size)
+        strings = [None]
+        for i, (field, value) in enumerate(zip(self.fields, values)):
+            if changed[i]:
+                mask[i >> 3] |= 1 << (i & 7)
+                strings.append(field.codec.dumps(value, little_endian))
+        strings[0] = bytes(mask)
+        return b''.join(strings)
+
+    def loads_delta(self, string, previous, offset=0):
+        """
+        Load a message encoded by dumps_delta, applying it to the previous
+        message for the same entity.
+
+        :param str string: A string encoded by dumps_delta. This should be a
+            str object on Python 2, and a bytes object on Python 3.
+        :param previous: The data dict or record that the delta was encoded
+            against. This is not modified. It may only be None if every field
+            is present in the delta.
+        :param int offset: Start decoding from this offset within the string.
+        :returns: dict, or an instance of the definition's record class.
+        """
+        return self.loads_delta_from(string, previous, offset)[0]
+
+    def loads_delta_from(self, string, previous, offset=0):
+        """
+        Load a message encoded by dumps_delta, along with the offset just past
+        the end of the delta.
+
+        :param str string: A string encoded by dumps_delta. This should be a
+            str object on Python 2, and a bytes object on Python 3.
+        :param previous: The data dict or record that the delta was encoded
+            against.
+        :param int offset: Start decoding from this offset within the string.
+        :returns: tuple(dict, int). If the definition has a record class, a
+            record is returned instead of the dict.
+        """
+        if isinstance(string, six.text_type):
+            string = string.encode('utf-8')
+        little_endian = self.little_endian
+        mask_size = self.delta_mask_size
+        mask = bytearray(string[offset:offset + mask_size])
+        if len(mask) < mask_size:
+            raise TruncatedError('unpack_from requires a buffer of at least '
+                                 '{} bytes'.format(offset + mask_size),
+                                 offset + mask_size)
+        offset += mask_size
+        if previous is None:
+            values = [None] * len(self.fields)
+        else:
+            values = self._get_values(previous)
+        for i, field in enumerate(self.fields):
+            if mask[i >> 3] & (1 << (i & 7)):
+                values[i], offset = field.codec.loads_from(string, offset,
+                                                           little_endian)
+            elif previous is None:
+                raise ValueError('field {!r} is missing from the delta and '
+                                 'there is no previous value'.format(
+                                     field.key))
+        return self._make_value(values), offset
 
 
 class Schema(object):
@@ -404,31 +2830,118 @@ class Schema(object):
     on the other end of a connection, as long as your packet types are defined
     the same way on both ends.
 
-    :param str id_type: Field type to use for packet type ids.
+    :param str id_type: Field type to use for packet type ids. By default,
+        the smallest of "uint8", "uint16" and "uint32" that can hold the id
+        of every definition is used, so the id type grows as definitions are
+        added, and all definitions should be defined before any messages are
+        encoded. Pass an id type explicitly to keep the wire format fixed,
+        such as for compatibility with older versions of a protocol.
+    :param str length_type: Default length type for the array and string
+        fields in the schema. The default is "uint32", which is what the
+        JavaScript version of the library expects. Use "varint" to encode
+        lengths in fewer bytes, if both ends of the connection support it.
+    :param bool pack_booleans: If True, consecutive boolean fields in the
+        schema's definitions are packed into shared bytes. See
+        :class:`Definition`.
+    :param bool codegen: If True, specialized functions are generated to
+        encode and decode each definition, with the id of the definition
+        precomputed. See :meth:`Definition.generate`.
     """
 
-    # FIXME: automatically set the id type depending on the number of packets
-    # that are defined in the schema
+    #: Id types that can be chosen automatically, and the largest id that each
+    #: of them can hold.
+    auto_id_types = (
+        ('uint8', 0xff),
+        ('uint16', 0xffff),
+        ('uint32', 0xffffffff),
+    )
 
-    def __init__(self, id_type='uint8'):
+    def __init__(self, id_type=None, length_type='uint32',
+                 pack_booleans=False, codegen=False):
         self.definitions = {}
         self.definitions_by_id = {}
-        self.id_type = id_type
+        self.auto_id_type = id_type is None
+        self.id_type = id_type or self.auto_id_types[0][0]
+        self.id_codec = _codecs[self.id_type]
+        self.length_type = length_type
+        self.pack_booleans = pack_booleans
+        self.codegen = codegen
         self.next_definition_id = 1
 
-    def define(self, key, fields):
+    def __reduce__(self):
+        definitions = sorted(self.definitions.values(),
+                             key=lambda definition: definition.id)
+        id_type = None if self.auto_id_type else self.id_type
+        return (_load_schema, (id_type, self.length_type,
+                               self.pack_booleans, self.codegen, definitions,
+                               self.next_definition_id))
+
+    def define(self, key, fields, record=False):
         """
         Define a new packet type for the schema.
 
         :param str key: A name for the definition.
         :param list(dict) fields: Fields for the definition.
+        :param record: Type of object to decode messages into. See
+            :class:`Definition`.
         :returns: Definition
         """
-        definition = Definition([Field(**kwargs) for kwargs in fields],
-                                self.next_definition_id, key)
+        definition = Definition(
+            _make_fields(fields, self.length_type, self.definitions),
+            self.next_definition_id, key, record=record,
+            pack_booleans=self.pack_booleans)
+        self._add_definition(definition)
         self.next_definition_id += 1
-        self.definitions[key] = definition
+        return definition
+
+    def _grow_id_type(self, definition_id):
+        """
+        If the id type is chosen automatically, and an id doesn't fit in it,
+        change it to the smallest one that the id fits in, and compute the
+        prefixes of the existing definitions again.
+
+        :param int definition_id: The largest id in the schema.
+        :raises ValueError: If the id is too large for any automatic id type.
+        """
+        if (not self.auto_id_type or
+                definition_id <= dict(self.auto_id_types)[self.id_type]):
+            return
+        for id_type, max_id in self.auto_id_types:
+            if definition_id <= max_id:
+                break
+        else:
+            raise ValueError('too many definitions in schema')
+        self.id_type = id_type
+        self.id_codec = _codecs[id_type]
+        for other in self.definitions.values():
+            other._set_id_codec(self.id_codec)
+
+    def _add_definition(self, definition):
+        """
+        Add a definition to the schema, and precompute its id prefix. If the
+        id type is chosen automatically, and the id of the definition doesn't
+        fit, the id type is changed to a larger one, and the prefixes of the
+        other definitions are computed again.
+
+        :param Definition definition: The definition to add.
+        :raises ValueError: If the id is too large for any automatic id type.
+        """
+        self._grow_id_type(definition.id)
+        definition._set_id_codec(self.id_codec, self.codegen)
+        self.definitions[definition.key] = definition
         self.definitions_by_id[definition.id] = definition
+
+    def _get_definition(self, key):
+        """
+        Get the definition with the given name.
+
+        :param str key: Name of the definition.
+        :returns: Definition
+        :raises KeyError: If the key is not defined in the schema.
+        """
+        definition = self.definitions.get(key)
+        if definition is None:
+            raise KeyError('key {!r} is not defined in schema'.format(key))
         return definition
 
     def dumps(self, key, data):
@@ -439,35 +2952,428 @@ class Schema(object):
         :param dict data: Data dict to encode as a string.
         :returns: str
         """
-        definition = self.definitions.get(key)
-        if definition is None:
-            raise KeyError('key {!r} is not defined in schema'.format(key))
-        id_codec = _codecs[self.id_type]
-        return id_codec.dumps(definition.id) + definition.dumps(data)
+        return self._get_definition(key)._dumps_message(data)
+
+    def size_of(self, key, data):
+        """
+        Calculate the exact size of an encoded message, including the id of
+        the definition, without encoding it.
+
+        :param str key: Name of the definition.
+        :param dict data: Data dict to measure.
+        :returns: int
+        """
+        definition = self._get_definition(key)
+        return len(definition._id_prefix) + definition.size_of(data)
+
+    def dumps_into(self, buffer, offset, key, data):
+        """
+        Dump a dict into a caller owned buffer, instead of allocating a new
+        string. See :meth:`Definition.dumps_into`.
+
+        :param buffer: A writable buffer, such as a bytearray or a memoryview
+            of one. It is never resized.
+        :param int offset: Offset within the buffer to write to.
+        :param str key: Name of the definition.
+        :param dict data: Data dict to encode.
+        :returns: int number of bytes written.
+        :raises BufferFullError: If the message does not fit in the space
+            remaining in the buffer.
+        """
+        definition = self._get_definition(key)
+        end = _write_bytes(buffer, offset, definition._id_prefix)
+        end = definition._dumps_values_into(
+            buffer, end, definition._get_values(data),
+            definition.little_endian)
+        return end - offset
+
+    def dumps_many(self, key, items):
+        """
+        Dump many dicts of the same definition into a single buffer.
+
+        The messages are packed back to back, each encoded exactly as dumps
+        would encode it.
+
+        :param str key: Name of the definition.
+        :param items: Iterable of data dicts to encode.
+        :returns: tuple(bytearray, list(int)) of the buffer and the offset at
+            which each message starts within it.
+        """
+        definition = self._get_definition(key)
+        return self._dumps_batch((definition, data) for data in items)
 
-    def loads(self, string):
+    def dumps_batch(self, messages):
+        """
+        Dump many dicts of any definitions into a single buffer.
+
+        :param messages: Iterable of (key, data) tuples to encode.
+        :returns: tuple(bytearray, list(int)) of the buffer and the offset at
+            which each message starts within it.
+        """
+        return self._dumps_batch((self._get_definition(key), data)
+                                 for key, data in messages)
+
+    def dumps_parallel(self, messages, executor=None, chunk_size=10000):
+        """
+        Dump a large list of messages in parallel, by splitting it into
+        chunks that are encoded by the workers of an executor. The encoded
+        chunks are joined into a single buffer, in the same order as the
+        messages, so the result is identical to dumps_batch.
+
+        With a :class:`concurrent.futures.ProcessPoolExecutor`, the schema and
+        each chunk of messages are pickled and sent to the worker processes.
+        The schema is pickled once, and each worker process only unpickles it
+        the first time it receives it, and reuses it for the rest of the
+        chunks. Definitions are compiled again when they are unpickled, so any
+        changes made to the definitions after they were defined are lost,
+        other than little_endian. Use dicts rather than records for the data,
+        as generated record classes can't be pickled.
+
+        :param messages: Sequence of (key, data) tuples to encode.
+        :param concurrent.futures.Executor executor: The executor to encode
+            the chunks with. If this is None, the chunks are encoded in the
+            current thread.
+        :param int chunk_size: The number of messages in each chunk.
+        :returns: tuple(bytearray, list(int)) of the buffer and the offset at
+            which each message starts within it.
+        """
+        if chunk_size < 1:
+            raise ValueError('invalid chunk size %r' % (chunk_size,))
+        chunks = [messages[i:i + chunk_size]
+                  for i in range(0, len(messages), chunk_size)]
+        reference = _SchemaReference(self)
+        if executor is None:
+            results = [_dumps_chunk(reference, chunk) for chunk in chunks]
+        else:
+            results = list(executor.map(_dumps_chunk,
+                                        itertools.repeat(reference), chunks))
+        buffer = bytearray(sum(len(chunk_buffer)
+                               for chunk_buffer, _ in results))
+        offsets = []
+        offset = 0
+        for chunk_buffer, chunk_offsets in results:
+            buffer[offset:offset + len(chunk_buffer)] = chunk_buffer
+            offsets.extend(chunk_offset + offset
+                           for chunk_offset in chunk_offsets)
+            offset += len(chunk_buffer)
+        return buffer, offsets
+
+    def _dumps_batch(self, messages):
+        """
+        Dump (definition, data) tuples into a single preallocated buffer.
+
+        Messages for fixed layout definitions are packed directly into the
+        buffer, along with their ids, so they don't allocate an intermediate
+        string. Other messages are encoded with their id prefixes and copied
+        into place.
+
+        :param messages: Iterable of (Definition, dict) tuples.
+        :returns: tuple(bytearray, list(int))
+        """
+        parts = []
+        size = 0
+        for definition, data in messages:
+            if definition.little_endian:
+                message_struct = definition._little_message_struct
+            else:
+                message_struct = definition._big_message_struct
+            if message_struct is not None:
+                body = definition._get_struct_values(data)
+                size += message_struct.size
+            else:
+                body = definition._dumps_message(data)
+                size += len(body)
+            parts.append((definition.id, message_struct, body))
+
+        buffer = bytearray(size)
+        offsets = []
+        offset = 0
+        for definition_id, message_struct, body in parts:
+            offsets.append(offset)
+            if message_struct is not None:
+                message_struct.pack_into(buffer, offset, definition_id, *body)
+                offset += message_struct.size
+            else:
+                buffer[offset:offset + len(body)] = body
+                offset += len(body)
+        return buffer, offsets
+
+    def loads(self, string, offset=0, fields=None):
         """
         Load a dict from a string.
 
         :param str string: A string encoded by a matching schema. This should
-            be a str object on Python 2, and a bytes object on Python 3.
-        :returns: dict
+            be a str object on Python 2, and a bytes object on Python 3. Any
+            object supporting the buffer protocol, such as a bytearray,
+            memoryview or mmap, can also be used.
+        :param int offset: Start decoding from this offset within the string.
+        :param fields: If passed, only the fields with these keys are decoded.
+            See :meth:`Definition.loads`.
+        :returns: dict, or an instance of the definition's record class.
+        :raises KeyError: If the id isn't defined in the schema, or one of the
+            fields isn't defined by the message's definition.
+        """
+        if fields is not None:
+            definition_id, offset = self.id_codec.loads_from(string, offset)
+            definition = self.definitions_by_id.get(definition_id)
+            if definition is None:
+                raise KeyError('id {!r} is not defined in schema'.format(
+                    definition_id))
+            return definition._loads_fields(string, offset, fields)
+        return self.loads_from(string, offset)[0]
+
+    def loads_from(self, string, offset=0):
+        """
+        Load a dict from a string, along with the offset just past the end of
+        the message. This can be used to walk through a buffer containing
+        several messages without slicing or copying it.
+
+        :param str string: A string encoded by a matching schema. This should
+            be a str object on Python 2, and a bytes object on Python 3. Any
+            object supporting the buffer protocol, such as a bytearray,
+            memoryview or mmap, can also be used.
+        :param int offset: Start decoding from this offset within the string.
+        :returns: tuple(dict, int)
         """
-        # FIXME: this should be able to take an offset.
-        id_codec = _codecs[self.id_type]
-        definition_id = id_codec.loads(string)
+        id_codec = self.id_codec
+        if _speedups is not None and not getattr(id_codec, 'converts', True):
+            return _speedups.loads_message(id_codec.format,
+                                           self.definitions_by_id, string,
+                                           offset)
+        definition_id, offset = id_codec.loads_from(string, offset)
         definition = self.definitions_by_id.get(definition_id)
         if definition is None:
             raise KeyError('id {!r} is not defined in schema'.format(
                 definition_id))
-        return definition.loads(string, id_codec.size)
+        return definition.loads_from(string, offset)
+
+    def decoder(self):
+        """
+        Create a decoder for a stream of messages encoded by this schema.
+
+        :returns: StreamDecoder
+        """
+        return StreamDecoder(self)
+
+
+class StreamDecoder(object):
+
+    """
+    A stream decoder incrementally decodes messages from a stream of
+    concatenated schema messages, such as the data read from a socket.
+    Chunks of any size can be fed to the decoder. Each complete message is
+    decoded as soon as all of its bytes have arrived, and any partial message
+    at the end of a chunk is buffered until the rest of it is fed.
+
+    When a partial message fails to decode, the decoder remembers how many
+    bytes the decode needed, and doesn't try again until that many bytes
+    have been buffered, so a large message fed in small chunks is only
+    decoded a few times.
+
+    :param Schema schema: The schema used to decode the messages.
+    """
+
+    def __init__(self, schema):
+        super(StreamDecoder, self).__init__()
+        self.schema = schema
+        self.buffer = bytearray()
+        self.needed = 0
+
+    @property
+    def pending(self):
+        """
+        The number of bytes buffered for a partially received message.
+        """
+        return len(self.buffer)
+
+    def feed(self, chunk):
+        """
+        Feed a chunk of data to the decoder.
+
+        :param bytes chunk: The next chunk of the stream. Any object supporting
+            the buffer protocol can be used. If no partial message is
+            buffered, messages are decoded straight from the chunk without
+            copying it.
+        :returns: list(dict) of the messages completed by this chunk.
+        :raises struct.error: If the stream contains an invalid message. A
+            message that has only partly arrived is buffered instead.
+        :raises KeyError: If the stream contains an id that is not defined in
+            the schema.
+        """
+        if self.buffer:
+            self.buffer += chunk
+            if len(self.buffer) < self.needed:
+                return []
+            string = self.buffer
+        else:
+            string = chunk
+        loads_from = self.schema.loads_from
+        messages = []
+        offset = 0
+        length = len(string)
+        self.needed = 0
+        while offset < length:
+            try:
+                value, offset_after = loads_from(string, offset)
+            except TruncatedError as error:
+                # The buffer ends partway through this message.
+                self.needed = error.size - offset
+                break
+            messages.append(value)
+            offset = offset_after
+        if string is self.buffer:
+            del self.buffer[:offset]
+        elif offset < length:
+            self.buffer = bytearray(string[offset:])
+        return messages
+
+
+#: Schemas that have been unpickled by _load_schema_reference, by token. Only
+#: the most recently used schemas are kept.
+_schema_references = collections.OrderedDict()
+_max_schema_references = 8
+
+
+class _SchemaReference(object):
+
+    """
+    Refers to a schema that is sent to worker processes by dumps_parallel.
+
+    The schema is pickled the first time the reference is pickled, and the
+    same pickled bytes are reused for every chunk. Worker processes cache the
+    unpickled schema by the token of the reference, so each worker only
+    unpickles the schema, and compiles its definitions, once.
+
+    :param Schema schema: The schema to refer to.
+    """
+
+    def __init__(self, schema, token=None):
+        super(_SchemaReference, self).__init__()
+        self.schema = schema
+        self.token = token or uuid.uuid4().hex
+        self._pickled_schema = None
+
+    def __reduce__(self):
+        if self._pickled_schema is None:
+            self._pickled_schema = pickle.dumps(self.schema,
+                                                pickle.HIGHEST_PROTOCOL)
+        return (_load_schema_reference, (self.token, self._pickled_schema))
+
+
+def _load_schema_reference(token, pickled_schema):
+    """
+    Unpickle a schema reference, reusing the schema if this process has
+    already unpickled it.
+
+    :param str token: The token of the reference.
+    :param bytes pickled_schema: The pickled schema.
+    :returns: _SchemaReference
+    """
+    reference = _schema_references.pop(token, None)
+    if reference is None:
+        reference = _SchemaReference(pickle.loads(pickled_schema), token)
+        while len(_schema_references) >= _max_schema_references:
+            _schema_references.popitem(last=False)
+    _schema_references[token] = reference
+    return reference
+
 
+def _dumps_chunk(reference, messages):
+    """
+    Dump a chunk of messages for Schema.dumps_parallel. This is a module level
+    function, so that it can be pickled and sent to worker processes.
+
+    :param _SchemaReference reference: The schema to encode the messages
+        with.
+    :param list messages: List of (key, data) tuples to encode.
+    :returns: tuple(bytes, list(int))
+    """
+    buffer, offsets = reference.schema.dumps_batch(messages)
+    return bytes(buffer), offsets
+
+
+def _load_definition(fields, id, key, little_endian, record, pack_booleans,
+                     codegen, id_type):
+    """
+    Recreate a pickled definition.
+
+    :param str id_type: The id type of the schema that the definition belongs
+        to, or None if it is standalone.
+    :returns: Definition
+    """
+    definition = Definition(fields, id, key, little_endian, record,
+                            pack_booleans)
+    if id_type is not None:
+        definition._set_id_codec(_codecs[id_type], codegen)
+    elif codegen:
+        definition.generate()
+    return definition
+
+
+def _load_schema(id_type, length_type, pack_booleans, codegen, definitions,
+                 next_definition_id):
+    """
+    Recreate a pickled schema.
+
+    :param str id_type: Field type to use for packet type ids, or None if it
+        is chosen automatically.
+    :param str length_type: Default length type for the schema.
+    :param bool pack_booleans: True if the schema packs booleans.
+    :param bool codegen: True if the schema generates code for definitions.
+    :param list(Definition) definitions: The unpickled definitions.
+    :param int next_definition_id: The id of the next definition.
+    :returns: Schema
+    """
+    schema = Schema(id_type, length_type, pack_booleans, codegen)
+    if definitions:
+        # Choose the id type up front, so that the definitions don't have to
+        # be prepared for a smaller id type first.
+        schema._grow_id_type(max(definition.id for definition in definitions))
+    for definition in definitions:
+        schema._add_definition(definition)
+    schema.next_definition_id = next_definition_id
+    return schema
+
+
+def _make_fields(field_kwargs, length_type, definitions=None):
+    """
+    Create field objects from a list of keyword argument dicts.
 
-def define(field_kwargs):
+    :param list(dict) field_kwargs: List of fields in the definition.
+    :param str length_type: Length type for fields that don't specify one.
+    :param dict definitions: Definitions that nested struct fields can refer
+        to by key.
+    :returns: list(Field)
+    """
+    fields = []
+    for kwargs in field_kwargs:
+        if 'length_type' not in kwargs:
+            kwargs = dict(kwargs, length_type=length_type)
+        definition = kwargs.get('definition')
+        if (definitions is not None and definition is not None and
+                not isinstance(definition, Definition)):
+            if definition not in definitions:
+                raise ValueError('definition {!r} is not defined in '
+                                 'schema'.format(definition))
+            kwargs = dict(kwargs, definition=definitions[definition])
+        fields.append(Field(**kwargs))
+    return fields
+
+
+def define(field_kwargs, record=False, length_type='uint32',
+           pack_booleans=False, codegen=False):
     """
     Create a new definition object.
 
     :param list(dict) field_kwargs: List of fields in the definition.
+    :param record: Type of object to decode messages into. See
+        :class:`Definition`.
+    :param str length_type: Default length type for array and string fields.
+    :param bool pack_booleans: If True, consecutive boolean fields are packed
+        into shared bytes. See :class:`Definition`.
+    :param bool codegen: If True, specialized functions are generated to
+        encode and decode the definition. See :meth:`Definition.generate`.
     :returns: Definition
     """
-    return Definition([Field(**kwargs) for kwargs in field_kwargs])
+    return Definition(_make_fields(field_kwargs, length_type), record=record,
+                      pack_booleans=pack_booleans, codegen=codegen)
@@ -0,0 +1,973 @@
+/*
+ * Optional C accelerator for jettison.
+ *
+ * This implements the inner loops of Definition.dumps, Definition.loads_from
+ * and Schema.loads_from. Each definition compiles a Plan from the same runs
+ * that the pure Python implementation uses:
+ *
+ * - Struct runs without any conversions are passed as (start, format, size)
+ *   tuples, and their values are packed and unpacked directly.
+ * - Any other run (variable length fields, bit groups, quantized values and
+ *   so on) is passed as the run object itself, and its dumps and loads_into
+ *   methods are called, exactly as the pure Python implementation would.
+ *
+ * The output is identical to the pure Python implementation, and errors are
+ * raised with the same exception types.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+#if PY_VERSION_HEX >= 0x030B0000
+#define pack_float4(x, p, le) PyFloat_Pack4((x), (char *)(p), (le))
+#define pack_float8(x, p, le) PyFloat_Pack8((x), (char *)(p), (le))
+#define unpack_float4(p, le) PyFloat_Unpack4((const char *)(p), (le))
+#define unpack_float8(p, le) PyFloat_Unpack8((const char *)(p), (le))
+#else
+#define pack_float4(x, p, le) _PyFloat_Pack4((x), (unsigned char *)(p), (le))
+#define pack_float8(x, p, le) _PyFloat_Pack8((x), (unsigned char *)(p), (le))
+#define unpack_float4(p, le) _PyFloat_Unpack4((const unsigned char *)(p), (le))
+#define unpack_float8(p, le) _PyFloat_Unpack8((const unsigned char *)(p), (le))
+#endif
+
+static PyObject *StructError = NULL;
+static PyObject *TruncatedError = NULL;
+static PyObject *str_dumps = NULL;
+static PyObject *str_loads_from = NULL;
+static PyObject *str_loads_into = NULL;
+static PyObject *str_little_endian = NULL;
+static PyObject *str_record_class = NULL;
+static PyObject *str_speedups_plan = NULL;
+
+/* A growable output buffer, which starts out on the stack. */
+typedef struct {
+    char *data;
+    Py_ssize_t size;
+    Py_ssize_t capacity;
+    char stack[256];
+} Output;
+
+static void
+output_init(Output *output)
+{
+    output->data = output->stack;
+    output->size = 0;
+    output->capacity = sizeof(output->stack);
+}
+
+static void
+output_free(Output *output)
+{
+    if (output->data != output->stack) {
+        PyMem_Free(output->data);
+    }
+}
+
+/* Reserve space for size more bytes and return a pointer to it. */
+static char *
+output_reserve(Output *output, Py_ssize_t size)
+{
+    Py_ssize_t capacity;
+    char *data;
+
+    if (output->size + size > output->capacity) {
+        capacity = output->capacity * 2;
+        while (capacity < output->size + size) {
+            capacity *= 2;
+        }
+        if (output->data == output->stack) {
+            data = PyMem_Malloc(capacity);
+            if (data != NULL) {
+                memcpy(data, output->stack, output->size);
+            }
+        } else {
+            data = PyMem_Realloc(output->data, capacity);
+        }
+        if (data == NULL) {
+            PyErr_NoMemory();
+            return NULL;
+        }
+        output->data = data;
+        output->capacity = capacity;
+    }
+    data = output->data + output->size;
+    output->size += size;
+    return data;
+}
+
+static Py_ssize_t
+format_size(char format)
+{
+    switch (format) {
+    case 'b': case 'B': case '?':
+        return 1;
+    case 'h': case 'H':
+        return 2;
+    case 'i': case 'I': case 'f':
+        return 4;
+    case 'd':
+        return 8;
+    default:
+        return -1;
+    }
+}
+
+static void
+write_int(char *p, unsigned long long value, Py_ssize_t size, int le)
+{
+    Py_ssize_t i;
+
+    if (le) {
+        for (i = 0; i < size; i++) {
+            p[i] = (char)(value & 0xff);
+            value >>= 8;
+        }
+    } else {
+        for (i = size - 1; i >= 0; i--) {
+            p[i] = (char)(value & 0xff);
+            value >>= 8;
+        }
+    }
+}
+
+static unsigned long long
+read_int(const unsigned char *p, Py_ssize_t size, int le)
+{
+    unsigned long long value = 0;
+    Py_ssize_t i;
+
+    if (le) {
+        for (i = size - 1; i >= 0; i--) {
+            value = (value << 8) | p[i];
+        }
+    } else {
+        for (i = 0; i < size; i++) {
+            value = (value << 8) | p[i];
+        }
+    }
+    return value;
+}
+
+/* Pack a single value, raising struct.error like the struct module. */
+static int
+pack_value(char *p, char format, PyObject *value, int le)
+{
+    Py_ssize_t size = format_size(format);
+    long long min, max, number;
+    PyObject *index;
+    double real;
+    int truth, overflow;
+
+    switch (format) {
+    case '?':
+        truth = PyObject_IsTrue(value);
+        if (truth < 0) {
+            return -1;
+        }
+        *p = (char)truth;
+        return 0;
+    case 'f':
+    case 'd':
+        real = PyFloat_AsDouble(value);
+        if (real == -1.0 && PyErr_Occurred()) {
+            if (PyErr_ExceptionMatches(PyExc_TypeError)) {
+                PyErr_SetString(StructError,
+                                "required argument is not a float");
+            }
+            return -1;
+        }
+        if (format == 'f') {
+            return pack_float4(real, p, le);
+        }
+        return pack_float8(real, p, le);
+    case 'b':
+    case 'h':
+    case 'i':
+        min = -(1LL << (size * 8 - 1));
+        max = (1LL << (size * 8 - 1)) - 1;
+        break;
+    default:
+        min = 0;
+        max = (1LL << (size * 8)) - 1;
+        break;
+    }
+    index = PyNumber_Index(value);
+    if (index == NULL) {
+        if (PyErr_ExceptionMatches(PyExc_TypeError)) {
+            PyErr_SetString(StructError,
+                            "required argument is not an integer");
+        }
+        return -1;
+    }
+    number = PyLong_AsLongLongAndOverflow(index, &overflow);
+    Py_DECREF(index);
+    if (number == -1 && PyErr_Occurred()) {
+        return -1;
+    }
+    if (overflow || number < min || number > max) {
+        PyErr_Format(StructError, "'%c' format requires %lld <= number <= "
+                     "%lld", format, min, max);
+        return -1;
+    }
+    write_int(p, (unsigned long long)number, size, le);
+    return 0;
+}
+
+static PyObject *
+unpack_value(const unsigned char *p, char format, int le)
+{
+    Py_ssize_t size = format_size(format);
+    unsigned long long number;
+    double real;
+
+    switch (format) {
+    case '?':
+        return PyBool_FromLong(*p != 0);
+    case 'f':
+    case 'd':
+        real = format == 'f' ? unpack_float4(p, le) : unpack_float8(p, le);
+        if (real == -1.0 && PyErr_Occurred()) {
+            return NULL;
+        }
+        return PyFloat_FromDouble(real);
+    }
+    number = read_int(p, size, le);
+    switch (format) {
+    case 'b':
+        return PyLong_FromLong((int8_t)number);
+    case 'h':
+        return PyLong_FromLong((int16_t)number);
+    case 'i':
+        return PyLong_FromLong((int32_t)number);
+    default:
+        return PyLong_FromUnsignedLongLong(number);
+    }
+}
+
+/*
+ * Raise jettison.TruncatedError. The class is looked up the first time it is
+ * needed, as this module is imported while jettison is still being imported.
+ */
+static PyObject *
+truncated_error(Py_ssize_t offset, Py_ssize_t size, Py_ssize_t length)
+{
+    PyObject *error;
+
+    if (TruncatedError == NULL) {
+        PyObject *jettison = PyImport_ImportModule("jettison");
+        if (jettison == NULL) {
+            return NULL;
+        }
+        TruncatedError = PyObject_GetAttrString(jettison, "TruncatedError");
+        Py_DECREF(jettison);
+        if (TruncatedError == NULL) {
+            return NULL;
+        }
+    }
+    error = PyObject_CallFunction(
+        TruncatedError, "Nn", PyUnicode_FromFormat(
+            "unpack_from requires a buffer of at least %zd bytes for "
+            "unpacking %zd bytes at offset %zd (actual buffer size is %zd)",
+            offset + size, size, offset, length), offset + size);
+    if (error != NULL) {
+        PyErr_SetObject(TruncatedError, error);
+        Py_DECREF(error);
+    }
+    return NULL;
+}
+
+/*
+ * A step is a run of a definition. Native steps are struct runs that are
+ * packed and unpacked directly, and have a NULL run. Other steps call the
+ * methods of their run object.
+ */
+typedef struct {
+    PyObject *run;
+    Py_ssize_t start;
+    Py_ssize_t stop;
+    Py_ssize_t size;
+} Step;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *keys;
+    Py_ssize_t field_count;
+    char *formats;
+    Step *steps;
+    Py_ssize_t step_count;
+    int native;
+    Py_ssize_t size;
+} PlanObject;
+
+static int
+plan_traverse(PlanObject *self, visitproc visit, void *arg)
+{
+    Py_ssize_t i;
+
+    Py_VISIT(self->keys);
+    for (i = 0; i < self->step_count; i++) {
+        Py_VISIT(self->steps[i].run);
+    }
+    return 0;
+}
+
+static int
+plan_clear(PlanObject *self)
+{
+    Py_ssize_t i;
+
+    Py_CLEAR(self->keys);
+    for (i = 0; i < self->step_count; i++) {
+        Py_CLEAR(self->steps[i].run);
+    }
+    return 0;
+}
+
+static void
+plan_dealloc(PlanObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    plan_clear(self);
+    PyMem_Free(self->formats);
+    PyMem_Free(self->steps);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *
+plan_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"runs", "keys", NULL};
+    PyObject *runs, *keys, *run;
+    PlanObject *self;
+    Py_ssize_t i, j, length, size, start;
+    const char *format;
+    Step *step;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!O!:Plan", kwlist,
+                                     &PyTuple_Type, &runs, &PyTuple_Type,
+                                     &keys)) {
+        return NULL;
+    }
+    self = (PlanObject *)type->tp_alloc(type, 0);
+    if (self == NULL) {
+        return NULL;
+    }
+    Py_INCREF(keys);
+    self->keys = keys;
+    self->field_count = PyTuple_GET_SIZE(keys);
+    self->formats = PyMem_Calloc(self->field_count + 1, 1);
+    self->steps = PyMem_Calloc(PyTuple_GET_SIZE(runs) + 1, sizeof(Step));
+    if (self->formats == NULL || self->steps == NULL) {
+        PyErr_NoMemory();
+        goto error;
+    }
+    self->native = 1;
+    self->size = 0;
+    for (i = 0; i < PyTuple_GET_SIZE(runs); i++) {
+        run = PyTuple_GET_ITEM(runs, i);
+        step = &self->steps[self->step_count++];
+        if (!PyTuple_Check(run)) {
+            Py_INCREF(run);
+            step->run = run;
+            self->native = 0;
+            continue;
+        }
+        if (!PyArg_ParseTuple(run, "ns#n:Plan", &start, &format, &length,
+                              &size)) {
+            goto error;
+        }
+        if (start < 0 || start + length > self->field_count) {
+            PyErr_SetString(PyExc_ValueError, "invalid run");
+            goto error;
+        }
+        step->start = start;
+        step->stop = start + length;
+        step->size = 0;
+        for (j = 0; j < length; j++) {
+            if (format_size(format[j]) < 0) {
+                PyErr_Format(PyExc_ValueError, "unsupported format %R",
+                             PyTuple_GET_ITEM(run, 1));
+                goto error;
+            }
+            self->formats[start + j] = format[j];
+            step->size += format_size(format[j]);
+        }
+        if (step->size != size) {
+            PyErr_SetString(PyExc_ValueError, "invalid run size");
+            goto error;
+        }
+        self->size += size;
+    }
+    return (PyObject *)self;
+
+error:
+    Py_DECREF(self);
+    return NULL;
+}
+
+/* Get the value of a field from a data dict or record, as a new reference. */
+static PyObject *
+get_value(PyObject *data, PyObject *key, int is_record)
+{
+    PyObject *value;
+
+    if (is_record) {
+        return PyObject_GetAttr(data, key);
+    } else if (PyDict_CheckExact(data)) {
+        value = PyDict_GetItemWithError(data, key);
+        if (value == NULL) {
+            if (!PyErr_Occurred()) {
+                PyErr_SetObject(PyExc_KeyError, key);
+            }
+            return NULL;
+        }
+        Py_INCREF(value);
+        return value;
+    }
+    return PyObject_GetItem(data, key);
+}
+
+static int
+is_record(PyObject *data, PyObject *record_class)
+{
+    if (record_class == Py_None || PyDict_CheckExact(data)) {
+        return 0;
+    }
+    return PyObject_IsInstance(data, record_class);
+}
+
+static int
+pack_step(PlanObject *self, char *p, Py_ssize_t start, Py_ssize_t stop,
+          PyObject *data, PyObject *values, int record, int le)
+{
+    PyObject *value;
+    Py_ssize_t i;
+    int result;
+
+    for (i = start; i < stop; i++) {
+        if (values != NULL) {
+            value = PyList_GET_ITEM(values, i);
+            Py_INCREF(value);
+        } else {
+            value = get_value(data, PyTuple_GET_ITEM(self->keys, i), record);
+            if (value == NULL) {
+                return -1;
+            }
+        }
+        result = pack_value(p, self->formats[i], value, le);
+        Py_DECREF(value);
+        if (result < 0) {
+            return -1;
+        }
+        p += format_size(self->formats[i]);
+    }
+    return 0;
+}
+
+PyDoc_STRVAR(plan_dumps_doc,
+"dumps(data, record_class, little_endian[, prefix]) -> bytes\n\n"
+"Encode a data dict or record, optionally after a prefix, such as the id\n"
+"of the definition.");
+
+static PyObject *
+plan_dumps(PlanObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    PyObject *data, *record_class, *little_endian, *values, *string;
+    const char *prefix = NULL;
+    Py_ssize_t i, prefix_size = 0;
+    Output output;
+    Step *step;
+    char *p;
+    int record, le;
+
+    if (nargs != 3 && nargs != 4) {
+        PyErr_SetString(PyExc_TypeError, "dumps takes 3 or 4 arguments");
+        return NULL;
+    }
+    data = args[0];
+    record_class = args[1];
+    little_endian = args[2];
+    if (nargs == 4 && args[3] != Py_None) {
+        if (!PyBytes_Check(args[3])) {
+            PyErr_SetString(PyExc_TypeError, "prefix must be bytes");
+            return NULL;
+        }
+        prefix = PyBytes_AS_STRING(args[3]);
+        prefix_size = PyBytes_GET_SIZE(args[3]);
+    }
+    le = PyObject_IsTrue(little_endian);
+    record = le < 0 ? -1 : is_record(data, record_class);
+    if (record < 0) {
+        return NULL;
+    }
+
+    if (self->native) {
+        string = PyBytes_FromStringAndSize(NULL, prefix_size + self->size);
+        if (string == NULL) {
+            return NULL;
+        }
+        p = PyBytes_AS_STRING(string);
+        if (prefix_size) {
+            memcpy(p, prefix, prefix_size);
+        }
+        if (pack_step(self, p + prefix_size, 0, self->field_count, data,
+                      NULL, record, le) < 0) {
+            Py_DECREF(string);
+            return NULL;
+        }
+        return string;
+    }
+
+    values = PyList_New(self->field_count);
+    if (values == NULL) {
+        return NULL;
+    }
+    for (i = 0; i < self->field_count; i++) {
+        PyObject *value = get_value(data, PyTuple_GET_ITEM(self->keys, i),
+                                    record);
+        if (value == NULL) {
+            Py_DECREF(values);
+            return NULL;
+        }
+        PyList_SET_ITEM(values, i, value);
+    }
+    output_init(&output);
+    if (prefix_size) {
+        p = output_reserve(&output, prefix_size);
+        if (p == NULL) {
+            goto error;
+        }
+        memcpy(p, prefix, prefix_size);
+    }
+    for (i = 0; i < self->step_count; i++) {
+        step = &self->steps[i];
+        if (step->run == NULL) {
+            p = output_reserve(&output, step->size);
+            if (p == NULL || pack_step(self, p, step->start, step->stop,
+                                       data, values, record, le) < 0) {
+                goto error;
+            }
+            continue;
+        }
+        string = PyObject_CallMethodObjArgs(step->run, str_dumps, values,
+                                            le ? Py_True : Py_False, NULL);
+        if (string == NULL) {
+            goto error;
+        }
+        if (!PyBytes_Check(string)) {
+            PyErr_SetString(PyExc_TypeError, "run must dump bytes");
+            Py_DECREF(string);
+            goto error;
+        }
+        p = output_reserve(&output, PyBytes_GET_SIZE(string));
+        if (p != NULL) {
+            memcpy(p, PyBytes_AS_STRING(string), PyBytes_GET_SIZE(string));
+        }
+        Py_DECREF(string);
+        if (p == NULL) {
+            goto error;
+        }
+    }
+    Py_DECREF(values);
+    string = PyBytes_FromStringAndSize(output.data, output.size);
+    output_free(&output);
+    return string;
+
+error:
+    Py_DECREF(values);
+    output_free(&output);
+    return NULL;
+}
+
+/* Unpack the fields of a native step into values, which may be a dict. */
+static int
+unpack_step(PlanObject *self, const unsigned char *p, Py_ssize_t start,
+            Py_ssize_t stop, PyObject *values, int le)
+{
+    PyObject *value;
+    Py_ssize_t i;
+    int result;
+
+    for (i = start; i < stop; i++) {
+        value = unpack_value(p, self->formats[i], le);
+        if (value == NULL) {
+            return -1;
+        }
+        if (PyDict_CheckExact(values)) {
+            result = PyDict_SetItem(values, PyTuple_GET_ITEM(self->keys, i),
+                                    value);
+            Py_DECREF(value);
+        } else if (PyTuple_CheckExact(values)) {
+            PyTuple_SET_ITEM(values, i, value);
+            result = 0;
+        } else {
+            result = PyList_Append(values, value);
+            Py_DECREF(value);
+        }
+        if (result < 0) {
+            return -1;
+        }
+        p += format_size(self->formats[i]);
+    }
+    return 0;
+}
+
+static PyObject *
+make_value(PlanObject *self, PyObject *record_class, PyObject *values)
+{
+    PyObject *value, *items;
+    Py_ssize_t i;
+
+    if (record_class != Py_None) {
+        items = PyList_AsTuple(values);
+        if (items == NULL) {
+            return NULL;
+        }
+        value = PyObject_Call(record_class, items, NULL);
+        Py_DECREF(items);
+        return value;
+    }
+    value = PyDict_New();
+    if (value == NULL) {
+        return NULL;
+    }
+    for (i = 0; i < self->field_count; i++) {
+        if (PyDict_SetItem(value, PyTuple_GET_ITEM(self->keys, i),
+                           PyList_GET_ITEM(values, i)) < 0) {
+            Py_DECREF(value);
+            return NULL;
+        }
+    }
+    return value;
+}
+
+static PyObject *
+plan_loads(PlanObject *self, PyObject *string, Py_ssize_t offset,
+           PyObject *record_class, int le)
+{
+    PyObject *values = NULL, *value, *result, *position;
+    Py_buffer view;
+    Py_ssize_t i;
+    Step *step;
+
+    if (PyObject_GetBuffer(string, &view, PyBUF_SIMPLE) < 0) {
+        return NULL;
+    }
+    if (offset < 0) {
+        if (offset + view.len < 0) {
+            PyErr_Format(StructError, "offset %zd out of range for %zd-byte "
+                         "buffer", offset, view.len);
+            goto error;
+        }
+        offset += view.len;
+    }
+
+    if (self->native) {
+        if (view.len - offset < self->size) {
+            truncated_error(offset, self->size, view.len);
+            goto error;
+        }
+        if (record_class != Py_None) {
+            values = PyTuple_New(self->field_count);
+        } else {
+            values = PyDict_New();
+        }
+        if (values == NULL ||
+                unpack_step(self, (const unsigned char *)view.buf + offset, 0,
+                            self->field_count, values, le) < 0) {
+            goto error;
+        }
+        PyBuffer_Release(&view);
+        if (record_class != Py_None) {
+            value = PyObject_Call(record_class, values, NULL);
+            Py_DECREF(values);
+            values = value;
+            if (values == NULL) {
+                return NULL;
+            }
+        }
+        return Py_BuildValue("(Nn)", values, offset + self->size);
+    }
+
+    values = PyList_New(0);
+    if (values == NULL) {
+        goto error;
+    }
+    for (i = 0; i < self->step_count; i++) {
+        step = &self->steps[i];
+        if (step->run == NULL) {
+            if (view.len - offset < step->size) {
+                truncated_error(offset, step->size, view.len);
+                goto error;
+            }
+            if (unpack_step(self, (const unsigned char *)view.buf + offset,
+                            step->start, step->stop, values, le) < 0) {
+                goto error;
+            }
+            offset += step->size;
+            continue;
+        }
+        position = PyLong_FromSsize_t(offset);
+        if (position == NULL) {
+            goto error;
+        }
+        result = PyObject_CallMethodObjArgs(step->run, str_loads_into, values,
+                                            string, position,
+                                            le ? Py_True : Py_False, NULL);
+        Py_DECREF(position);
+        if (result == NULL) {
+            goto error;
+        }
+        offset = PyLong_AsSsize_t(result);
+        Py_DECREF(result);
+        if (offset == -1 && PyErr_Occurred()) {
+            goto error;
+        }
+    }
+    PyBuffer_Release(&view);
+    value = make_value(self, record_class, values);
+    Py_DECREF(values);
+    if (value == NULL) {
+        return NULL;
+    }
+    return Py_BuildValue("(Nn)", value, offset);
+
+error:
+    PyBuffer_Release(&view);
+    Py_XDECREF(values);
+    return NULL;
+}
+
+PyDoc_STRVAR(plan_loads_from_doc,
+"loads_from(string, offset, record_class, little_endian) -> (value, offset)"
+"\n\n"
+"Decode a data dict or record, along with the offset just past the end of\n"
+"the encoded message.");
+
+static PyObject *
+plan_loads_from(PlanObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    Py_ssize_t offset;
+    int le;
+
+    if (nargs != 4) {
+        PyErr_SetString(PyExc_TypeError, "loads_from takes 4 arguments");
+        return NULL;
+    }
+    offset = PyNumber_AsSsize_t(args[1], PyExc_OverflowError);
+    if (offset == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    le = PyObject_IsTrue(args[3]);
+    if (le < 0) {
+        return NULL;
+    }
+    return plan_loads(self, args[0], offset, args[2], le);
+}
+
+static PyMethodDef plan_methods[] = {
+    {"dumps", (PyCFunction)(void (*)(void))plan_dumps, METH_FASTCALL,
+     plan_dumps_doc},
+    {"loads_from", (PyCFunction)(void (*)(void))plan_loads_from,
+     METH_FASTCALL, plan_loads_from_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+PyDoc_STRVAR(plan_doc,
+"Plan(runs, keys)\n\n"
+"The compiled runs of a definition. Each run is either a (start, format,\n"
+"size) tuple for a struct run that can be packed directly, or a run object\n"
+"with dumps and loads_into methods.");
+
+static PyTypeObject PlanType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "jettison._speedups.Plan",
+    .tp_basicsize = sizeof(PlanObject),
+    .tp_dealloc = (destructor)plan_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_doc = plan_doc,
+    .tp_traverse = (traverseproc)plan_traverse,
+    .tp_clear = (inquiry)plan_clear,
+    .tp_methods = plan_methods,
+    .tp_new = plan_new,
+};
+
+PyDoc_STRVAR(loads_message_doc,
+"loads_message(id_format, definitions_by_id, string, offset)"
+" -> (value, offset)\n\n"
+"Decode the big endian id of a schema message, then decode the message\n"
+"with the definition that has that id.");
+
+static PyObject *
+speedups_loads_message(PyObject *module, PyObject *const *args,
+                       Py_ssize_t nargs)
+{
+    PyObject *id_format, *definitions_by_id, *string, *id, *definition;
+    PyObject *plan = NULL, *record_class = NULL, *little_endian = NULL;
+    PyObject *end, *result = NULL;
+    Py_ssize_t offset, size, length;
+    const char *format;
+    Py_buffer view;
+    int le;
+
+    if (nargs != 4 || !PyDict_Check(args[1])) {
+        PyErr_SetString(PyExc_TypeError, "loads_message takes 4 arguments");
+        return NULL;
+    }
+    id_format = args[0];
+    definitions_by_id = args[1];
+    string = args[2];
+    offset = PyNumber_AsSsize_t(args[3], PyExc_OverflowError);
+    if (offset == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    format = PyUnicode_AsUTF8AndSize(id_format, &length);
+    if (format == NULL) {
+        return NULL;
+    }
+    size = format_size(format[0]);
+    if (length != 1 || size < 0) {
+        PyErr_Format(PyExc_ValueError, "invalid id format %R", id_format);
+        return NULL;
+    }
+    if (PyObject_GetBuffer(string, &view, PyBUF_SIMPLE) < 0) {
+        return NULL;
+    }
+    if (offset < 0) {
+        offset += view.len;
+    }
+    if (offset < 0 || view.len - offset < size) {
+        truncated_error(offset, size, view.len);
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    id = unpack_value((const unsigned char *)view.buf + offset, format[0], 0);
+    PyBuffer_Release(&view);
+    if (id == NULL) {
+        return NULL;
+    }
+    definition = PyDict_GetItemWithError(definitions_by_id, id);
+    if (definition == NULL) {
+        if (!PyErr_Occurred()) {
+            PyObject *message = PyUnicode_FromFormat(
+                "id %R is not defined in schema", id);
+            if (message != NULL) {
+                PyErr_SetObject(PyExc_KeyError, message);
+                Py_DECREF(message);
+            }
+        }
+        Py_DECREF(id);
+        return NULL;
+    }
+    Py_DECREF(id);
+    Py_INCREF(definition);
+    offset += size;
+
+    /*
+     * Definitions that have a plan, and haven't been replaced by generated
+     * code, are decoded directly. Otherwise, call their loads_from method.
+     */
+    plan = PyObject_GetAttr(definition, str_speedups_plan);
+    if (plan == NULL) {
+        goto done;
+    }
+    if (Py_TYPE(plan) == &PlanType) {
+        PyObject *instance_dict = PyObject_GenericGetDict(definition, NULL);
+        int overridden;
+        if (instance_dict == NULL) {
+            goto done;
+        }
+        overridden = PyDict_Contains(instance_dict, str_loads_from);
+        Py_DECREF(instance_dict);
+        if (overridden < 0) {
+            goto done;
+        }
+        if (!overridden) {
+            record_class = PyObject_GetAttr(definition, str_record_class);
+            little_endian = PyObject_GetAttr(definition, str_little_endian);
+            if (record_class == NULL || little_endian == NULL) {
+                goto done;
+            }
+            le = PyObject_IsTrue(little_endian);
+            if (le >= 0) {
+                result = plan_loads((PlanObject *)plan, string, offset,
+                                    record_class, le);
+            }
+            goto done;
+        }
+    }
+    end = PyLong_FromSsize_t(offset);
+    if (end != NULL) {
+        result = PyObject_CallMethodObjArgs(definition, str_loads_from,
+                                            string, end, NULL);
+        Py_DECREF(end);
+    }
+
+done:
+    Py_XDECREF(plan);
+    Py_XDECREF(record_class);
+    Py_XDECREF(little_endian);
+    Py_DECREF(definition);
+    return result;
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"loads_message", (PyCFunction)(void (*)(void))speedups_loads_message,
+     METH_FASTCALL, loads_message_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    "jettison._speedups",
+    "C accelerator for jettison. See jettison/_speedups.c.",
+    -1,
+    speedups_methods,
+    NULL,
+    NULL,
+    NULL,
+    NULL
+};
+
+PyMODINIT_FUNC
+PyInit__speedups(void)
+{
+    PyObject *module, *struct_module;
+
+    if (PyType_Ready(&PlanType) < 0) {
+        return NULL;
+    }
+    struct_module = PyImport_ImportModule("struct");
+    if (struct_module == NULL) {
+        return NULL;
+    }
+    StructError = PyObject_GetAttrString(struct_module, "error");
+    Py_DECREF(struct_module);
+    if (StructError == NULL) {
+        return NULL;
+    }
+    str_dumps = PyUnicode_InternFromString("dumps");
+    str_loads_from = PyUnicode_InternFromString("loads_from");
+    str_loads_into = PyUnicode_InternFromString("loads_into");
+    str_little_endian = PyUnicode_InternFromString("little_endian");
+    str_record_class = PyUnicode_InternFromString("record_class");
+    str_speedups_plan = PyUnicode_InternFromString("_speedups_plan");
+    if (str_dumps == NULL || str_loads_from == NULL ||
+            str_loads_into == NULL || str_little_endian == NULL ||
+            str_record_class == NULL || str_speedups_plan == NULL) {
+        return NULL;
+    }
+    module = PyModule_Create(&speedups_module);
+    if (module == NULL) {
+        return NULL;
+    }
+    Py_INCREF(&PlanType);
+    if (PyModule_AddObject(module, "Plan", (PyObject *)&PlanType) < 0) {
+        Py_DECREF(&PlanType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
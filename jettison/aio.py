@@ -0,0 +1,198 @@
+"""
+asyncio support for Jettison schemas.
+
+This module wraps a :class:`jettison.Schema` around an asyncio stream pair.
+Messages are decoded from a :class:`asyncio.StreamReader` as they arrive:
+
+    >>> reader, writer = await jettison.aio.open_connection(schema, host, port)
+    >>> async for message in reader:
+    ...     print(message)
+
+and encoded to a :class:`asyncio.StreamWriter`. Messages written during the
+same event loop iteration are coalesced into a single write to the transport:
+
+    >>> for entity in entities:
+    ...     writer.write('position', entity)
+    >>> await writer.drain()
+
+Pass a :class:`jettison.compression.Compression` to compress the stream.
+Each batch of coalesced messages is sent as a single frame.
+
+This module requires Python 3.7 or later.
+"""
+
+import asyncio
+import collections
+
+
+class SchemaReader(object):
+
+    """
+    Decodes schema messages from an asyncio stream reader.
+
+    Instances are asynchronous iterators, yielding each decoded message dict
+    in the order it was received, and stopping at the end of the stream.
+
+    :param jettison.Schema schema: The schema used to decode the messages.
+    :param asyncio.StreamReader reader: The stream to read from.
+    :param int chunk_size: The maximum number of bytes to read at a time.
+    :param jettison.compression.Compression compression: If passed, the
+        stream is decoded as compressed frames.
+    """
+
+    def __init__(self, schema, reader, chunk_size=65536, compression=None):
+        super(SchemaReader, self).__init__()
+        self.schema = schema
+        self.reader = reader
+        self.chunk_size = chunk_size
+        if compression is not None:
+            self.decoder = compression.decoder(schema)
+        else:
+            self.decoder = schema.decoder()
+        self.messages = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.read()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def read(self):
+        """
+        Read the next message from the stream.
+
+        :returns: dict, or None if the stream has ended.
+        :raises asyncio.IncompleteReadError: If the stream ends partway
+            through a message.
+        """
+        while not self.messages:
+            chunk = await self.reader.read(self.chunk_size)
+            if not chunk:
+                if self.decoder.pending:
+                    partial = bytes(self.decoder.buffer)
+                    raise asyncio.IncompleteReadError(partial, None)
+                return None
+            self.messages.extend(self.decoder.feed(chunk))
+        return self.messages.popleft()
+
+
+class SchemaWriter(object):
+
+    """
+    Encodes schema messages to an asyncio stream writer.
+
+    Messages are encoded as soon as they are written, so encoding errors are
+    raised to the caller, but they are buffered until the end of the current
+    event loop iteration, and then passed to the transport with a single
+    write call.
+
+    :param jettison.Schema schema: The schema used to encode the messages.
+    :param asyncio.StreamWriter writer: The stream to write to.
+    :param jettison.compression.Compression compression: If passed, each
+        write to the transport is compressed as a single frame.
+    """
+
+    def __init__(self, schema, writer, compression=None):
+        super(SchemaWriter, self).__init__()
+        self.schema = schema
+        self.writer = writer
+        self.compression = compression
+        self.buffer = bytearray()
+        self._flush_handle = None
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_soon(self.flush)
+
+    def write(self, key, data):
+        """
+        Encode a message and queue it to be written.
+
+        :param str key: Name of the definition.
+        :param dict data: Data dict to encode.
+        """
+        self.buffer += self.schema.dumps(key, data)
+        self._schedule_flush()
+
+    def write_many(self, key, items):
+        """
+        Encode many messages of the same definition and queue them to be
+        written.
+
+        :param str key: Name of the definition.
+        :param items: Iterable of data dicts to encode.
+        """
+        buffer, _ = self.schema.dumps_many(key, items)
+        self.buffer += buffer
+        self._schedule_flush()
+
+    def flush(self):
+        """
+        Pass any queued messages to the transport immediately.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self.buffer:
+            buffer, self.buffer = self.buffer, bytearray()
+            if self.compression is not None:
+                buffer = self.compression.compress(buffer)
+            self.writer.write(buffer)
+
+    async def drain(self):
+        """
+        Flush any queued messages, then wait until it is appropriate to
+        resume writing to the stream.
+        """
+        self.flush()
+        await self.writer.drain()
+
+    def close(self):
+        """
+        Flush any queued messages and close the stream.
+        """
+        self.flush()
+        self.writer.close()
+
+    async def wait_closed(self):
+        """
+        Wait until the stream is closed.
+        """
+        await self.writer.wait_closed()
+
+
+def wrap(schema, reader, writer, chunk_size=65536, compression=None):
+    """
+    Wrap a schema around an existing pair of asyncio streams.
+
+    :param jettison.Schema schema: The schema used to encode and decode
+        messages.
+    :param asyncio.StreamReader reader: The stream to read from.
+    :param asyncio.StreamWriter writer: The stream to write to.
+    :param int chunk_size: The maximum number of bytes to read at a time.
+    :param jettison.compression.Compression compression: If passed, both
+        streams are compressed.
+    :returns: tuple(SchemaReader, SchemaWriter)
+    """
+    return (SchemaReader(schema, reader, chunk_size, compression),
+            SchemaWriter(schema, writer, compression))
+
+
+async def open_connection(schema, host=None, port=None, compression=None,
+                          **kwargs):
+    """
+    Open a connection with :func:`asyncio.open_connection` and wrap a schema
+    around it. Extra keyword arguments are passed to asyncio.
+
+    :param jettison.Schema schema: The schema used to encode and decode
+        messages.
+    :param jettison.compression.Compression compression: If passed, both
+        streams are compressed.
+    :returns: tuple(SchemaReader, SchemaWriter)
+    """
+    reader, writer = await asyncio.open_connection(host, port, **kwargs)
+    return wrap(schema, reader, writer, compression=compression)
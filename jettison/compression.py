@@ -0,0 +1,304 @@
+"""
+Compression for streams of Jettison schema messages.
+
+Schema messages are already compact, but messages with string fields, such
+as chat messages or item names, tend to repeat the same substrings over and
+over. Each message or batch of messages is too short for zlib to find much
+repetition within it, so zlib is primed with a preset dictionary, trained
+from a sample of encoded messages, which both ends of the stream share:
+
+    >>> samples = [schema.dumps(key, data) for key, data in recorded]
+    >>> dictionary = jettison.compression.train_dictionary(samples)
+    >>> compression = jettison.compression.Compression(dictionary)
+
+The stream is split into frames. Each frame holds one or more complete
+messages, and starts with a type byte and the length of the frame's data as
+a varint. Frames smaller than the compression threshold, or that don't get any
+smaller when compressed, are sent as they are:
+
+    >>> frame = compression.dumps_batch(schema, messages)
+    >>> decoder = compression.decoder(schema)
+    >>> decoder.feed(frame)
+
+Compressed frames are raw deflate streams, so they don't include the zlib
+header or checksum, and each frame can be decompressed independently of the
+others. The dictionary itself is never sent, so both ends must be configured
+with exactly the same dictionary. Frames are limited to max_payload_size
+bytes, and the decoder rejects any frame that claims or decompresses to more,
+so a peer can't make it buffer or inflate an unbounded amount of data.
+"""
+
+import collections
+import zlib
+
+import six
+
+import jettison
+
+
+#: Frame type for payloads that are sent uncompressed.
+RAW = 0
+
+#: Frame type for payloads that are compressed with deflate.
+DEFLATE = 1
+
+_frame_length_codec = jettison.VarintCodec()
+
+
+def train_dictionary(samples, size=16384, segment_size=8):
+    """
+    Train a preset dictionary from sample encoded messages.
+
+    Every substring of segment_size bytes is counted once for each sample
+    that contains it, and the substrings that occur in the most samples are
+    added to the dictionary, with overlapping substrings merged back into the
+    longer strings they came from. Deflate finds matches near the end of the
+    dictionary most cheaply, so the most common strings are placed last.
+
+    :param samples: Iterable of encoded messages, or batches of messages.
+    :param int size: The maximum size of the dictionary, in bytes. zlib only
+        uses the last 32KB of a dictionary.
+    :param int segment_size: Length of the substrings that are counted.
+    :returns: bytes
+    """
+    if segment_size < 3:
+        raise ValueError('invalid segment size %r' % (segment_size,))
+    counts = collections.Counter()
+    for sample in samples:
+        sample = bytes(sample)
+        counts.update(set(sample[i:i + segment_size]
+                          for i in range(len(sample) - segment_size + 1)))
+
+    pieces = []
+    by_prefix = {}
+    by_suffix = {}
+    total = 0
+    for segment, count in counts.most_common():
+        if count < 2 or total >= size:
+            break
+        head = segment[:-1]
+        tail = segment[1:]
+        if head in by_suffix:
+            # The segment continues a piece, so extend it by one byte.
+            i = by_suffix.pop(head)
+            pieces[i] += segment[-1:]
+            by_suffix[tail] = i
+            total += 1
+        elif tail in by_prefix:
+            i = by_prefix.pop(tail)
+            pieces[i][:0] = segment[:1]
+            by_prefix[head] = i
+            total += 1
+        else:
+            by_prefix[head] = by_suffix[tail] = len(pieces)
+            pieces.append(bytearray(segment))
+            total += segment_size
+    return bytes(b''.join(reversed(pieces))[-size:])
+
+
+class Compression(object):
+
+    """
+    Compresses and decompresses frames of schema messages.
+
+    :param bytes dictionary: Optional preset dictionary, such as one returned
+        by :func:`train_dictionary`.
+    :param int threshold: Payloads smaller than this many bytes are sent
+        uncompressed, as they rarely compress enough to be worth the time.
+    :param int level: The zlib compression level, from 0 to 9, or -1 for the
+        zlib default.
+    :param int max_payload_size: The largest payload of a frame, in bytes,
+        either before or after it is decompressed.
+    """
+
+    def __init__(self, dictionary=None, threshold=32, level=6,
+                 max_payload_size=16777216):
+        super(Compression, self).__init__()
+        if not -1 <= level <= 9:
+            raise ValueError('invalid compression level %r' % (level,))
+        if threshold < 0:
+            raise ValueError('invalid threshold %r' % (threshold,))
+        if max_payload_size < 1:
+            raise ValueError('invalid max payload size %r' %
+                             (max_payload_size,))
+        self.dictionary = dictionary
+        self.threshold = threshold
+        self.level = level
+        self.max_payload_size = max_payload_size
+
+    def _compressobj(self):
+        """
+        Create a compressor for a single frame.
+
+        :returns: zlib.Compress
+        """
+        if self.dictionary:
+            return zlib.compressobj(self.level, zlib.DEFLATED, -15,
+                                    zdict=self.dictionary)
+        return zlib.compressobj(self.level, zlib.DEFLATED, -15)
+
+    def _decompressobj(self):
+        """
+        Create a decompressor for a single frame.
+
+        :returns: zlib.Decompress
+        """
+        if self.dictionary:
+            return zlib.decompressobj(-15, zdict=self.dictionary)
+        return zlib.decompressobj(-15)
+
+    def compress(self, payload):
+        """
+        Make a frame from a payload of encoded messages, compressing it if it
+        is large enough.
+
+        :param bytes payload: One or more complete messages.
+        :returns: bytes
+        :raises ValueError: If the payload is larger than max_payload_size.
+        """
+        if len(payload) > self.max_payload_size:
+            raise ValueError('payload of {} bytes is larger than the maximum '
+                             'of {}'.format(len(payload),
+                                            self.max_payload_size))
+        frame_type = RAW
+        data = payload
+        if len(payload) >= self.threshold:
+            compressor = self._compressobj()
+            compressed = compressor.compress(payload) + compressor.flush()
+            if len(compressed) < len(payload):
+                frame_type = DEFLATE
+                data = compressed
+        return (six.int2byte(frame_type) +
+                _frame_length_codec.dumps(len(data)) + data)
+
+    def decompress(self, frame_type, data):
+        """
+        Get the payload of a frame.
+
+        :param int frame_type: The type of the frame.
+        :param bytes data: The data of the frame, after its length.
+        :returns: bytes
+        :raises ValueError: If the frame type is unknown, the data is not a
+            complete deflate stream, or the payload is larger than
+            max_payload_size.
+        """
+        max_payload_size = self.max_payload_size
+        if len(data) > max_payload_size:
+            raise ValueError('frame of {} bytes is larger than the maximum of '
+                             '{}'.format(len(data), max_payload_size))
+        if frame_type == RAW:
+            return bytes(data)
+        elif frame_type != DEFLATE:
+            raise ValueError('invalid frame type %r' % (frame_type,))
+        decompressor = self._decompressobj()
+        try:
+            payload = decompressor.decompress(bytes(data), max_payload_size)
+        except zlib.error as error:
+            raise ValueError('invalid compressed frame: {}'.format(error))
+        if decompressor.unconsumed_tail:
+            raise ValueError('compressed frame is larger than the maximum of '
+                             '{} bytes'.format(max_payload_size))
+        if not decompressor.eof:
+            raise ValueError('compressed frame is truncated')
+        return payload
+
+    def dumps(self, schema, key, data):
+        """
+        Encode a single message as a frame.
+
+        :param jettison.Schema schema: The schema to encode the message with.
+        :param str key: Name of the definition.
+        :param dict data: Data dict to encode.
+        :returns: bytes
+        """
+        return self.compress(schema.dumps(key, data))
+
+    def dumps_batch(self, schema, messages):
+        """
+        Encode many messages of any definitions as a single frame. A batch
+        usually compresses much better than the same messages framed one at
+        a time.
+
+        :param jettison.Schema schema: The schema to encode the messages
+            with.
+        :param messages: Iterable of (key, data) tuples to encode.
+        :returns: bytes
+        """
+        buffer, _ = schema.dumps_batch(messages)
+        return self.compress(buffer)
+
+    def decoder(self, schema):
+        """
+        Create a decoder for a stream of frames.
+
+        :param jettison.Schema schema: The schema to decode the messages
+            with.
+        :returns: FrameDecoder
+        """
+        return FrameDecoder(schema, self)
+
+
+class FrameDecoder(object):
+
+    """
+    Incrementally decodes messages from a stream of frames. This has the same
+    interface as :class:`jettison.StreamDecoder`, so it can be used anywhere
+    a stream decoder is used.
+
+    :param jettison.Schema schema: The schema used to decode the messages.
+    :param Compression compression: The compression settings of the stream.
+    """
+
+    def __init__(self, schema, compression):
+        super(FrameDecoder, self).__init__()
+        self.schema = schema
+        self.compression = compression
+        self.buffer = bytearray()
+
+    @property
+    def pending(self):
+        """
+        The number of bytes buffered for a partially received frame.
+        """
+        return len(self.buffer)
+
+    def feed(self, chunk):
+        """
+        Feed a chunk of data to the decoder.
+
+        :param bytes chunk: The next chunk of the stream.
+        :returns: list(dict) of the messages in the frames completed by this
+            chunk.
+        :raises ValueError: If a frame is invalid, or is larger than the
+            compression's max_payload_size.
+        :raises struct.error: If the length of a frame is invalid.
+        """
+        self.buffer += chunk
+        buffer = self.buffer
+        length = len(buffer)
+        loads_from = self.schema.loads_from
+        max_payload_size = self.compression.max_payload_size
+        messages = []
+        offset = 0
+        while offset < length:
+            try:
+                data_size, start = _frame_length_codec.loads_from(
+                    buffer, offset + 1)
+            except jettison.TruncatedError:
+                break
+            if data_size > max_payload_size:
+                raise ValueError('frame of {} bytes is larger than the '
+                                 'maximum of {}'.format(data_size,
+                                                        max_payload_size))
+            end = start + data_size
+            if end > length:
+                break
+            payload = self.compression.decompress(buffer[offset],
+                                                  buffer[start:end])
+            payload_offset = 0
+            while payload_offset < len(payload):
+                value, payload_offset = loads_from(payload, payload_offset)
+                messages.append(value)
+            offset = end
+        del buffer[:offset]
+        return messages
@@ -0,0 +1,287 @@
+"""
+Random access to files of Jettison schema messages.
+
+A message log is a file of concatenated schema messages, such as a recording
+of the messages sent over a connection. :class:`MessageLog` memory maps the
+file, and builds an index of the offset of each message, so messages can be
+decoded lazily, in any order, without reading the whole file:
+
+    >>> with jettison.log.MessageLog(schema, 'replay.bin') as log:
+    ...     print(len(log))
+    ...     print(log[1000])
+    ...     for message in log.iterate(5000):
+    ...         print(message)
+
+Building the index has to walk through every message, so for large logs the
+index can be saved to a file, and loaded again the next time the log is
+opened. If the log has grown since the index was saved, only the new messages
+are indexed. The index stores a checksum of the start and end of the indexed
+part of the log, so an index is ignored if the log has been rewritten since.
+"""
+
+import array
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import jettison
+
+
+#: Header of an index file. This is the magic string, the format version, the
+#: number of bytes of the log that were indexed, the number of offsets, and
+#: the checksum of the indexed bytes.
+_index_header = struct.Struct('<4sIQQI')
+_index_magic = b'JTIX'
+_index_version = 2
+
+#: Number of bytes at the start and end of the indexed part of the log that
+#: are included in the checksum.
+_index_checksum_size = 4096
+
+
+class MessageLog(object):
+
+    """
+    Reads messages from a file of concatenated schema messages.
+
+    If the file ends with a partial message, such as when the log is still
+    being written, the partial message is not included. Call :meth:`refresh`
+    to index any messages that have been written since.
+
+    :param jettison.Schema schema: The schema used to decode the messages.
+    :param str path: Path of the log file.
+    :param str index_path: Optional path of an index file. If the file
+        exists, the index is loaded from it, otherwise the index is built and
+        saved to it.
+    :raises KeyError: If the log contains an id that is not defined in the
+        schema.
+    """
+
+    def __init__(self, schema, path, index_path=None):
+        super(MessageLog, self).__init__()
+        self.schema = schema
+        self.path = path
+        self.index_path = index_path
+        self.offsets = array.array('Q')
+        self.indexed_size = 0
+        self._file = open(path, 'rb')
+        self._map = None
+        self._map_file()
+        if index_path is not None and self._load_index(index_path):
+            if self.refresh():
+                self.save_index()
+        else:
+            self.refresh()
+            if index_path is not None:
+                self.save_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return self.iterate()
+
+    def __getitem__(self, index):
+        """
+        Decode a message, or a list of messages if index is a slice.
+
+        :param index: Index of the message, which can be negative.
+        :returns: dict, or an instance of the definition's record class.
+        :raises IndexError: If the index is out of range.
+        """
+        if isinstance(index, slice):
+            return [self._map_loads(offset) for offset in self.offsets[index]]
+        return self._map_loads(self.offsets[index])
+
+    def _map_file(self):
+        """
+        Memory map the file, or map it again if it has grown.
+        """
+        size = os.fstat(self._file.fileno()).st_size
+        if self._map is not None and len(self._map) == size:
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def _map_loads(self, offset):
+        return self.schema.loads_from(self._map, offset)[0]
+
+    def _skip_message(self, offset):
+        """
+        Find the end of the message at an offset without decoding it.
+
+        :param int offset: Offset of the message in the log.
+        :returns: int offset just past the end of the message.
+        :raises KeyError: If the message's id is not defined in the schema.
+        :raises jettison.TruncatedError: If the log ends before the message.
+        """
+        string = self._map
+        definition_id, offset = self.schema.id_codec.loads_from(string, offset)
+        definition = self.schema.definitions_by_id.get(definition_id)
+        if definition is None:
+            raise KeyError('id {!r} is not defined in schema'.format(
+                definition_id))
+        return definition.skip_from(string, offset)
+
+    def _get_checksum(self, indexed_size):
+        """
+        Compute a checksum of the first and last bytes of the indexed part of
+        the log, so a saved index can be matched to the log it was built for.
+
+        :param int indexed_size: The number of bytes of the log that were
+            indexed.
+        :returns: int
+        """
+        if not indexed_size:
+            return 0
+        string = self._map
+        checksum = zlib.crc32(string[:min(indexed_size,
+                                          _index_checksum_size)])
+        checksum = zlib.crc32(
+            string[max(indexed_size - _index_checksum_size, 0):indexed_size],
+            checksum)
+        return checksum & 0xffffffff
+
+    def _load_index(self, index_path):
+        """
+        Load the offsets from an index file.
+
+        :param str index_path: Path of the index file.
+        :returns: bool, True if the index was loaded, or False if the file
+            doesn't exist, or doesn't match the log. An index matches if the
+            checksum of the indexed bytes is unchanged, and the last indexed
+            message ends exactly where the index ends.
+        """
+        try:
+            with open(index_path, 'rb') as index_file:
+                header = index_file.read(_index_header.size)
+                data = index_file.read()
+        except (IOError, OSError):
+            return False
+        if len(header) < _index_header.size:
+            return False
+        magic, version, indexed_size, count, checksum = _index_header.unpack(
+            header)
+        size = len(self._map) if self._map is not None else 0
+        if (magic != _index_magic or version != _index_version or
+                indexed_size > size or len(data) != count * 8 or
+                bool(count) != bool(indexed_size) or
+                checksum != self._get_checksum(indexed_size)):
+            return False
+        offsets = array.array('Q')
+        offsets.frombytes(data)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        if offsets:
+            try:
+                end = self._skip_message(offsets[-1])
+            except (KeyError, struct.error):
+                return False
+            if end != indexed_size:
+                return False
+        self.offsets = offsets
+        self.indexed_size = indexed_size
+        return True
+
+    def save_index(self, index_path=None):
+        """
+        Save the index to a file, so that it can be loaded the next time the
+        log is opened.
+
+        :param str index_path: Path of the index file. Defaults to the
+            index_path the log was opened with.
+        """
+        index_path = index_path or self.index_path
+        if index_path is None:
+            raise ValueError('index_path is required')
+        offsets = self.offsets
+        if sys.byteorder != 'little':
+            offsets = array.array('Q', offsets)
+            offsets.byteswap()
+        temporary_path = '{}.tmp'.format(index_path)
+        with open(temporary_path, 'wb') as index_file:
+            index_file.write(_index_header.pack(
+                _index_magic, _index_version, self.indexed_size,
+                len(offsets), self._get_checksum(self.indexed_size)))
+            index_file.write(offsets.tobytes())
+        os.replace(temporary_path, index_path)
+
+    def refresh(self):
+        """
+        Index any complete messages that have been appended to the log since
+        it was last indexed.
+
+        Messages are skipped over without being decoded. Strings and arrays
+        are skipped using their length prefixes, and only fields that don't
+        have a length prefix, such as lists of nested definitions, have to be
+        decoded to find where they end.
+
+        :returns: int number of new messages.
+        :raises KeyError: If the log contains an id that is not defined in
+            the schema.
+        :raises struct.error: If the log contains an invalid message.
+        """
+        self._map_file()
+        if self._map is None:
+            return 0
+        size = len(self._map)
+        offsets = self.offsets
+        count = len(offsets)
+        offset = self.indexed_size
+        while offset < size:
+            try:
+                end = self._skip_message(offset)
+            except jettison.TruncatedError:
+                break
+            offsets.append(offset)
+            offset = end
+        self.indexed_size = offset
+        return len(offsets) - count
+
+    def raw(self, index):
+        """
+        Get the encoded bytes of a message, including its id.
+
+        :param int index: Index of the message, which can be negative.
+        :returns: bytes
+        """
+        offsets = self.offsets
+        start = offsets[index]
+        if index == -1 or index == len(offsets) - 1:
+            end = self.indexed_size
+        else:
+            end = offsets[index + 1]
+        return self._map[start:end]
+
+    def iterate(self, start=0, stop=None):
+        """
+        Lazily decode messages in order.
+
+        :param int start: Index of the first message.
+        :param int stop: Index just past the last message. Defaults to the
+            number of messages in the log.
+        :returns: iterator of dicts or records.
+        """
+        for offset in self.offsets[start:stop]:
+            yield self._map_loads(offset)
+
+    def close(self):
+        """
+        Close the memory map and the log file.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
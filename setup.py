@@ -1,5 +1,5 @@
 import os
-from setuptools import setup
+from setuptools import Extension, setup
 
 
 version_file_path = os.path.join(os.path.abspath(os.path.dirname(__file__)),
@@ -14,6 +14,13 @@ setup(
                  'JavaScript library'),
     url='https://github.com/noonat/jettison-python',
     packages=['jettison'],
+    python_requires='>=3.5',
+    # The C accelerator is optional. If it fails to build, jettison falls
+    # back to the pure Python implementation.
+    ext_modules=[
+        Extension('jettison._speedups', ['jettison/_speedups.c'],
+                  optional=True),
+    ],
     install_requires=[
         'six',
     ],
@@ -0,0 +1,16 @@
+import pytest
+
+import jettison
+
+
+@pytest.fixture(autouse=True, params=['python', 'speedups'])
+def backend(request, monkeypatch):
+    """
+    Run every test against both the pure Python implementation and the C
+    accelerator, if it has been built.
+    """
+    if request.param == 'python':
+        monkeypatch.setattr(jettison, '_speedups', None)
+    elif jettison._speedups is None:
+        pytest.skip('the C accelerator is not built')
+    return request.param
@@ -0,0 +1,124 @@
+# encoding: utf-8
+
+import asyncio
+
+import pytest
+
+import jettison
+import jettison.aio
+import jettison.compression
+
+
+@pytest.fixture
+def schema():
+    schema = jettison.Schema()
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'x', 'type': 'float64'},
+    ])
+    schema.define('name', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'name', 'type': 'string'},
+    ])
+    return schema
+
+
+class FakeStreamWriter(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    async def drain(self):
+        pass
+
+
+def test_writer_coalesces_writes(schema):
+    stream = FakeStreamWriter()
+    writer = jettison.aio.SchemaWriter(schema, stream)
+    positions = [{'entity_id': i, 'x': i * 0.5} for i in range(10)]
+
+    async def run():
+        for value in positions:
+            writer.write('position', value)
+        writer.write('name', {'entity_id': 1, 'name': u'hodør'})
+        assert stream.writes == []
+        await asyncio.sleep(0)
+        assert len(stream.writes) == 1
+        writer.write_many('position', positions)
+        await writer.drain()
+        assert len(stream.writes) == 2
+
+    asyncio.run(run())
+    expected = b''.join(schema.dumps('position', value)
+                        for value in positions)
+    assert stream.writes == [
+        expected + schema.dumps('name', {'entity_id': 1, 'name': u'hodør'}),
+        expected,
+    ]
+
+
+def test_writer_raises_encoding_errors(schema):
+    writer = jettison.aio.SchemaWriter(schema, FakeStreamWriter())
+
+    async def run():
+        with pytest.raises(KeyError):
+            writer.write('missing', {})
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_loopback(schema, compressed):
+    if compressed:
+        sample = schema.dumps('name', {'entity_id': 1, 'name': u'hodør'})
+        compression = jettison.compression.Compression(
+            jettison.compression.train_dictionary([sample, sample]))
+    else:
+        compression = None
+    messages = [
+        ('position', {'entity_id': 1, 'x': 0.5}),
+        ('name', {'entity_id': 1, 'name': u'hodør'}),
+        ('position', {'entity_id': 2, 'x': 1.5}),
+    ] * 100
+
+    async def handle(stream_reader, stream_writer):
+        reader, writer = jettison.aio.wrap(schema, stream_reader,
+                                           stream_writer, chunk_size=7,
+                                           compression=compression)
+        async for message in reader:
+            writer.write('position' if 'x' in message else 'name', message)
+        writer.close()
+        await writer.wait_closed()
+
+    async def run():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await jettison.aio.open_connection(
+                schema, '127.0.0.1', port, compression=compression)
+            for key, value in messages:
+                writer.write(key, value)
+            await writer.drain()
+            writer.writer.write_eof()
+            loaded_values = [message async for message in reader]
+            writer.close()
+            await writer.wait_closed()
+        return loaded_values
+
+    assert asyncio.run(run()) == [value for key, value in messages]
+
+
+def test_reader_incomplete_message(schema):
+    async def run():
+        stream = asyncio.StreamReader()
+        dumped_value = schema.dumps('name', {'entity_id': 1, 'name': u'abc'})
+        stream.feed_data(dumped_value[:-1])
+        stream.feed_eof()
+        reader = jettison.aio.SchemaReader(schema, stream)
+        with pytest.raises(asyncio.IncompleteReadError):
+            await reader.read()
+
+    asyncio.run(run())
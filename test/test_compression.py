@@ -0,0 +1,119 @@
+# encoding: utf-8
+
+import random
+
+import pytest
+
+import jettison
+import jettison.compression
+
+
+@pytest.fixture
+def schema():
+    schema = jettison.Schema()
+    schema.define('chat', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'channel', 'type': 'string'},
+        {'key': 'text', 'type': 'string'},
+    ])
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float32'},
+    ])
+    return schema
+
+
+def make_messages(count, seed=0):
+    rng = random.Random(seed)
+    words = [u'hello', u'anyone', u'selling', u'buying', u'sword', u'of',
+             u'the', u'ancients', u'meet', u'at', u'the', u'gate', u'hodør']
+    messages = []
+    for i in range(count):
+        messages.append(('chat', {
+            'entity_id': rng.randrange(1000),
+            'channel': rng.choice([u'trade', u'general', u'guild']),
+            'text': u' '.join(rng.choice(words) for _ in range(8)),
+        }))
+        messages.append(('position', {'entity_id': i, 'x': 0.5}))
+    return messages
+
+
+def test_train_dictionary(schema):
+    samples = [schema.dumps(key, data) for key, data in make_messages(200)]
+    dictionary = jettison.compression.train_dictionary(samples, size=1024)
+    assert isinstance(dictionary, bytes)
+    assert 0 < len(dictionary) <= 1024
+    assert b'ancients' in dictionary
+    assert jettison.compression.train_dictionary([]) == b''
+
+    key, data = make_messages(1, seed=1)[0]
+    plain = jettison.compression.Compression(threshold=0)
+    primed = jettison.compression.Compression(dictionary, threshold=0)
+    assert len(primed.dumps(schema, key, data)) < len(
+        plain.dumps(schema, key, data))
+
+
+def test_frame_decoder(schema):
+    messages = make_messages(20)
+    samples = [schema.dumps(key, data) for key, data in make_messages(50, 1)]
+    compression = jettison.compression.Compression(
+        jettison.compression.train_dictionary(samples))
+    frames = [compression.dumps(schema, key, data) for key, data in messages]
+    frames.append(compression.dumps_batch(schema, messages))
+    frame_types = set(frame[0] for frame in frames)
+    assert frame_types == set([jettison.compression.RAW,
+                               jettison.compression.DEFLATE])
+    stream = b''.join(frames)
+
+    decoder = compression.decoder(schema)
+    values = []
+    for i in range(len(stream)):
+        values.extend(decoder.feed(stream[i:i + 1]))
+    assert decoder.pending == 0
+    assert values == [data for key, data in messages] * 2
+
+    # Both ends have to use the same dictionary.
+    other = jettison.compression.Compression(b'something else')
+    with pytest.raises(ValueError):
+        other.decoder(schema).feed(frames[-1])
+    with pytest.raises(ValueError):
+        compression.decoder(schema).feed(b'\x07\x00')
+
+
+def test_compression_options():
+    with pytest.raises(ValueError):
+        jettison.compression.Compression(level=10)
+    with pytest.raises(ValueError):
+        jettison.compression.Compression(threshold=-1)
+    compression = jettison.compression.Compression(threshold=100)
+    assert compression.compress(b'\x00' * 99) == b'\x00\x63' + b'\x00' * 99
+    assert compression.compress(b'\x00' * 100)[:1] == b'\x01'
+
+
+def test_compression_max_payload_size(schema):
+    with pytest.raises(ValueError):
+        jettison.compression.Compression(max_payload_size=0)
+    compression = jettison.compression.Compression(max_payload_size=1000)
+    with pytest.raises(ValueError):
+        compression.compress(b'\x00' * 1001)
+    frame = compression.compress(b'\x00' * 1000)
+    assert frame[:1] == b'\x01'
+    assert compression.decompress(1, frame[2:]) == b'\x00' * 1000
+
+    # A frame that inflates to more than the limit is rejected without
+    # inflating all of it.
+    bomb = jettison.compression.Compression().compress(b'\x00' * 100000)
+    assert len(bomb) < 1000
+    with pytest.raises(ValueError):
+        compression.decoder(schema).feed(bomb)
+
+    # So is a frame whose length is too large, before its data arrives.
+    decoder = compression.decoder(schema)
+    with pytest.raises(ValueError):
+        decoder.feed(b'\x00\xe9\x07')
+    assert jettison.compression.Compression().decoder(schema).feed(
+        b'\x00\xe9\x07') == []
+
+    # An invalid length is raised instead of being buffered forever.
+    with pytest.raises(jettison.struct.error):
+        compression.decoder(schema).feed(b'\x00' + b'\x80' * 11)
@@ -1,6 +1,15 @@
 # encoding: utf-8
 
+import array
+import concurrent.futures
+import gc
+import linecache
 import math
+import mmap
+import pickle
+import struct
+import threading
+import traceback
 
 import pytest
 import six
@@ -124,6 +133,8 @@ def test_codecs(codec, expected_size, expected_type, value,
     else:
         assert loaded_value == value
     assert isinstance(loaded_value, expected_type)
+    loaded_value, offset = codec.loads_from(b'\xff' + dumped_value, 1)
+    assert offset == expected_size + 1
 
 
 def test_array_codec():
@@ -142,14 +153,16 @@ def test_array_codec():
         b'\x3F\xE0\x00\x00\x00\x00\x00\x00'  # value 4
     )
     assert codec.loads(dumped_values) == values
-    assert codec.size == len(dumped_values)
+    assert codec.loads_from(dumped_values) == (values, len(dumped_values))
+    assert not hasattr(codec, 'size')
 
     # dumping an empty iterable should just write a zero length
     values = ()
     dumped_values = codec.dumps(values)
     assert dumped_values == b'\x00\x00\x00\x00'
     assert codec.loads(dumped_values) == values
-    assert codec.size == len(dumped_values)
+    assert codec.loads_from(dumped_values) == (values, len(dumped_values))
+    assert not hasattr(codec, 'size')
 
 
 def test_string_codec():
@@ -161,14 +174,25 @@ def test_string_codec():
     dumped_value = codec.dumps(value)
     assert dumped_value == b'\x00\x00\x00\x06' + value.encode('utf-8')
     assert codec.loads(dumped_value) == value
-    assert codec.size == len(dumped_value)
+    assert codec.loads_from(dumped_value) == (value, len(dumped_value))
+    assert not hasattr(codec, 'size')
 
     # dumping an empty unicode string should just write a zero length
     value = u''
     dumped_value = codec.dumps(value)
     assert dumped_value == b'\x00\x00\x00\x00'
     assert codec.loads(dumped_value) == value
-    assert codec.size == len(dumped_value)
+    assert codec.loads_from(dumped_value) == (value, len(dumped_value))
+    assert not hasattr(codec, 'size')
+
+
+@pytest.mark.parametrize('isascii', [True, False])
+def test_string_codec_size_of(isascii, monkeypatch):
+    if not isascii:
+        monkeypatch.setattr(jettison, '_isascii', None)
+    codec = jettison.StringCodec('varint')
+    for value in (u'', u'hello', u'hodør', u'\u2603' * 50):
+        assert codec.size_of(value) == len(codec.dumps(value))
 
 
 def test_float_codec_javascript_nan():
@@ -258,3 +282,1282 @@ def test_schema():
         b'\x40\x1F\x8F\x5C\x28\xF5\xC2\x8F'  # y
     )
     assert schema.loads(dumped_value) == value
+
+
+@pytest.mark.parametrize('little_endian', [False, True])
+def test_definition_fixed_layout(little_endian):
+    fields = [
+        jettison.Field('entity_id', 'uint32'),
+        jettison.Field('alive', 'boolean'),
+        jettison.Field('x', 'float32'),
+        jettison.Field('y', 'float64'),
+        jettison.Field('health', 'int16'),
+    ]
+    definition = jettison.Definition(fields, little_endian=little_endian)
+    assert definition.big_struct is not None
+    assert definition.little_struct is not None
+    value = {'entity_id': 7,
+             'alive': True,
+             'x': 0.5,
+             'y': -1.5,
+             'health': -3}
+
+    # the compiled struct should produce the same bytes as the field codecs
+    dumped_value = definition.dumps(value)
+    assert dumped_value == b''.join(
+        field.codec.dumps(value[field.key], little_endian)
+        for field in fields)
+    assert definition.loads(dumped_value) == value
+    assert definition.loads(b'\xff' + dumped_value, 1) == value
+
+
+def test_definition_variable_layout():
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'name', 'type': 'string'},
+    ])
+    assert definition.big_struct is None
+    assert definition.little_struct is None
+
+
+def test_definition_loads_from():
+    definition = jettison.define([
+        {'key': 'name', 'type': 'string'},
+        {'key': 'points', 'type': 'array', 'value_type': 'uint8'},
+        {'key': 'health', 'type': 'int16'},
+    ])
+    value = {'name': u'hodør', 'points': (1, 2, 3), 'health': 100}
+    dumped_value = definition.dumps(value)
+    string = b'\xff' + dumped_value + dumped_value
+    loaded_value, offset = definition.loads_from(string, 1)
+    assert loaded_value == value
+    assert offset == len(dumped_value) + 1
+    assert definition.loads_from(string, offset) == (value, len(string))
+
+
+def test_definition_loads_threads():
+    definition = jettison.define([
+        {'key': 'name', 'type': 'string'},
+        {'key': 'health', 'type': 'int16'},
+    ])
+    errors = []
+
+    def decode(name):
+        value = {'name': name, 'health': len(name)}
+        dumped_value = definition.dumps(value)
+        try:
+            for _ in range(2000):
+                assert definition.loads(dumped_value) == value
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=decode, args=(u'x' * i,))
+               for i in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_schema_dumps_many():
+    schema = jettison.Schema()
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'x', 'type': 'float64'},
+        {'key': 'y', 'type': 'float64'},
+    ])
+    schema.define('name', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'name', 'type': 'string'},
+    ])
+    positions = [{'entity_id': i, 'x': i * 0.5, 'y': -i * 0.5}
+                 for i in range(5)]
+    buffer, offsets = schema.dumps_many('position', positions)
+    assert isinstance(buffer, bytearray)
+    assert buffer == b''.join(schema.dumps('position', value)
+                              for value in positions)
+    assert offsets == [i * 21 for i in range(5)]
+    for offset, value in zip(offsets, positions):
+        assert schema.loads(bytes(buffer[offset:offset + 21])) == value
+
+    assert schema.dumps_many('position', []) == (bytearray(), [])
+    with pytest.raises(KeyError):
+        schema.dumps_many('missing', positions)
+
+
+def test_schema_dumps_batch():
+    schema = jettison.Schema()
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'x', 'type': 'float64'},
+    ])
+    schema.define('name', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'name', 'type': 'string'},
+    ])
+    messages = [
+        ('position', {'entity_id': 1, 'x': 0.5}),
+        ('name', {'entity_id': 1, 'name': u'hodør'}),
+        ('position', {'entity_id': 2, 'x': 1.5}),
+    ]
+    buffer, offsets = schema.dumps_batch(messages)
+    dumped_values = [schema.dumps(key, value) for key, value in messages]
+    assert buffer == b''.join(dumped_values)
+    assert offsets == [0, 13, 13 + 15]
+    ends = offsets[1:] + [len(buffer)]
+    for start, end, (key, value) in zip(offsets, ends, messages):
+        assert schema.loads(bytes(buffer[start:end])) == value
+
+
+def test_schema_loads_from_buffers():
+    schema = jettison.Schema()
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'x', 'type': 'float64'},
+    ])
+    schema.define('name', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'name', 'type': 'string'},
+    ])
+    messages = [
+        ('position', {'entity_id': 1, 'x': 0.5}),
+        ('name', {'entity_id': 1, 'name': u'hodør'}),
+        ('position', {'entity_id': 2, 'x': 1.5}),
+    ]
+    buffer, offsets = schema.dumps_batch(messages)
+    mapped = mmap.mmap(-1, len(buffer))
+    mapped.write(bytes(buffer))
+    try:
+        for string in (bytes(buffer), buffer, memoryview(buffer), mapped):
+            offset = 0
+            for expected_offset, (key, value) in zip(offsets, messages):
+                assert offset == expected_offset
+                assert schema.loads(string, offset) == value
+                loaded_value, offset = schema.loads_from(string, offset)
+                assert loaded_value == value
+            assert offset == len(buffer)
+    finally:
+        mapped.close()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 13, 1000])
+def test_stream_decoder(chunk_size):
+    schema = jettison.Schema()
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'x', 'type': 'float64'},
+    ])
+    schema.define('name', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'name', 'type': 'string'},
+        {'key': 'points', 'type': 'array', 'value_type': 'uint16'},
+    ])
+    messages = [
+        ('position', {'entity_id': 1, 'x': 0.5}),
+        ('name', {'entity_id': 1, 'name': u'hodør', 'points': (1, 2)}),
+        ('name', {'entity_id': 2, 'name': u'', 'points': ()}),
+        ('position', {'entity_id': 2, 'x': 1.5}),
+    ]
+    buffer, offsets = schema.dumps_batch(messages)
+    string = bytes(buffer)
+
+    decoder = schema.decoder()
+    loaded_values = []
+    for i in range(0, len(string), chunk_size):
+        loaded_values.extend(decoder.feed(string[i:i + chunk_size]))
+    assert loaded_values == [value for key, value in messages]
+    assert decoder.pending == 0
+
+    # a trailing partial message should stay buffered until it is completed
+    assert decoder.feed(string[:offsets[1] + 3]) == [messages[0][1]]
+    assert decoder.pending == 3
+    assert decoder.feed(memoryview(string)[offsets[1] + 3:]) == [
+        value for key, value in messages[1:]]
+    assert decoder.pending == 0
+
+
+@pytest.mark.parametrize('codegen', [False, True])
+def test_stream_decoder_needed(codegen):
+    schema = jettison.Schema(length_type='varint', codegen=codegen)
+    schema.define('blob', [
+        {'key': 'count', 'type': 'varint'},
+        {'key': 'data', 'type': 'string'},
+    ])
+    string = schema.dumps('blob', {'count': 1, 'data': u'x' * 1000})
+
+    # Once the length of the string has arrived, the message isn't decoded
+    # again until all of it has.
+    decoder = schema.decoder()
+    assert decoder.feed(string[:5]) == []
+    assert decoder.needed == len(string)
+    for i in range(5, len(string) - 1):
+        assert decoder.feed(string[i:i + 1]) == []
+    assert decoder.feed(string[-1:]) == [{'count': 1, 'data': u'x' * 1000}]
+    assert decoder.needed == 0
+
+    with pytest.raises(jettison.TruncatedError) as error:
+        schema.loads(string[:-1])
+    assert error.value.size == len(string)
+
+    # Invalid messages are raised instead of being buffered.
+    with pytest.raises(struct.error) as error:
+        schema.decoder().feed(b'\x01' + b'\x80' * 11 + b'\x00')
+    assert not isinstance(error.value, jettison.TruncatedError)
+    with pytest.raises(KeyError):
+        schema.decoder().feed(b'\x09\x00')
+    bounded = jettison.Schema(length_type='varint', codegen=codegen)
+    bounded.define('blob', [
+        {'key': 'count', 'type': 'varint'},
+        {'key': 'data', 'type': 'string', 'max_length': 10},
+    ])
+    with pytest.raises(struct.error) as error:
+        bounded.decoder().feed(string[:5])
+    assert not isinstance(error.value, jettison.TruncatedError)
+
+
+@pytest.mark.parametrize('little_endian', [False, True])
+def test_array_codec_array_module(little_endian):
+    codec = jettison.ArrayCodec('f', array_type='array')
+    values = array.array('f', [0.5, -1.5, 2.25])
+    dumped_values = codec.dumps(values, little_endian)
+    assert dumped_values == jettison.ArrayCodec('f').dumps(
+        tuple(values), little_endian)
+    loaded_values, offset = codec.loads_from(dumped_values,
+                                             little_endian=little_endian)
+    assert isinstance(loaded_values, array.array)
+    assert loaded_values == values
+    assert offset == len(dumped_values)
+
+    # a truncated array should fail like the struct module does
+    with pytest.raises(struct.error):
+        codec.loads(dumped_values[:-1], little_endian=little_endian)
+
+    with pytest.raises(ValueError):
+        jettison.ArrayCodec('?', array_type='array')
+    with pytest.raises(ValueError):
+        jettison.ArrayCodec('f', array_type='list')
+
+
+@pytest.mark.parametrize('little_endian', [False, True])
+def test_array_codec_numpy(little_endian):
+    numpy = pytest.importorskip('numpy')
+    codec = jettison.ArrayCodec('f', array_type='numpy')
+    values = numpy.array([0.5, -1.5, 2.25], dtype=numpy.float32)
+    dumped_values = codec.dumps(values, little_endian)
+    assert dumped_values == jettison.ArrayCodec('f').dumps(
+        tuple(values), little_endian)
+    # float64 arrays are packed value by value, like tuples
+    assert codec.dumps(values.astype(numpy.float64),
+                       little_endian) == dumped_values
+    loaded_values, offset = codec.loads_from(bytearray(dumped_values),
+                                             little_endian=little_endian)
+    assert isinstance(loaded_values, numpy.ndarray)
+    assert loaded_values.dtype == numpy.float32
+    assert loaded_values.dtype.isnative
+    assert (loaded_values == values).all()
+    assert offset == len(dumped_values)
+    assert len(codec.loads(codec.dumps(values[:0]))) == 0
+
+    # arrays of other types are range checked instead of being cast
+    byte_codec = jettison.ArrayCodec('B')
+    dumped_bytes = byte_codec.dumps((1, 255), little_endian)
+    assert byte_codec.dumps(numpy.array([1, 255]),
+                            little_endian) == dumped_bytes
+    assert byte_codec.dumps(numpy.array([1, 255], dtype=numpy.uint8),
+                            little_endian) == dumped_bytes
+    for bad_values in ([300, -1, 1.7], [300], [-1]):
+        with pytest.raises(struct.error):
+            byte_codec.dumps(numpy.array(bad_values), little_endian)
+    with pytest.raises(struct.error):
+        byte_codec.dumps(numpy.array([-1], dtype=numpy.int8), little_endian)
+    with pytest.raises((struct.error, TypeError)):
+        byte_codec.dumps(numpy.array([[1, 2], [3, 4]], dtype=numpy.uint8),
+                         little_endian)
+
+    definition = jettison.define([{'key': 'count', 'type': 'uint8'}])
+    assert definition.loads_columns(definition.dumps_columns(
+        {'count': numpy.array([1, 2], dtype=numpy.int64)})) == \
+        {'count': (1, 2)}
+    with pytest.raises(struct.error):
+        definition.dumps_columns({'count': numpy.array([300])})
+
+
+def test_definition_array_type():
+    definition = jettison.define([
+        {'key': 'heights', 'type': 'array', 'value_type': 'uint16',
+         'array_type': 'array'},
+        {'key': 'health', 'type': 'int16'},
+    ])
+    value = {'heights': array.array('H', [1, 2, 3]), 'health': 100}
+    assert definition.loads(definition.dumps(value)) == value
+    with pytest.raises(ValueError):
+        jettison.Field('health', 'int16', array_type='array')
+
+
+def test_array_codec_struct_cache(monkeypatch):
+    codec = jettison.ArrayCodec('H')
+    assert codec._get_struct(3, False) is codec._get_struct(3, False)
+    assert codec._get_struct(3, False) is not codec._get_struct(3, True)
+    assert codec._get_struct(3, False).format == '>3H'
+    with pytest.raises(struct.error):
+        codec.loads(codec.dumps((1, 2, 3))[:-1])
+
+    # the cache is bounded
+    monkeypatch.setattr(jettison, '_max_cached_structs', 4)
+    monkeypatch.setattr(jettison, '_array_structs', {})
+    for length in range(10):
+        values = tuple(range(length))
+        assert codec.loads(codec.dumps(values)) == values
+        assert len(jettison._array_structs) <= 4
+
+
+def test_string_codec_truncated():
+    codec = jettison._codecs['string']
+    dumped_value = codec.dumps(u'hodør')
+    with pytest.raises(struct.error):
+        codec.loads(dumped_value[:-1])
+    with pytest.raises(struct.error):
+        codec.loads(dumped_value[:3])
+
+
+def test_definition_columns():
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint16'},
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'name', 'type': 'string'},
+    ])
+    records = [
+        {'entity_id': 1, 'x': 0.5, 'name': u'a'},
+        {'entity_id': 2, 'x': 1.5, 'name': u'bc'},
+        {'entity_id': 3, 'x': -2.5, 'name': u''},
+    ]
+    columns = {
+        'entity_id': (1, 2, 3),
+        'x': (0.5, 1.5, -2.5),
+        'name': (u'a', u'bc', u''),
+    }
+    dumped_value = definition.dumps_columns(records)
+    assert dumped_value == (
+        b'\x00\x00\x00\x03'                  # count
+        b'\x00\x01\x00\x02\x00\x03'          # entity ids
+        b'\x3F\x00\x00\x00'                  # x 0
+        b'\x3F\xC0\x00\x00'                  # x 1
+        b'\xC0\x20\x00\x00'                  # x 2
+        b'\x00\x00\x00\x01a'                 # name 0
+        b'\x00\x00\x00\x02bc'                # name 1
+        b'\x00\x00\x00\x00'                  # name 2
+    )
+    assert definition.dumps_columns(columns) == dumped_value
+    assert definition.dumps_columns(dict(
+        columns, entity_id=array.array('H', columns['entity_id']))) == (
+        dumped_value)
+    assert definition.loads_columns(dumped_value) == columns
+    assert definition.loads_columns_from(b'\xff' + dumped_value, 1) == (
+        columns, len(dumped_value) + 1)
+
+    assert definition.dumps_columns([]) == b'\x00\x00\x00\x00'
+    assert definition.loads_columns(b'\x00\x00\x00\x00') == {
+        'entity_id': (), 'x': (), 'name': ()}
+    with pytest.raises(ValueError):
+        definition.dumps_columns(dict(columns, x=(0.5,)))
+
+
+def test_definition_record_namedtuple():
+    schema = jettison.Schema()
+    definition = schema.define('spawn', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float64'},
+        {'key': 'name', 'type': 'string'},
+    ], record=True)
+    record_class = definition.record_class
+    assert record_class.__name__ == 'spawn'
+    assert record_class._fields == ('entity_id', 'x', 'name')
+
+    value = {'entity_id': 1, 'x': 0.5, 'name': u'hodør'}
+    dumped_value = schema.dumps('spawn', value)
+    loaded_value = schema.loads(dumped_value)
+    assert isinstance(loaded_value, record_class)
+    assert loaded_value == record_class(1, 0.5, u'hodør')
+    assert loaded_value._asdict() == value
+
+    # records can be encoded as well as dicts
+    assert schema.dumps('spawn', loaded_value) == dumped_value
+    buffer, offsets = schema.dumps_many('spawn', [loaded_value, value])
+    assert buffer == dumped_value * 2
+
+    # namedtuples need keys that are valid identifiers
+    for key in ('entity-id', 'class', '_id'):
+        with pytest.raises(ValueError) as error:
+            schema.define('invalid', [{'key': key, 'type': 'uint32'}],
+                          record=True)
+        assert 'record=True' in str(error.value)
+    assert 'invalid' not in schema.definitions
+
+
+def test_definition_record_slots():
+    class Position(object):
+        __slots__ = ('entity_id', 'x', 'y')
+
+        def __init__(self, entity_id, x, y):
+            self.entity_id = entity_id
+            self.x = x
+            self.y = y
+
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ], record=Position)
+    dumped_value = definition.dumps({'entity_id': 1, 'x': 0.5, 'y': 1.5})
+    loaded_value = definition.loads(dumped_value)
+    assert isinstance(loaded_value, Position)
+    assert (loaded_value.entity_id, loaded_value.x, loaded_value.y) == (
+        1, 0.5, 1.5)
+    assert definition.dumps(loaded_value) == dumped_value
+    assert definition.loads_columns(definition.dumps_columns(
+        [loaded_value])) == {'entity_id': (1,), 'x': (0.5,), 'y': (1.5,)}
+
+
+@pytest.mark.parametrize('codegen', [False, True])
+def test_definition_record_keyword_keys(codegen):
+    class Item(object):
+        def __init__(self, id, kind, name):
+            self.id = id
+            setattr(self, 'class', kind)
+            setattr(self, 'item-name', name)
+
+    definition = jettison.define([
+        {'key': 'id', 'type': 'uint16'},
+        {'key': 'class', 'type': 'uint8'},
+        {'key': 'item-name', 'type': 'string'},
+    ], record=Item, codegen=codegen)
+    dumped_value = definition.dumps(Item(1, 2, u'hodør'))
+    assert dumped_value == definition.dumps(
+        {'id': 1, 'class': 2, 'item-name': u'hodør'})
+    loaded_value = definition.loads(dumped_value)
+    assert (loaded_value.id, getattr(loaded_value, 'class'),
+            getattr(loaded_value, 'item-name')) == (1, 2, u'hodør')
+
+
+def test_definition_delta():
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+        {'key': 'name', 'type': 'string'},
+        {'key': 'a', 'type': 'uint8'},
+        {'key': 'b', 'type': 'uint8'},
+        {'key': 'c', 'type': 'uint8'},
+        {'key': 'd', 'type': 'uint8'},
+        {'key': 'health', 'type': 'int16'},
+    ])
+    assert definition.delta_mask_size == 2
+    previous = {'entity_id': 1, 'x': 0.5, 'y': 1.5, 'name': u'hodør',
+                'a': 1, 'b': 2, 'c': 3, 'd': 4, 'health': 100}
+    value = dict(previous, y=2.5, health=90)
+
+    dumped_value = definition.dumps_delta(previous, value)
+    assert dumped_value == (
+        b'\x04\x01'          # changed fields mask
+        b'\x40\x20\x00\x00'  # y
+        b'\x00\x5A'          # health
+    )
+    assert definition.loads_delta(dumped_value, previous) == value
+    assert previous['y'] == 1.5
+    assert definition.loads_delta_from(b'\xff' + dumped_value, previous,
+                                       1) == (value, len(dumped_value) + 1)
+
+    # unchanged values should only write the mask
+    assert definition.dumps_delta(value, value) == b'\x00\x00'
+    assert definition.loads_delta(b'\x00\x00', value) == value
+
+    # without a previous value, every field should be written
+    dumped_value = definition.dumps_delta(None, value)
+    assert dumped_value == b'\xff\x01' + definition.dumps(value)
+    assert definition.loads_delta(dumped_value, None) == value
+    with pytest.raises(ValueError):
+        definition.loads_delta(b'\x04\x01\x40\x20\x00\x00\x00\x5A', None)
+
+
+def test_definition_delta_numpy():
+    numpy = pytest.importorskip('numpy')
+    schema = jettison.Schema()
+    schema.define('path', [
+        {'key': 'points', 'type': 'array', 'value_type': 'float32',
+         'array_type': 'numpy'},
+    ])
+    definition = schema.define('entity', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'heights', 'type': 'array', 'value_type': 'uint16',
+         'array_type': 'numpy'},
+        {'key': 'path', 'type': 'struct', 'definition': 'path'},
+    ])
+    previous = {'entity_id': 1,
+                'heights': numpy.array([1, 2, 3], dtype=numpy.uint16),
+                'path': {'points': numpy.array([0.5], dtype=numpy.float32)}}
+    value = {'entity_id': 1,
+             'heights': numpy.array([1, 2, 3], dtype=numpy.uint16),
+             'path': {'points': numpy.array([0.5], dtype=numpy.float32)}}
+    assert definition.dumps_delta(previous, value) == b'\x00'
+
+    value['heights'] = numpy.array([1, 2, 4], dtype=numpy.uint16)
+    value['path'] = {'points': numpy.array([0.5, 1.5], dtype=numpy.float32)}
+    dumped_value = definition.dumps_delta(previous, value)
+    assert dumped_value[:1] == b'\x06'
+    loaded_value = definition.loads_delta(dumped_value, previous)
+    assert loaded_value['entity_id'] == 1
+    assert (loaded_value['heights'] == value['heights']).all()
+    assert (loaded_value['path']['points'] == value['path']['points']).all()
+
+    value['heights'] = numpy.array([], dtype=numpy.uint16)
+    assert definition.dumps_delta(previous, value)[:1] == b'\x06'
+    assert definition.dumps_delta(value, value) == b'\x00'
+
+
+@pytest.mark.parametrize('codec_key,value,expected_dumped_value', [
+    ('varint', 0, [0]),
+    ('varint', 1, [1]),
+    ('varint', 127, [127]),
+    ('varint', 128, [128, 1]),
+    ('varint', 300, [172, 2]),
+    ('varint', 4294967295, [255, 255, 255, 255, 15]),
+    ('varint', 18446744073709551615, [255] * 9 + [1]),
+    ('svarint', 0, [0]),
+    ('svarint', -1, [1]),
+    ('svarint', 1, [2]),
+    ('svarint', -2, [3]),
+    ('svarint', 2147483647, [254, 255, 255, 255, 15]),
+    ('svarint', -2147483648, [255, 255, 255, 255, 15]),
+    ('svarint', -9223372036854775808, [255] * 9 + [1]),
+])
+def test_varint_codecs(codec_key, value, expected_dumped_value):
+    codec = jettison._codecs[codec_key]
+    dumped_value = codec.dumps(value)
+    assert isinstance(dumped_value, six.binary_type)
+    assert bytearray(dumped_value) == bytearray(expected_dumped_value)
+    assert codec.loads(dumped_value) == value
+    assert codec.loads_from(b'\xff' + dumped_value, 1) == (
+        value, len(dumped_value) + 1)
+
+
+def test_varint_codec_errors():
+    with pytest.raises(struct.error):
+        jettison._codecs['varint'].dumps(-1)
+    with pytest.raises(struct.error):
+        jettison._codecs['varint'].dumps(1 << 64)
+    with pytest.raises(struct.error):
+        jettison._codecs['svarint'].dumps(1 << 63)
+    with pytest.raises(struct.error):
+        jettison._codecs['varint'].loads(b'\x80\x80')
+    with pytest.raises(struct.error):
+        jettison._codecs['varint'].loads(b'\xff' * 11)
+
+
+def test_varint_lengths():
+    codec = jettison.StringCodec('varint')
+    value = u'hodør'
+    assert codec.dumps(value) == b'\x06' + value.encode('utf-8')
+    assert codec.loads_from(codec.dumps(value)) == (value, 7)
+
+    codec = jettison.ArrayCodec('B', length_type='varint')
+    values = tuple(range(200))
+    assert codec.dumps(values) == b'\xc8\x01' + bytes(bytearray(values))
+    assert codec.loads_from(codec.dumps(values)) == (values, 202)
+
+    with pytest.raises(ValueError):
+        jettison.StringCodec('uint8')
+
+    schema = jettison.Schema(length_type='varint')
+    schema.define('chat', [
+        {'key': 'entity_id', 'type': 'varint'},
+        {'key': 'delta', 'type': 'svarint'},
+        {'key': 'message', 'type': 'string'},
+        {'key': 'legacy', 'type': 'string', 'length_type': 'uint32'},
+    ])
+    value = {'entity_id': 300, 'delta': -2, 'message': u'hi',
+             'legacy': u'yo'}
+    dumped_value = schema.dumps('chat', value)
+    assert dumped_value == (
+        b'\x01'               # definition id
+        b'\xac\x02'           # entity id
+        b'\x03'               # delta
+        b'\x02hi'             # message
+        b'\x00\x00\x00\x02yo'  # legacy
+    )
+    assert schema.loads(dumped_value) == value
+    assert schema.decoder().feed(dumped_value * 2) == [value, value]
+
+    with pytest.raises(ValueError):
+        jettison.Field('points', 'array', value_type='varint')
+
+
+def test_quantized_codec():
+    codec = jettison.QuantizedCodec(-1000, 1000, 16)
+    assert codec.size == 2
+    assert codec.dumps(-1000) == b'\x00\x00'
+    assert codec.dumps(1000) == b'\xff\xff'
+    assert codec.dumps(0) == b'\x80\x00'
+    for value in (-1000, -12.34, 0, 0.5, 999.99, 1000):
+        loaded_value = codec.loads(codec.dumps(value))
+        assert abs(loaded_value - value) <= codec.step_size / 2
+    assert codec.loads_from(b'\xff\xff\xff', 1) == (1000, 3)
+    with pytest.raises(struct.error):
+        codec.dumps(1000.5)
+    with pytest.raises(ValueError):
+        jettison.QuantizedCodec(0, 1, 12)
+    with pytest.raises(ValueError):
+        jettison.QuantizedCodec(1, 1, 8)
+
+
+def test_definition_quantized():
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'quantized', 'min': -1000, 'max': 1000,
+         'bits': 16},
+        {'key': 'angle', 'type': 'quantized', 'min': 0, 'max': 360,
+         'bits': 8},
+    ])
+    assert definition.big_struct.format == '>IHB'
+    value = {'entity_id': 1, 'x': 123.4, 'angle': 90}
+    dumped_value = definition.dumps(value)
+    assert dumped_value == b''.join(
+        field.codec.dumps(value[field.key]) for field in definition.fields)
+    loaded_value = definition.loads(dumped_value)
+    assert loaded_value['entity_id'] == 1
+    assert abs(loaded_value['x'] - 123.4) < 0.02
+    assert abs(loaded_value['angle'] - 90) < 1
+
+    columns = definition.loads_columns(definition.dumps_columns([value]))
+    assert columns == {key: (loaded_value[key],) for key in loaded_value}
+
+    with pytest.raises(ValueError):
+        jettison.Field('x', 'quantized', max=1)
+    with pytest.raises(ValueError):
+        jettison.Field('x', 'float32', bits=16)
+
+
+def test_bits_codec():
+    codec = jettison._codecs['uint3']
+    assert codec.size == 1
+    assert codec.dumps(5) == b'\x05'
+    assert codec.loads(b'\x05') == 5
+    with pytest.raises(struct.error):
+        codec.dumps(8)
+    with pytest.raises(ValueError):
+        jettison.BitsCodec(8)
+
+
+def test_definition_bit_fields():
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint16'},
+        {'key': 'team', 'type': 'uint2'},
+        {'key': 'state', 'type': 'uint3'},
+        {'key': 'level', 'type': 'uint7'},
+        {'key': 'alive', 'type': 'boolean'},
+        {'key': 'kind', 'type': 'uint4'},
+    ])
+    assert definition.big_struct.format == '>H2s?1s'
+    value = {'entity_id': 1, 'team': 2, 'state': 5, 'level': 127,
+             'alive': True, 'kind': 15}
+    dumped_value = definition.dumps(value)
+    assert dumped_value == (
+        b'\x00\x01'  # entity id
+        b'\xaf\xf0'  # team, state, level and padding: 10 101 1111111 00000
+        b'\x01'      # alive
+        b'\xf0'      # kind and padding
+    )
+    assert definition.loads(dumped_value) == value
+    with pytest.raises(struct.error):
+        definition.dumps(dict(value, state=8))
+
+    # bit fields can't be packed into arrays without range checks
+    for value_type in ('uint1', 'uint3', 'uint7'):
+        with pytest.raises(ValueError):
+            jettison.define([{'key': 'a', 'type': 'array',
+                              'value_type': value_type}])
+
+
+@pytest.mark.parametrize('little_endian', [False, True])
+def test_definition_pack_booleans(little_endian):
+    fields = [
+        {'key': 'name', 'type': 'string'},
+    ] + [
+        {'key': 'flag{}'.format(i), 'type': 'boolean'} for i in range(10)
+    ] + [
+        {'key': 'team', 'type': 'uint2'},
+        {'key': 'health', 'type': 'int16'},
+    ]
+    definition = jettison.define(fields, pack_booleans=True)
+    definition.little_endian = little_endian
+    assert definition.big_struct is None
+    value = {'name': u'hodør', 'team': 3, 'health': -2}
+    for i in range(10):
+        value['flag{}'.format(i)] = i % 3 == 0
+    dumped_value = definition.dumps(value)
+    assert dumped_value[:10] == jettison.StringCodec().dumps(
+        u'hodør', little_endian)
+    assert dumped_value[10:12] == b'\x92\x70'  # 1001001001 11 0000
+    assert dumped_value[12:] == jettison._codecs['int16'].dumps(
+        -2, little_endian)
+    loaded_value = definition.loads(dumped_value)
+    assert loaded_value == value
+    assert all(type(loaded_value['flag{}'.format(i)]) is bool
+               for i in range(10))
+
+    # booleans should only be packed when the schema opts in
+    schema = jettison.Schema(pack_booleans=True)
+    schema.define('flags', fields)
+    assert schema.definitions['flags'].pack_booleans
+    assert not jettison.Schema().define('flags', fields).pack_booleans
+
+
+def test_schema_nested_definitions():
+    schema = jettison.Schema()
+    schema.define('vec2', [
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ])
+    schema.define('player', [
+        {'key': 'entity_id', 'type': 'uint16'},
+        {'key': 'position', 'type': 'struct', 'definition': 'vec2'},
+        {'key': 'team', 'type': 'uint2'},
+        {'key': 'state', 'type': 'uint3'},
+    ])
+    schema.define('snapshot', [
+        {'key': 'tick', 'type': 'uint32'},
+        {'key': 'players', 'type': 'array', 'value_type': 'struct',
+         'definition': 'player'},
+        {'key': 'names', 'type': 'array', 'value_type': 'string'},
+    ])
+
+    # fixed size nested definitions should be flattened into one struct
+    assert schema.definitions['player'].big_struct.format == '>Hff1s'
+
+    value = {
+        'tick': 7,
+        'players': (
+            {'entity_id': 1, 'position': {'x': 0.5, 'y': 1.5}, 'team': 1,
+             'state': 2},
+            {'entity_id': 2, 'position': {'x': -0.5, 'y': -1.5}, 'team': 3,
+             'state': 7},
+        ),
+        'names': (u'hodør', u''),
+    }
+    dumped_value = schema.dumps('snapshot', value)
+    assert dumped_value == (
+        b'\x03'                              # definition id
+        b'\x00\x00\x00\x07'                  # tick
+        b'\x00\x00\x00\x02'                  # players length
+        b'\x00\x01'                          # player 0 entity id
+        b'\x3F\x00\x00\x00\x3F\xC0\x00\x00'  # player 0 position
+        b'\x50'                              # player 0 team and state
+        b'\x00\x02'                          # player 1 entity id
+        b'\xBF\x00\x00\x00\xBF\xC0\x00\x00'  # player 1 position
+        b'\xF8'                              # player 1 team and state
+        b'\x00\x00\x00\x02'                  # names length
+        b'\x00\x00\x00\x06hod\xc3\xb8r'      # name 0
+        b'\x00\x00\x00\x00'                  # name 1
+    )
+    assert schema.loads(dumped_value) == value
+    assert schema.loads(schema.dumps('snapshot', dict(
+        value, players=[], names=[]))) == dict(value, players=(), names=())
+
+    with pytest.raises(ValueError):
+        schema.define('bad', [
+            {'key': 'position', 'type': 'struct', 'definition': 'vec3'},
+        ])
+    with pytest.raises(ValueError):
+        jettison.Field('position', 'struct')
+
+
+def test_schema_nested_definitions_untrusted_length(monkeypatch):
+    monkeypatch.setattr(jettison, '_repeated_structs', {})
+    schema = jettison.Schema()
+    schema.define('vec2', [
+        {'key': 'x', 'type': 'int16'},
+        {'key': 'y', 'type': 'int16'},
+    ])
+    schema.define('empty', [])
+    schema.define('path', [
+        {'key': 'points', 'type': 'array', 'value_type': 'struct',
+         'definition': 'vec2'},
+    ])
+    schema.define('markers', [
+        {'key': 'markers', 'type': 'array', 'value_type': 'struct',
+         'definition': 'empty'},
+    ])
+
+    # a huge length is checked against the string before any struct is
+    # compiled for it
+    with pytest.raises(jettison.TruncatedError) as error:
+        schema.loads(b'\x03\xff\xff\xff\xff')
+    assert error.value.size == 5 + 0xffffffff * 4
+    assert not jettison._repeated_structs
+    with pytest.raises(jettison.TruncatedError):
+        schema.loads(schema.dumps('path', {'points': [{'x': 1, 'y': 2}]})[:-1])
+
+    # nested definitions without any fields take no space
+    value = {'markers': ({}, {}, {})}
+    dumped_value = schema.dumps('markers', value)
+    assert dumped_value == b'\x04\x00\x00\x00\x03'
+    assert schema.loads(dumped_value) == value
+
+
+def test_definition_nested_variable_length():
+    name = jettison.define([
+        {'key': 'first', 'type': 'string'},
+        {'key': 'last', 'type': 'string'},
+    ], record=True)
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint16'},
+        {'key': 'name', 'type': 'struct', 'definition': name},
+        {'key': 'health', 'type': 'int16'},
+    ])
+    definition.little_endian = True
+    value = {'entity_id': 1, 'name': name.record_class(u'a', u'bc'),
+             'health': -2}
+    dumped_value = definition.dumps(value)
+    assert dumped_value == (
+        b'\x01\x00'                  # entity id
+        b'\x01\x00\x00\x00a'         # first
+        b'\x02\x00\x00\x00bc'        # last
+        b'\xfe\xff'                  # health
+    )
+    loaded_value = definition.loads(dumped_value)
+    assert loaded_value == value
+    assert isinstance(loaded_value['name'], name.record_class)
+
+
+def test_definition_dumps_into():
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint16'},
+        {'key': 'name', 'type': 'string', 'length_type': 'varint'},
+        {'key': 'position', 'type': 'array', 'value_type': 'float32'},
+        {'key': 'health', 'type': 'quantized', 'min': 0, 'max': 1,
+         'bits': 8},
+    ])
+    value = {'entity_id': 7, 'name': u'hodør', 'position': (1.0, 2.0),
+             'health': 1.0}
+    dumped_value = definition.dumps(value)
+    buffer = bytearray(64)
+    assert definition.dumps_into(buffer, 3, value) == len(dumped_value)
+    assert bytes(buffer[3:3 + len(dumped_value)]) == dumped_value
+    assert len(buffer) == 64
+
+    view = memoryview(buffer)[10:10 + len(dumped_value)]
+    assert definition.dumps_into(view, 0, value) == len(dumped_value)
+    assert bytes(view) == dumped_value
+
+    for size in range(len(dumped_value)):
+        buffer = bytearray(size)
+        with pytest.raises(jettison.BufferFullError):
+            definition.dumps_into(buffer, 0, value)
+        assert len(buffer) == size
+
+
+def test_schema_dumps_into():
+    schema = jettison.Schema()
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'uint16'},
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ])
+    schema.define('names', [
+        {'key': 'names', 'type': 'array', 'value_type': 'string'},
+    ])
+    buffer = bytearray(32)
+    offset = 0
+    offset += schema.dumps_into(buffer, offset, 'position',
+                                {'entity_id': 1, 'x': 0.5, 'y': 1.5})
+    offset += schema.dumps_into(buffer, offset, 'names',
+                                {'names': [u'a', u'bc']})
+    assert bytes(buffer[:offset]) == (
+        schema.dumps('position', {'entity_id': 1, 'x': 0.5, 'y': 1.5}) +
+        schema.dumps('names', {'names': [u'a', u'bc']}))
+    with pytest.raises(jettison.BufferFullError):
+        schema.dumps_into(buffer, offset, 'position',
+                          {'entity_id': 1, 'x': 0.5, 'y': 1.5})
+    with pytest.raises(struct.error):
+        schema.dumps_into(buffer, 0, 'position',
+                          {'entity_id': -1, 'x': 0.5, 'y': 1.5})
+
+
+def test_definition_sizes():
+    vec3 = jettison.define([
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+        {'key': 'z', 'type': 'float32'},
+    ])
+    assert vec3.fixed_size == vec3.max_size == 12
+    assert vec3.size_of({'x': 0, 'y': 0, 'z': 0}) == 12
+
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'varint'},
+        {'key': 'name', 'type': 'string', 'max_length': 16,
+         'length_type': 'varint'},
+        {'key': 'path', 'type': 'array', 'value_type': 'struct',
+         'definition': vec3, 'max_length': 4},
+        {'key': 'tags', 'type': 'array', 'value_type': 'uint8',
+         'max_length': 3},
+        {'key': 'alive', 'type': 'boolean'},
+    ])
+    assert definition.fixed_size is None
+    assert definition.max_size == 10 + (1 + 16) + (4 + 48) + (4 + 3) + 1
+    values = [
+        {'entity_id': 0, 'name': u'', 'path': [], 'tags': [],
+         'alive': True},
+        {'entity_id': 300, 'name': u'hodør',
+         'path': [{'x': 1, 'y': 2, 'z': 3}] * 4, 'tags': [1, 2, 3],
+         'alive': False},
+    ]
+    for value in values:
+        assert definition.size_of(value) == len(definition.dumps(value))
+    with pytest.raises(struct.error):
+        definition.dumps(dict(values[0], name=u'x' * 17))
+    with pytest.raises(struct.error):
+        definition.dumps(dict(values[0], tags=[1, 2, 3, 4]))
+
+    names = jettison.define([
+        {'key': 'names', 'type': 'array', 'value_type': 'string',
+         'max_length': 2},
+    ])
+    assert names.max_size is None
+    assert names.size_of({'names': [u'a', u'bc']}) == 4 + 5 + 6
+
+    with pytest.raises(ValueError):
+        jettison.Field('health', 'int16', max_length=2)
+
+
+def test_schema_size_of():
+    schema = jettison.Schema()
+    schema.define('chat', [
+        {'key': 'text', 'type': 'string'},
+    ])
+    value = {'text': u'hodør'}
+    assert schema.size_of('chat', value) == len(schema.dumps('chat', value))
+
+
+@pytest.mark.parametrize('little_endian', [False, True])
+@pytest.mark.parametrize('record', [False, True])
+def test_definition_codegen(little_endian, record):
+    vec2 = jettison.define([
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ])
+    fields = [
+        {'key': 'entity_id', 'type': 'uint16'},
+        {'key': 'position', 'type': 'struct', 'definition': vec2},
+        {'key': 'health', 'type': 'quantized', 'min': 0, 'max': 1,
+         'bits': 8},
+        {'key': 'alive', 'type': 'boolean'},
+        {'key': 'team', 'type': 'uint3'},
+        {'key': 'name', 'type': 'string'},
+        {'key': 'score', 'type': 'svarint'},
+        {'key': 'path', 'type': 'array', 'value_type': 'struct',
+         'definition': vec2},
+        {'key': 'flags', 'type': 'int8'},
+    ]
+    generic = jettison.define(fields, record=record, pack_booleans=True)
+    generated = jettison.define(fields, record=record, pack_booleans=True,
+                                codegen=True)
+    generic.little_endian = little_endian
+    generated.little_endian = little_endian
+    generated.generate()
+    assert 'def dumps(data):' in generated.generated_source
+    assert generic.generated_source is None
+
+    data = {'entity_id': 7, 'position': {'x': 0.5, 'y': -1.5},
+            'health': 1.0, 'alive': True, 'team': 5, 'name': u'hodør',
+            'score': -300, 'path': ({'x': 1.0, 'y': 2.0},), 'flags': -1}
+    value = generated.record_class(**data) if record else data
+    dumped_value = generic.dumps(data)
+    assert generated.dumps(data) == dumped_value
+    assert generated.dumps(value) == dumped_value
+    assert generated.loads(dumped_value) == value
+    assert generated.loads_from(b'\x00' + dumped_value, 1) == (
+        value, len(dumped_value) + 1)
+    with pytest.raises(struct.error):
+        generated.loads(dumped_value[:-1])
+
+
+def test_definition_codegen_linecache():
+    definition = jettison.define([{'key': 'x', 'type': 'uint8'}],
+                                 codegen=True)
+    definition.generate()
+    filename = '<jettison definition {:#x}>'.format(id(definition))
+    assert filename in linecache.cache
+    del definition
+    gc.collect()
+    assert filename not in linecache.cache
+
+
+def test_schema_codegen():
+    schema = jettison.Schema(id_type='uint16', codegen=True)
+    schema.define('position', [
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ])
+    definition = schema.define('chat', [
+        {'key': 'text', 'type': 'string'},
+    ])
+    definition.little_endian = True
+    definition.generate()
+    for key, value in [('position', {'x': 0.5, 'y': -1.5}),
+                       ('chat', {'text': u'hodør'})]:
+        dumped_value = schema.dumps(key, value)
+        assert dumped_value == schema.dumps_batch([(key, value)])[0]
+        assert schema.loads(dumped_value) == value
+    assert schema.dumps('position', {'x': 0, 'y': 0})[:2] == b'\x00\x01'
+    assert schema.dumps('chat', {'text': u''}) == b'\x00\x02\x00\x00\x00\x00'
+
+    # The generated source is used for tracebacks.
+    try:
+        schema.dumps('position', {'x': 0})
+    except KeyError:
+        formatted_exception = traceback.format_exc()
+    assert "data['y']" in formatted_exception
+
+
+def test_backend_errors(backend):
+    definition = jettison.define([
+        {'key': 'a', 'type': 'int8'},
+        {'key': 'b', 'type': 'uint16'},
+        {'key': 'c', 'type': 'int32'},
+        {'key': 'd', 'type': 'float32'},
+        {'key': 'e', 'type': 'boolean'},
+    ])
+    value = {'a': -128, 'b': 65535, 'c': -2 ** 31, 'd': 0.5, 'e': True}
+    dumped_value = definition.dumps(value)
+    assert dumped_value == b'\x80\xff\xff\x80\x00\x00\x00?\x00\x00\x00\x01'
+    assert definition.loads(dumped_value) == value
+    assert definition.loads_from(b'\x00' + dumped_value, 1) == (value, 13)
+    for key, bad_value in [('a', 128), ('b', -1), ('c', 2 ** 31),
+                           ('c', 1.5), ('d', 'x'), ('b', 2 ** 64)]:
+        with pytest.raises(struct.error):
+            definition.dumps(dict(value, **{key: bad_value}))
+    with pytest.raises(KeyError):
+        definition.dumps({'a': 1})
+    with pytest.raises(struct.error):
+        definition.loads(dumped_value[:-1])
+
+    schema = jettison.Schema()
+    schema.define('value', [{'key': 'a', 'type': 'int8'}])
+    with pytest.raises(KeyError):
+        schema.loads(b'\x02\x00')
+    with pytest.raises(struct.error):
+        schema.loads(b'')
+    assert schema.loads(bytearray(b'\x01\xff')) == {'a': -1}
+
+
+@pytest.mark.parametrize('codegen', [False, True])
+def test_schema_pickle(codegen):
+    schema = jettison.Schema(id_type='uint16', length_type='varint',
+                             pack_booleans=True, codegen=codegen)
+    schema.define('vec2', [
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ])
+    schema.define('entity', [
+        {'key': 'position', 'type': 'struct', 'definition': 'vec2'},
+        {'key': 'alive', 'type': 'boolean'},
+        {'key': 'team', 'type': 'uint2'},
+        {'key': 'name', 'type': 'string', 'max_length': 8},
+        {'key': 'health', 'type': 'quantized', 'min': 0, 'max': 1},
+    ], record=True)
+    schema.definitions['vec2'].little_endian = True
+    if codegen:
+        schema.definitions['vec2'].generate()
+    value = {'position': {'x': 1.0, 'y': 2.0}, 'alive': True, 'team': 2,
+             'name': u'hodør', 'health': 0.0}
+
+    loaded_schema = pickle.loads(pickle.dumps(schema))
+    assert loaded_schema.dumps('entity', value) == schema.dumps('entity',
+                                                                value)
+    assert loaded_schema.dumps('vec2', {'x': 1, 'y': 2}) == schema.dumps(
+        'vec2', {'x': 1, 'y': 2})
+    loaded_value = loaded_schema.loads(schema.dumps('entity', value))
+    assert loaded_value._asdict() == value
+    definition = loaded_schema.definitions['entity']
+    assert definition.fields[0].definition is loaded_schema.definitions[
+        'vec2']
+    assert definition.max_size == schema.definitions['entity'].max_size
+    assert loaded_schema.define('other', []).id == 3
+
+
+@pytest.mark.parametrize('executor_class', [
+    None,
+    concurrent.futures.ThreadPoolExecutor,
+    concurrent.futures.ProcessPoolExecutor,
+])
+def test_schema_dumps_parallel(executor_class):
+    schema = jettison.Schema()
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float32'},
+    ])
+    schema.define('name', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'name', 'type': 'string'},
+    ])
+    messages = []
+    for i in range(250):
+        messages.append(('position', {'entity_id': i, 'x': i * 0.5}))
+        messages.append(('name', {'entity_id': i, 'name': u'e%d' % i}))
+    expected = schema.dumps_batch(messages)
+    if executor_class is None:
+        assert schema.dumps_parallel(messages, chunk_size=7) == expected
+    else:
+        with executor_class(max_workers=2) as executor:
+            assert schema.dumps_parallel(messages, executor,
+                                         chunk_size=64) == expected
+    assert schema.dumps_parallel([]) == (bytearray(), [])
+    with pytest.raises(ValueError):
+        schema.dumps_parallel(messages, chunk_size=0)
+
+
+def test_schema_reference_pickle(monkeypatch):
+    schema = jettison.Schema(codegen=True)
+    for i in range(300):
+        schema.define('point%d' % i, [{'key': 'x', 'type': 'uint8'}])
+    generated = []
+    generate = jettison.Definition.generate
+
+    def counting_generate(definition, *args):
+        generated.append(definition.key)
+        return generate(definition, *args)
+
+    monkeypatch.setattr(jettison.Definition, 'generate', counting_generate)
+    string = pickle.dumps(jettison._SchemaReference(schema))
+    loaded = pickle.loads(string)
+    assert sorted(generated) == sorted(schema.definitions)
+    assert loaded.schema.id_type == 'uint16'
+    assert (loaded.schema.dumps('point299', {'x': 1}) ==
+            schema.dumps('point299', {'x': 1}))
+
+    # The same reference is only unpickled once.
+    assert pickle.loads(string).schema is loaded.schema
+    assert len(generated) == len(schema.definitions)
+
+
+@pytest.mark.parametrize('little_endian', [False, True])
+@pytest.mark.parametrize('codegen', [False, True])
+def test_definition_loads_fields(little_endian, codegen):
+    vec2 = jettison.define([
+        {'key': 'x', 'type': 'float32'},
+        {'key': 'y', 'type': 'float32'},
+    ])
+    definition = jettison.define([
+        {'key': 'entity_id', 'type': 'uint16'},
+        {'key': 'position', 'type': 'struct', 'definition': vec2},
+        {'key': 'alive', 'type': 'boolean'},
+        {'key': 'team', 'type': 'uint3'},
+        {'key': 'name', 'type': 'string'},
+        {'key': 'health', 'type': 'quantized', 'min': 0, 'max': 1,
+         'bits': 8},
+        {'key': 'speed', 'type': 'float64'},
+        {'key': 'path', 'type': 'array', 'value_type': 'int16'},
+        {'key': 'score', 'type': 'svarint'},
+        {'key': 'tags', 'type': 'array', 'value_type': 'string'},
+        {'key': 'flags', 'type': 'int8'},
+    ], record=True, pack_booleans=True, codegen=codegen)
+    definition.little_endian = little_endian
+    if codegen:
+        definition.generate()
+    data = {'entity_id': 7, 'position': {'x': 0.5, 'y': -1.5},
+            'alive': True, 'team': 5, 'name': u'hodør', 'health': 1.0,
+            'speed': 2.5, 'path': (1, -2, 3), 'score': -300,
+            'tags': (u'a', u'bc'), 'flags': -1}
+    dumped_value = b'\x00' + definition.dumps(data)
+    for key in definition.keys:
+        assert definition.loads(dumped_value, 1, fields=[key]) == {
+            key: data[key]}
+    assert definition.loads(dumped_value, 1, fields=('speed', 'entity_id',
+                                                     'score')) == {
+        'entity_id': 7, 'speed': 2.5, 'score': -300}
+    assert definition.loads(dumped_value, 1, fields=definition.keys) == data
+    assert definition.loads(dumped_value, 1, fields=()) == {}
+
+    # Nothing after the last requested field is read.
+    assert definition.loads(dumped_value[:12], 1, fields=['entity_id']) == {
+        'entity_id': 7}
+    with pytest.raises(struct.error):
+        definition.loads(dumped_value[:12], 1, fields=['name'])
+    with pytest.raises(KeyError):
+        definition.loads(dumped_value, 1, fields=['missing'])
+
+    # Skipping a message finds its end without decoding it.
+    assert definition.skip_from(dumped_value, 1) == len(dumped_value)
+    for end in (12, len(dumped_value) - 1):
+        with pytest.raises(jettison.TruncatedError):
+            definition.skip_from(dumped_value[:end], 1)
+
+
+def test_schema_loads_fields():
+    schema = jettison.Schema(id_type='uint16')
+    schema.define('chat', [
+        {'key': 'text', 'type': 'string'},
+        {'key': 'entity_id', 'type': 'uint32'},
+    ])
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float32'},
+    ])
+    for key, data in [('chat', {'text': u'hello', 'entity_id': 3}),
+                      ('position', {'entity_id': 4, 'x': 0.5})]:
+        assert schema.loads(schema.dumps(key, data),
+                            fields=['entity_id']) == {
+            'entity_id': data['entity_id']}
+    with pytest.raises(KeyError):
+        schema.loads(b'\x00\x09', fields=['entity_id'])
+
+
+@pytest.mark.parametrize('codegen', [False, True])
+def test_schema_auto_id_type(codegen):
+    fields = [
+        {'key': 'entity_id', 'type': 'uint32'},
+        {'key': 'x', 'type': 'float32'},
+    ]
+    schema = jettison.Schema(codegen=codegen)
+    assert schema.id_type == 'uint8'
+    first = schema.define('message1', fields)
+    first.little_endian = True
+    if codegen:
+        first.generate()
+    value = {'entity_id': 1, 'x': 0.5}
+    assert schema.dumps('message1', value) == b'\x01' + first.dumps(value)
+    for i in range(2, 257):
+        schema.define('message{}'.format(i), fields)
+    assert schema.id_type == 'uint16'
+    assert schema.auto_id_type
+
+    # The ids of the definitions that were already defined grow as well.
+    for key, prefix in [('message1', b'\x00\x01'),
+                        ('message256', b'\x01\x00')]:
+        dumped_value = schema.dumps(key, value)
+        definition = schema.definitions[key]
+        assert dumped_value == prefix + definition.dumps(value)
+        assert schema.size_of(key, value) == len(dumped_value)
+        assert schema.loads(dumped_value) == value
+    buffer, offsets = schema.dumps_batch([('message1', value),
+                                          ('message256', value)])
+    assert bytes(buffer) == (schema.dumps('message1', value) +
+                             schema.dumps('message256', value))
+    unpickled_schema = pickle.loads(pickle.dumps(schema))
+    assert unpickled_schema.id_type == 'uint16'
+    assert unpickled_schema.dumps('message256', value) == schema.dumps(
+        'message256', value)
+
+
+def test_schema_explicit_id_type():
+    schema = jettison.Schema(id_type='uint8')
+    for i in range(1, 256):
+        schema.define('message{}'.format(i), [])
+    assert schema.dumps('message255', {}) == b'\xff'
+    with pytest.raises(struct.error):
+        schema.define('message256', [])
+
+    schema = jettison.Schema(id_type='varint')
+    schema.define('message', [{'key': 'x', 'type': 'uint8'}])
+    assert schema.dumps('message', {'x': 2}) == b'\x01\x02'
+    assert schema.loads(b'\x01\x02') == {'x': 2}
@@ -0,0 +1,133 @@
+# encoding: utf-8
+
+import os
+
+import pytest
+
+import jettison
+import jettison.log
+
+
+@pytest.fixture
+def schema():
+    schema = jettison.Schema()
+    schema.define('position', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'x', 'type': 'float64'},
+    ])
+    schema.define('name', [
+        {'key': 'entity_id', 'type': 'int32'},
+        {'key': 'name', 'type': 'string'},
+    ])
+    return schema
+
+
+@pytest.fixture
+def messages():
+    messages = []
+    for i in range(100):
+        messages.append(('position', {'entity_id': i, 'x': i * 0.5}))
+        if i % 3 == 0:
+            messages.append(('name', {'entity_id': i, 'name': u'hodør'}))
+    return messages
+
+
+def write_log(schema, path, messages, mode='wb'):
+    with open(path, mode) as log_file:
+        for key, value in messages:
+            log_file.write(schema.dumps(key, value))
+
+
+def test_message_log(schema, messages, tmpdir):
+    path = str(tmpdir.join('log.bin'))
+    write_log(schema, path, messages)
+    values = [value for key, value in messages]
+    with jettison.log.MessageLog(schema, path) as log:
+        assert len(log) == len(messages)
+        assert log[0] == values[0]
+        assert log[-1] == values[-1]
+        assert log[3:6] == values[3:6]
+        assert list(log) == values
+        assert list(log.iterate(100, 110)) == values[100:110]
+        assert log.raw(1) == schema.dumps(*messages[1])
+        assert log.raw(-1) == schema.dumps(*messages[-1])
+        with pytest.raises(IndexError):
+            log[len(messages)]
+
+
+def test_message_log_partial_and_appended(schema, messages, tmpdir):
+    path = str(tmpdir.join('log.bin'))
+    write_log(schema, path, messages)
+    partial = schema.dumps('name', {'entity_id': 1, 'name': u'abc'})
+    with open(path, 'ab') as log_file:
+        log_file.write(partial[:-1])
+    with jettison.log.MessageLog(schema, path) as log:
+        assert len(log) == len(messages)
+        with open(path, 'ab') as log_file:
+            log_file.write(partial[-1:])
+            log_file.write(schema.dumps(*messages[0]))
+        assert log.refresh() == 2
+        assert log[-2] == {'entity_id': 1, 'name': u'abc'}
+        assert log[-1] == messages[0][1]
+
+
+def test_message_log_index_file(schema, messages, tmpdir):
+    path = str(tmpdir.join('log.bin'))
+    index_path = str(tmpdir.join('log.index'))
+    write_log(schema, path, messages)
+    with jettison.log.MessageLog(schema, path, index_path) as log:
+        offsets = list(log.offsets)
+    assert os.path.exists(index_path)
+
+    # The saved index is used instead of walking through the log again, and
+    # new messages are indexed from the end of the saved index.
+    write_log(schema, path, messages[:2], mode='ab')
+    with jettison.log.MessageLog(schema, path, index_path) as log:
+        assert list(log.offsets)[:len(offsets)] == offsets
+        assert len(log) == len(messages) + 2
+        assert log[-2:] == [value for key, value in messages[:2]]
+    with jettison.log.MessageLog(schema, path, index_path) as log:
+        assert len(log) == len(messages) + 2
+
+    # An index for a different file is ignored.
+    empty_path = str(tmpdir.join('empty.bin'))
+    open(empty_path, 'wb').close()
+    with jettison.log.MessageLog(schema, empty_path, index_path) as log:
+        assert len(log) == 0
+        assert list(log) == []
+
+
+def test_message_log_rewritten(schema, messages, tmpdir):
+    path = str(tmpdir.join('log.bin'))
+    index_path = str(tmpdir.join('log.index'))
+    write_log(schema, path, messages)
+    with jettison.log.MessageLog(schema, path, index_path):
+        pass
+
+    # A log rewritten with different messages, and at least as long as the
+    # indexed part of the old one, is indexed again.
+    rewritten = [('name', {'entity_id': i, 'name': u'x' * (i % 7)})
+                 for i in range(len(messages))]
+    write_log(schema, path, rewritten)
+    with jettison.log.MessageLog(schema, path, index_path) as log:
+        assert len(log) == len(rewritten)
+        assert list(log) == [value for key, value in rewritten]
+
+    # So is a log whose messages only differ in the middle.
+    changed = list(rewritten)
+    changed[len(changed) // 2] = ('position', {'entity_id': 1, 'x': 0.5})
+    write_log(schema, path, changed)
+    with jettison.log.MessageLog(schema, path, index_path) as log:
+        assert list(log) == [value for key, value in changed]
+
+
+def test_message_log_invalid(tmpdir):
+    schema = jettison.Schema(length_type='varint')
+    schema.define('name', [{'key': 'name', 'type': 'string'}])
+    path = str(tmpdir.join('log.bin'))
+    with open(path, 'wb') as log_file:
+        log_file.write(schema.dumps('name', {'name': u'hodør'}))
+        log_file.write(b'\x01' + b'\x80' * 11)
+    with pytest.raises(jettison.struct.error) as error:
+        jettison.log.MessageLog(schema, path)
+    assert not isinstance(error.value, jettison.TruncatedError)